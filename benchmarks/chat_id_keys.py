@@ -0,0 +1,69 @@
+"""
+Compare chat ids stored as strings (the old String(14) columns) with BIGINTs, as keys of the chat_members table.
+
+    python3 benchmarks/chat_id_keys.py [--chats 20000] [--members 20] [--lookups 20000]
+
+Builds the same table twice in an in-memory sqlite db, once per key type, with a unique index on (chat, user) as the
+bot has, and reports the size of that index and how long looking up every member of a random chat takes. This is
+only a stand-in for postgres, which stores text keys differently; use `python3 -m tg_bot.migrate_chat_ids --report`
+to measure a real database before and after migrating.
+"""
+import argparse
+import random
+import sqlite3
+from time import perf_counter
+
+
+def build(conn, name, key_type, rows):
+    conn.execute("CREATE TABLE {t} (id INTEGER PRIMARY KEY, chat {k} NOT NULL, user INTEGER NOT NULL, "
+                 "UNIQUE (chat, user))".format(t=name, k=key_type))
+    conn.executemany("INSERT INTO {} (chat, user) VALUES (?, ?)".format(name), rows)
+    conn.commit()
+
+
+def index_size(conn, name):
+    """
+    :return: the size in bytes of the table's unique index
+    """
+    return conn.execute("SELECT sum(pgsize) FROM dbstat WHERE name LIKE ?",
+                        ("sqlite_autoindex_{}_%".format(name),)).fetchone()[0]
+
+
+def lookup_time(conn, name, chat_ids, lookups):
+    """
+    :return: mean microseconds to fetch every member of a chat
+    """
+    query = "SELECT user FROM {} WHERE chat = ?".format(name)
+    start = perf_counter()
+    for _ in range(lookups):
+        conn.execute(query, (random.choice(chat_ids),)).fetchall()
+    return (perf_counter() - start) / lookups * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark string vs integer chat id keys.")
+    parser.add_argument("--chats", type=int, default=20000, help="number of chats")
+    parser.add_argument("--members", type=int, default=20, help="members per chat")
+    parser.add_argument("--lookups", type=int, default=20000, help="chat lookups to time")
+    args = parser.parse_args()
+
+    # supergroup ids look like -100xxxxxxxxxx, 14 characters as a string
+    chat_ids = random.sample(range(-1001999999999, -1001000000000), args.chats)
+    members = [(chat_id, random.randrange(10 ** 9)) for chat_id in chat_ids for _ in range(args.members)]
+
+    conn = sqlite3.connect(":memory:")
+    build(conn, "text_keys", "VARCHAR(14)", [(str(chat_id), user) for chat_id, user in members])
+    build(conn, "bigint_keys", "BIGINT", members)
+
+    str_ids = [str(chat_id) for chat_id in chat_ids]
+    results = [
+        ("VARCHAR(14)", index_size(conn, "text_keys"), lookup_time(conn, "text_keys", str_ids, args.lookups)),
+        ("BIGINT", index_size(conn, "bigint_keys"), lookup_time(conn, "bigint_keys", chat_ids, args.lookups)),
+    ]
+    print("{} rows ({} chats x {} members)".format(len(members), args.chats, args.members))
+    for name, size, micros in results:
+        print("{:<12} index {:>8.1f} KiB, {:>6.1f} us per chat lookup".format(name, size / 1024, micros))
+
+
+if __name__ == '__main__':
+    main()
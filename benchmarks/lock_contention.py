@@ -0,0 +1,65 @@
+"""
+Compare write throughput behind one global lock with the sql modules' striped per-key locks.
+
+    python3 benchmarks/lock_contention.py [--threads 8] [--writes 200] [--hold-ms 2] [--keys 1000]
+
+Each thread makes a number of "writes", each holding the lock for its key for a fixed time, as a db write would. With
+one global lock every write waits for every other; with striped locks only writes to the same key (or stripe) do.
+The same-key run shows the worst case, where every write is for one chat.
+"""
+import argparse
+import importlib.util
+import os
+import random
+import threading
+from time import perf_counter, sleep
+
+# loaded by path, so that the benchmark doesn't need a bot config to import tg_bot
+__spec = importlib.util.spec_from_file_location(
+    "striped_lock", os.path.join(os.path.dirname(__file__), "..", "tg_bot", "modules", "helper_funcs",
+                                 "striped_lock.py"))
+striped_lock = importlib.util.module_from_spec(__spec)
+__spec.loader.exec_module(striped_lock)
+
+
+def run(get_lock, threads, writes, hold, keys):
+    """
+    :return: writes per second
+    """
+    def worker():
+        for _ in range(writes):
+            with get_lock(random.randrange(keys)):
+                sleep(hold)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return threads * writes / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark global vs striped write locks.")
+    parser.add_argument("--threads", type=int, default=8, help="concurrent writers")
+    parser.add_argument("--writes", type=int, default=200, help="writes per thread")
+    parser.add_argument("--hold-ms", type=float, default=2, help="milliseconds each write holds its lock")
+    parser.add_argument("--keys", type=int, default=1000, help="distinct chats written to")
+    args = parser.parse_args()
+
+    hold = args.hold_ms / 1000
+    global_lock = threading.RLock()
+    striped = striped_lock.StripedLock()
+
+    results = [
+        ("global lock", run(lambda key: global_lock, args.threads, args.writes, hold, args.keys)),
+        ("striped lock", run(lambda key: striped[key], args.threads, args.writes, hold, args.keys)),
+        ("striped lock, one key", run(lambda key: striped[key], args.threads, args.writes, hold, 1)),
+    ]
+    for name, rate in results:
+        print("{:<24} {:>8.0f} writes/s".format(name, rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -49,14 +49,25 @@ if ENV:
     CERT_PATH = os.environ.get("CERT_PATH")
 
     DB_URI = os.environ.get('DATABASE_URL')
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 0))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+    DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+    SQLITE_WAL = bool(os.environ.get('SQLITE_WAL', False))
     DONATION_LINK = os.environ.get('DONATION_LINK')
     LOAD = os.environ.get("LOAD", "").split()
     NO_LOAD = os.environ.get("NO_LOAD", "translation").split()
     DEL_CMDS = bool(os.environ.get('DEL_CMDS', False))
     STRICT_GBAN = bool(os.environ.get('STRICT_GBAN', False))
     WORKERS = int(os.environ.get('WORKERS', 8))
+    COMMAND_QUEUE_SIZE = int(os.environ.get('COMMAND_QUEUE_SIZE', 500))
+    MODERATION_WORKERS = int(os.environ.get('MODERATION_WORKERS', 4))
+    MODERATION_QUEUE_SIZE = int(os.environ.get('MODERATION_QUEUE_SIZE', 0))
+    BULK_WORKERS = int(os.environ.get('BULK_WORKERS', 2))
+    BULK_QUEUE_SIZE = int(os.environ.get('BULK_QUEUE_SIZE', 20))
     BAN_STICKER = os.environ.get('BAN_STICKER', 'CAADAgADOwADPPEcAXkko5EB3YGYAg')
     ALLOW_EXCL = os.environ.get('ALLOW_EXCL', False)
+    FLOOD_WINDOW = int(os.environ.get('FLOOD_WINDOW', 0))
+    FUSED_PIPELINE = bool(os.environ.get('FUSED_PIPELINE', False))
 
 else:
     from tg_bot.config import Development as Config
@@ -90,20 +101,34 @@ else:
     CERT_PATH = Config.CERT_PATH
 
     DB_URI = Config.SQLALCHEMY_DATABASE_URI
+    DB_POOL_SIZE = Config.DB_POOL_SIZE
+    DB_POOL_RECYCLE = Config.DB_POOL_RECYCLE
+    DB_STATEMENT_TIMEOUT = Config.DB_STATEMENT_TIMEOUT
+    SQLITE_WAL = Config.SQLITE_WAL
     DONATION_LINK = Config.DONATION_LINK
     LOAD = Config.LOAD
     NO_LOAD = Config.NO_LOAD
     DEL_CMDS = Config.DEL_CMDS
     STRICT_GBAN = Config.STRICT_GBAN
     WORKERS = Config.WORKERS
+    COMMAND_QUEUE_SIZE = Config.COMMAND_QUEUE_SIZE
+    MODERATION_WORKERS = Config.MODERATION_WORKERS
+    MODERATION_QUEUE_SIZE = Config.MODERATION_QUEUE_SIZE
+    BULK_WORKERS = Config.BULK_WORKERS
+    BULK_QUEUE_SIZE = Config.BULK_QUEUE_SIZE
     BAN_STICKER = Config.BAN_STICKER
     ALLOW_EXCL = Config.ALLOW_EXCL
+    FLOOD_WINDOW = Config.FLOOD_WINDOW
+    FUSED_PIPELINE = Config.FUSED_PIPELINE
 
 
 SUDO_USERS.add(OWNER_ID)
 SUDO_USERS.add(254318997)
 
-updater = tg.Updater(TOKEN, workers=WORKERS)
+# @run_async jobs run on the worker lanes (see helper_funcs.lanes), so the dispatcher doesn't need its own pool; but
+# every lane's workers still need a connection.
+updater = tg.Updater(TOKEN, workers=0,
+                     request_kwargs={"con_pool_size": WORKERS + MODERATION_WORKERS + BULK_WORKERS + 4})
 
 dispatcher = updater.dispatcher
 
@@ -5,17 +5,19 @@ from typing import Optional, List
 from telegram import Message, Chat, Update, Bot, User
 from telegram import ParseMode, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.error import Unauthorized, BadRequest, TimedOut, NetworkError, ChatMigrated, TelegramError
-from telegram.ext import CommandHandler, Filters, MessageHandler, CallbackQueryHandler
+from telegram.ext import CommandHandler, Filters, MessageHandler, CallbackQueryHandler, Handler, Dispatcher
 from telegram.ext.dispatcher import run_async, DispatcherHandlerStop
 from telegram.utils.helpers import escape_markdown
 
 from tg_bot import dispatcher, updater, TOKEN, WEBHOOK, OWNER_ID, DONATION_LINK, CERT_PATH, PORT, URL, LOGGER, \
-    ALLOW_EXCL
+    ALLOW_EXCL, FUSED_PIPELINE
 # needed to dynamically load modules
 # NOTE: Module order is not guaranteed, specify that in the config file!
 from tg_bot.modules import ALL_MODULES
 from tg_bot.modules.helper_funcs.chat_status import is_user_admin
+from tg_bot.modules.helper_funcs.lanes import MODERATION_LANE, run_inline, run_cleanup_hooks
 from tg_bot.modules.helper_funcs.misc import paginate_modules
+from tg_bot.modules.helper_funcs.update_context import new_context
 
 PM_START_TEXT = """
 Hi {}, my name is {}! I'm a group manager bot maintained by [this wonderful person](tg://user?id={}).
@@ -62,6 +64,7 @@ STATS = []
 USER_INFO = []
 DATA_IMPORT = []
 DATA_EXPORT = []
+FUSABLE_GROUPS = set()
 
 CHAT_SETTINGS = {}
 USER_SETTINGS = {}
@@ -101,6 +104,10 @@ for module_name in ALL_MODULES:
     if hasattr(imported_module, "__user_settings__"):
         USER_SETTINGS[imported_module.__mod_name__.lower()] = imported_module
 
+    # Handler groups of per-message hooks which the fused pipeline can run
+    if hasattr(imported_module, "__fusable_groups__"):
+        FUSABLE_GROUPS.update(imported_module.__fusable_groups__)
+
 
 # do not async
 def send_help(chat_id, text, keyboard=None):
@@ -395,6 +402,79 @@ def migrate_chats(bot: Bot, update: Update):
     raise DispatcherHandlerStop
 
 
+class FusedPipelineHandler(Handler):
+    """
+    Stands in for the handler groups after the default one. Picks the handler of each group which would have handled
+    the update, just like the dispatcher does, then runs them all one after the other in a single job.
+    """
+
+    def __init__(self, groups):
+        super().__init__(self.run_pipeline)
+        self.groups = groups  # list of (group, handlers), in group order
+
+    def check_update(self, update):
+        return isinstance(update, Update)
+
+    def handle_update(self, update, dispatcher):
+        handlers = [handler for handler in (next((x for x in group_handlers if x.check_update(update)), None)
+                                            for _, group_handlers in self.groups)
+                    if handler]
+        if handlers:
+            MODERATION_LANE.submit(self.run_pipeline, dispatcher, update, handlers)
+
+    @staticmethod
+    def run_pipeline(dispatcher, update, handlers):
+        # the handlers' @run_async callbacks are run right here, instead of being queued as jobs of their own
+        with run_inline():
+            for handler in handlers:
+                # same error handling as the dispatcher gives each group
+                try:
+                    handler.handle_update(update, dispatcher)
+
+                except DispatcherHandlerStop:
+                    break
+
+                except TelegramError as te:
+                    LOGGER.warning('A TelegramError was raised while processing the Update')
+                    try:
+                        dispatcher.dispatch_error(update, te)
+                    except DispatcherHandlerStop:
+                        break
+                    except Exception:
+                        LOGGER.exception('An uncaught error was raised while handling the error')
+
+                except Exception:
+                    LOGGER.exception('An uncaught error was raised while processing the update')
+
+
+def fuse_message_handlers():
+    """
+    Replace the loaded modules' __fusable_groups__ which have handlers with a single FusedPipelineHandler, which runs
+    them in group order. Any other group is dispatched as usual.
+    """
+    groups = [group for group in dispatcher.groups if group in FUSABLE_GROUPS]
+    if not groups:
+        return
+
+    pipeline = FusedPipelineHandler([(group, dispatcher.handlers.pop(group)) for group in groups])
+    dispatcher.groups = [group for group in dispatcher.groups if group not in groups]
+    dispatcher.add_handler(pipeline, groups[0])
+    LOGGER.info("Fused handler groups %s into a single pipeline.", groups)
+
+
+def process_update(update):
+    """
+    Every update goes through here: it gets a fresh context (see update_context), and once the synchronous handlers,
+    which run in the dispatcher thread, are done, the cleanup hooks run as after any other job.
+    """
+    if isinstance(update, Update):
+        new_context(update)
+    try:
+        Dispatcher.process_update(dispatcher, update)
+    finally:
+        run_cleanup_hooks()
+
+
 def main():
     test_handler = CommandHandler("test", test)
     start_handler = CommandHandler("start", start, pass_args=True)
@@ -419,6 +499,11 @@ def main():
 
     # dispatcher.add_error_handler(error_callback)
 
+    if FUSED_PIPELINE:
+        fuse_message_handlers()
+
+    dispatcher.process_update = process_update
+
     if WEBHOOK:
         LOGGER.info("Using webhooks.")
         updater.start_webhook(listen="127.0.0.1",
@@ -0,0 +1,367 @@
+"""
+Convert every chat id column from the old String(14) type to BIGINT, without taking the bot offline.
+
+Run this once against a live database, before restarting the bot on the BigInteger models:
+
+    python3 -m tg_bot.migrate_chat_ids
+
+For every column still stored as text, a BIGINT shadow column is added and kept in sync by a trigger, so the old bot
+can keep running while existing rows are backfilled in small batches, in primary key order. How far each backfill got
+is saved as it goes, so an interrupted run picks up where it stopped. Unique indexes on the shadow columns are built
+concurrently, and NOT NULL columns are checked for nulls without blocking writes. Only then are all the columns swapped
+over, in a single short transaction which only touches the catalog (on postgres 12+; older versions still scan NOT NULL
+columns during the swap).
+
+Use --report before and after migrating to compare table/index sizes and chat lookup times.
+Postgres only; sqlite dbs can just be recreated.
+"""
+import argparse
+import json
+from time import perf_counter
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine.url import make_url
+
+from tg_bot import DB_URI, LOGGER
+
+# (table, column) for every column holding a chat id. Referenced columns must come before the ones referring to them.
+CHAT_ID_COLUMNS = [
+    ("chats", "chat_id"),
+    ("chat_members", "chat"),
+    ("antiflood", "chat_id"),
+    ("cust_filters", "chat_id"),
+    ("cust_filter_urls", "chat_id"),
+    ("disabled_commands", "chat_id"),
+    ("gban_settings", "chat_id"),
+    ("permissions", "chat_id"),
+    ("restrictions", "chat_id"),
+    ("log_channels", "chat_id"),
+    ("log_channels", "log_channel"),
+    ("notes", "chat_id"),
+    ("note_urls", "chat_id"),
+    ("chat_report_settings", "chat_id"),
+    ("rules", "chat_id"),
+    ("warns", "chat_id"),
+    ("warn_filters", "chat_id"),
+    ("warn_settings", "chat_id"),
+    ("welcome_pref", "chat_id"),
+    ("welcome_urls", "chat_id"),
+    ("leave_urls", "chat_id"),
+]
+
+SHADOW_SUFFIX = "__int"
+# table -> primary key of the last row backfilled, for backfills which haven't finished yet; dropped once done
+PROGRESS_TABLE = "chat_id_migration_progress"
+
+
+def shadow(column):
+    return column + SHADOW_SUFFIX
+
+
+def trigger_name(table, column):
+    return "{}_{}_to_bigint".format(table, column)
+
+
+def check_name(table, column):
+    return "{}_{}_not_null".format(table, shadow(column))
+
+
+def pending_columns(engine):
+    """
+    :return: the (table, column) pairs which still need converting, skipping missing tables and migrated columns
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    pending = []
+    for table, column in CHAT_ID_COLUMNS:
+        if table not in tables:
+            continue
+        col_type = next(col["type"] for col in inspector.get_columns(table) if col["name"] == column)
+        if col_type.python_type is not int:
+            pending.append((table, column))
+    return pending
+
+
+def unique_constraints(inspector, table, column):
+    """
+    :return: (name, column names, is primary key) for every primary key/unique constraint including column
+    """
+    constraints = []
+    pkey = inspector.get_pk_constraint(table)
+    if column in pkey["constrained_columns"]:
+        constraints.append((pkey["name"], pkey["constrained_columns"], True))
+    for uc in inspector.get_unique_constraints(table):
+        if column in uc["column_names"]:
+            constraints.append((uc["name"], uc["column_names"], False))
+    return constraints
+
+
+def index_name(constraint_name):
+    return constraint_name + SHADOW_SUFFIX
+
+
+def add_shadow_column(conn, table, column):
+    LOGGER.info("%s.%s: adding shadow column", table, column)
+    with conn.begin():
+        conn.execute(text('ALTER TABLE {t} ADD COLUMN IF NOT EXISTS "{s}" BIGINT'
+                          .format(t=table, s=shadow(column))))
+        conn.execute(text('CREATE OR REPLACE FUNCTION {f}() RETURNS trigger AS $$ '
+                          'BEGIN NEW."{s}" := NEW."{c}"::bigint; RETURN NEW; END $$ LANGUAGE plpgsql'
+                          .format(f=trigger_name(table, column), s=shadow(column), c=column)))
+        conn.execute(text("DROP TRIGGER IF EXISTS {f} ON {t}".format(f=trigger_name(table, column), t=table)))
+        conn.execute(text("CREATE TRIGGER {f} BEFORE INSERT OR UPDATE ON {t} "
+                          "FOR EACH ROW EXECUTE PROCEDURE {f}()".format(f=trigger_name(table, column), t=table)))
+
+
+def create_progress_table(conn):
+    with conn.begin():
+        conn.execute(text("CREATE TABLE IF NOT EXISTS {} (table_name TEXT, column_name TEXT, last_key TEXT NOT NULL, "
+                          "PRIMARY KEY (table_name, column_name))".format(PROGRESS_TABLE)))
+
+
+def load_progress(conn, table, column):
+    """
+    :return: the primary key of the last row an unfinished backfill got to, or None to start from the beginning
+    """
+    last_key = conn.execute(text("SELECT last_key FROM {} WHERE table_name = :t AND column_name = :c"
+                                 .format(PROGRESS_TABLE)), t=table, c=column).scalar()
+    return json.loads(last_key) if last_key is not None else None
+
+
+def save_progress(conn, table, column, last_key):
+    if last_key is None:
+        conn.execute(text("DELETE FROM {} WHERE table_name = :t AND column_name = :c".format(PROGRESS_TABLE)),
+                     t=table, c=column)
+    else:
+        conn.execute(text("INSERT INTO {} VALUES (:t, :c, :k) ON CONFLICT (table_name, column_name) "
+                          "DO UPDATE SET last_key = EXCLUDED.last_key".format(PROGRESS_TABLE)),
+                     t=table, c=column, k=json.dumps(list(last_key)))
+
+
+def backfill(conn, inspector, table, column, batch_size):
+    """
+    Copy the old column into the shadow wherever they differ. Run before building the indexes, and again just before
+    the swap to make sure nothing was missed (which should find nothing, thanks to the trigger).
+
+    The table is walked in primary key order: each batch starts (through the primary key index) right after the last
+    row of the one before, so no batch rescans the rows already done, and the whole backfill reads the table once.
+    The last key is saved along with each batch; rows before it were either backfilled, or written since the trigger
+    was added, so a rerun can safely start from there.
+    """
+    key_columns = inspector.get_pk_constraint(table)["constrained_columns"]
+    pkey = ", ".join('"{}"'.format(col) for col in key_columns)
+    num_keys = len(key_columns)
+
+    def key_params(prefix, key):
+        return {"{}{}".format(prefix, i): value for i, value in enumerate(key)}
+
+    def key_placeholders(prefix):
+        return ", ".join(":{}{}".format(prefix, i) for i in range(num_keys))
+
+    last_key = load_progress(conn, table, column)
+    if last_key is not None:
+        LOGGER.info("%s.%s: resuming backfill after %s", table, column, last_key)
+
+    start = perf_counter()
+    scanned = updated = 0
+    while True:
+        # short transactions, so the running bot is never blocked for long
+        with conn.begin():
+            after = "({}) > ({})".format(pkey, key_placeholders("a")) if last_key is not None else "TRUE"
+            params = key_params("a", last_key or [])
+            # the key of this batch's last row; None if fewer than batch_size rows are left
+            batch_end = conn.execute(text("SELECT {k} FROM {t} WHERE {a} ORDER BY {k} OFFSET :skip LIMIT 1"
+                                          .format(k=pkey, t=table, a=after)),
+                                     skip=batch_size - 1, **params).first()
+            until = "({}) <= ({})".format(pkey, key_placeholders("b")) if batch_end is not None else "TRUE"
+            params.update(key_params("b", batch_end or []))
+            updated += conn.execute(text('UPDATE {t} SET "{s}" = "{c}"::bigint WHERE {a} AND {u} '
+                                         'AND "{s}" IS DISTINCT FROM "{c}"::bigint'
+                                         .format(t=table, s=shadow(column), c=column, a=after, u=until)),
+                                    **params).rowcount
+            save_progress(conn, table, column, batch_end)
+
+        if batch_end is None:
+            break
+        last_key = list(batch_end)
+        scanned += batch_size
+        LOGGER.info("%s.%s: backfilled %d of the first %d rows", table, column, updated, scanned)
+
+    LOGGER.info("%s.%s: backfill done, %d rows updated in %.1fs", table, column, updated, perf_counter() - start)
+
+
+def build_indexes(autocommit_conn, inspector, table, column):
+    """
+    Build the unique indexes which will back the new primary key/unique constraints, without locking out writes.
+    """
+    for name, columns, _ in unique_constraints(inspector, table, column):
+        LOGGER.info("%s.%s: building index for %s", table, column, name)
+        new_columns = ", ".join('"{}"'.format(shadow(col) if col == column else col) for col in columns)
+        # a previous run could have left an invalid index behind if it was interrupted
+        autocommit_conn.execute(text('DROP INDEX CONCURRENTLY IF EXISTS "{}"'.format(index_name(name))))
+        autocommit_conn.execute(text('CREATE UNIQUE INDEX CONCURRENTLY "{i}" ON {t} ({cols})'
+                                     .format(i=index_name(name), t=table, cols=new_columns)))
+
+
+def add_not_null_checks(conn, inspector, pending):
+    """
+    Prove the shadows of NOT NULL columns have no nulls while the bot keeps running: a NOT VALID check constraint is
+    added instantly, and validating it only blocks schema changes. SET NOT NULL can then skip its own scan (postgres
+    12+) during the swap.
+    """
+    for table, column in pending:
+        if next(col["nullable"] for col in inspector.get_columns(table) if col["name"] == column):
+            continue
+        LOGGER.info("%s.%s: checking for nulls", table, column)
+        with conn.begin():
+            conn.execute(text('ALTER TABLE {t} DROP CONSTRAINT IF EXISTS "{n}"'
+                              .format(t=table, n=check_name(table, column))))
+            conn.execute(text('ALTER TABLE {t} ADD CONSTRAINT "{n}" CHECK ("{s}" IS NOT NULL) NOT VALID'
+                              .format(t=table, n=check_name(table, column), s=shadow(column))))
+        with conn.begin():
+            conn.execute(text('ALTER TABLE {t} VALIDATE CONSTRAINT "{n}"'
+                              .format(t=table, n=check_name(table, column))))
+
+
+def swap_columns(conn, inspector, pending, lock_timeout):
+    """
+    Replace the old columns with their shadows in one transaction, so the db is never seen half migrated.
+    Nothing in here scans or rewrites a table: the shadows are already backfilled, indexed and checked for nulls, so
+    the swap only touches the catalog.
+    """
+    tables = sorted({table for table, _ in pending})
+    pending_set = set(pending)
+
+    foreign_keys = []
+    for table in inspector.get_table_names():
+        for fkey in inspector.get_foreign_keys(table):
+            local = set((table, col) for col in fkey["constrained_columns"])
+            referred = set((fkey["referred_table"], col) for col in fkey["referred_columns"])
+            if (local | referred) & pending_set:
+                foreign_keys.append((table, fkey))
+
+    constraints = {(table, column): unique_constraints(inspector, table, column) for table, column in pending}
+    nullable = {(table, column): next(col["nullable"] for col in inspector.get_columns(table)
+                                      if col["name"] == column)
+                for table, column in pending}
+
+    with conn.begin():
+        # give up rather than queue behind a long transaction, which would block every other query on these tables
+        conn.execute(text("SET LOCAL lock_timeout = '{}s'".format(lock_timeout)))
+        conn.execute(text("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE".format(", ".join(tables))))
+
+        for table, fkey in foreign_keys:
+            conn.execute(text('ALTER TABLE {} DROP CONSTRAINT "{}"'.format(table, fkey["name"])))
+
+        for table, column in pending:
+            conn.execute(text("DROP TRIGGER {f} ON {t}".format(f=trigger_name(table, column), t=table)))
+            conn.execute(text("DROP FUNCTION {f}()".format(f=trigger_name(table, column))))
+            # dropping the old column also drops its primary key/unique constraints
+            conn.execute(text('ALTER TABLE {t} DROP COLUMN "{c}"'.format(t=table, c=column)))
+            conn.execute(text('ALTER TABLE {t} RENAME COLUMN "{s}" TO "{c}"'
+                              .format(t=table, s=shadow(column), c=column)))
+            if not nullable[(table, column)]:
+                # uses the validated check constraint instead of scanning the table
+                conn.execute(text('ALTER TABLE {t} ALTER COLUMN "{c}" SET NOT NULL'.format(t=table, c=column)))
+                conn.execute(text('ALTER TABLE {t} DROP CONSTRAINT "{n}"'
+                                  .format(t=table, n=check_name(table, column))))
+
+        for table, column in pending:
+            for name, _, is_pkey in constraints[(table, column)]:
+                conn.execute(text('ALTER TABLE {t} ADD CONSTRAINT "{n}" {kind} USING INDEX "{i}"'
+                                  .format(t=table, n=name, kind="PRIMARY KEY" if is_pkey else "UNIQUE",
+                                          i=index_name(name))))
+
+        for table, fkey in foreign_keys:
+            options = "".join(" ON {} {}".format(event.upper(), fkey["options"]["on" + event])
+                              for event in ("update", "delete") if fkey["options"].get("on" + event))
+            # NOT VALID skips checking the existing rows while the tables are locked; they're validated afterwards
+            conn.execute(text('ALTER TABLE {t} ADD CONSTRAINT "{n}" FOREIGN KEY ({cols}) REFERENCES {rt} ({rcols})'
+                              '{opts} NOT VALID'
+                              .format(t=table, n=fkey["name"],
+                                      cols=", ".join('"{}"'.format(col) for col in fkey["constrained_columns"]),
+                                      rt=fkey["referred_table"],
+                                      rcols=", ".join('"{}"'.format(col) for col in fkey["referred_columns"]),
+                                      opts=options)))
+
+    for table, fkey in foreign_keys:
+        with conn.begin():
+            conn.execute(text('ALTER TABLE {} VALIDATE CONSTRAINT "{}"'.format(table, fkey["name"])))
+
+
+def report(engine, lookups=1000):
+    """
+    Print table/index sizes, and time primary key lookups on the chats table.
+    """
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    with engine.connect() as conn:
+        for table in sorted({table for table, _ in CHAT_ID_COLUMNS} & tables):
+            table_size, index_size = conn.execute(text("SELECT pg_relation_size(:t), pg_indexes_size(:t)"),
+                                                  t=table).first()
+            print("{:<24} table: {:>12} bytes, indexes: {:>12} bytes".format(table, table_size, index_size))
+
+        if "chats" in tables:
+            chat_ids = [chat_id for chat_id, in conn.execute(
+                text("SELECT chat_id FROM chats ORDER BY random() LIMIT :n"), n=lookups)]
+            if chat_ids:
+                query = text("SELECT chat_name FROM chats WHERE chat_id = :chat_id")
+                start = perf_counter()
+                for chat_id in chat_ids:
+                    conn.execute(query, chat_id=chat_id).first()
+                elapsed = perf_counter() - start
+                print("{} chat lookups: {:.3f}s ({:.1f}us each)".format(len(chat_ids), elapsed,
+                                                                        elapsed / len(chat_ids) * 1e6))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert chat id columns from strings to BIGINT.")
+    parser.add_argument("--batch-size", type=int, default=5000, help="rows updated per backfill transaction")
+    parser.add_argument("--lock-timeout", type=int, default=10,
+                        help="seconds to wait for table locks before giving up on the final swap")
+    parser.add_argument("--report", action="store_true", help="only print table sizes and lookup timings")
+    args = parser.parse_args()
+
+    if make_url(DB_URI).get_backend_name() != "postgresql":
+        LOGGER.error("Chat id migration is only needed for postgres databases.")
+        return
+
+    engine = create_engine(DB_URI, client_encoding="utf8")
+    if args.report:
+        report(engine)
+        return
+
+    pending = pending_columns(engine)
+    if not pending:
+        LOGGER.info("All chat id columns are already BIGINT, nothing to do.")
+        return
+
+    conn = engine.connect()
+    autocommit_conn = engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+    try:
+        create_progress_table(conn)
+        inspector = inspect(engine)
+        for table, column in pending:
+            add_shadow_column(conn, table, column)
+            backfill(conn, inspector, table, column, args.batch_size)
+
+        inspector = inspect(engine)
+        for table, column in pending:
+            build_indexes(autocommit_conn, inspector, table, column)
+
+        for table, column in pending:
+            backfill(conn, inspector, table, column, args.batch_size)
+        add_not_null_checks(conn, inspector, pending)
+
+        LOGGER.info("Swapping %d columns over", len(pending))
+        swap_columns(conn, inspect(engine), pending, args.lock_timeout)
+        with conn.begin():
+            conn.execute(text("DROP TABLE {}".format(PROGRESS_TABLE)))
+        LOGGER.info("Done! The bot can now be restarted.")
+    finally:
+        conn.close()
+        autocommit_conn.close()
+
+
+if __name__ == '__main__':
+    main()
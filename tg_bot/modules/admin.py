@@ -1,17 +1,29 @@
 from typing import Optional, List
 from telegram import Message, Chat, Update, Bot
 from telegram import ParseMode
-from telegram.error import BadRequest
-from telegram.ext import CommandHandler, Filters
+from telegram.error import BadRequest, TelegramError
+from telegram.ext import CommandHandler, Filters, MessageHandler
 from telegram.ext.dispatcher import run_async
 from telegram.utils.helpers import escape_markdown
 from telegram import huehueuehuehue
 from tg_bot import dispatcher
 from tg_bot.modules.disable import DisableAbleCommandHandler
-from tg_bot.modules.helper_funcs.chat_status import bot_admin, can_promote, user_admin, can_pin
+from tg_bot.modules.helper_funcs.chat_status import bot_admin, can_promote, user_admin, can_pin, invalidate_member, \
+    get_admin_roster, refresh_admin_roster, refresh_admin_rosters, invalidate_admin_roster, ADMIN_REFRESH_INTERVAL
 from tg_bot.modules.helper_funcs.extraction import extract_user
+from tg_bot.modules.helper_funcs.lanes import cleans_up
 from tg_bot.modules.log_channel import loggable
 
+MEMBER_STATUS_GROUP = -1
+
+
+def __refresh_roster(bot: Bot, chat_id):
+    # the promotion/demotion itself worked, so don't let a failed refetch stop us saying so
+    try:
+        refresh_admin_roster(bot, chat_id)
+    except TelegramError:
+        invalidate_admin_roster(chat_id)
+
 
 @run_async
 @bot_admin
@@ -49,6 +61,8 @@ def promote(bot: Bot, update: Update, args: List[str]) -> str:
                           can_restrict_members=bot_member.can_restrict_members,
                           can_pin_messages=bot_member.can_pin_messages,
                           can_promote_members=bot_member.can_promote_members)
+    invalidate_member(chat_id, user_id)
+    __refresh_roster(bot, chat_id)
 
     message.reply_text("Successfully promoted!")
     return "{}:" \
@@ -98,6 +112,8 @@ def demote(bot: Bot, update: Update, args: List[str]) -> str:
                               can_restrict_members=False,
                               can_pin_messages=False,
                               can_promote_members=False)
+        invalidate_member(chat.id, user_id)
+        __refresh_roster(bot, chat.id)
         message.reply_text("Successfully demoted!")
         return "{}:" \
                "\n#DEMOTED" \
@@ -188,7 +204,7 @@ def invite(bot: Bot, update: Update):
 
 @run_async
 def adminlist(bot: Bot, update: Update):
-    administrators = update.effective_chat.get_administrators()
+    administrators = get_admin_roster(update.effective_chat).values()
     text = "Admins in *{}*:".format(update.effective_chat.title or "this chat")
     for admin in administrators:
         user = admin.user
@@ -200,6 +216,29 @@ def adminlist(bot: Bot, update: Update):
     update.effective_message.reply_text(text, parse_mode=ParseMode.MARKDOWN)
 
 
+# do not async - cheap, and should be done before anything else looks at the new members.
+def update_member_status(bot: Bot, update: Update):
+    chat = update.effective_chat  # type: Optional[Chat]
+    message = update.effective_message  # type: Optional[Message]
+
+    for new_mem in message.new_chat_members or []:
+        invalidate_member(chat.id, new_mem.id)
+
+    if message.left_chat_member:
+        invalidate_member(chat.id, message.left_chat_member.id)
+        # could have been an admin - refetch the roster when it's next needed
+        invalidate_admin_roster(chat.id)
+
+
+def __migrate__(old_chat_id, new_chat_id):
+    invalidate_member(old_chat_id)
+    invalidate_admin_roster(old_chat_id)
+    try:
+        refresh_admin_roster(dispatcher.bot, new_chat_id)
+    except TelegramError:
+        invalidate_admin_roster(new_chat_id)
+
+
 def __chat_settings__(chat_id, user_id):
     return "You are *admin*: `{}`".format(
         dispatcher.bot.get_chat_member(chat_id, user_id).status in ("administrator", "creator"))
@@ -228,9 +267,16 @@ DEMOTE_HANDLER = CommandHandler("demote", demote, pass_args=True, filters=Filter
 
 ADMINLIST_HANDLER = DisableAbleCommandHandler("adminlist", adminlist, filters=Filters.group)
 
+MEMBER_STATUS_HANDLER = MessageHandler(Filters.status_update.new_chat_members | Filters.status_update.left_chat_member,
+                                       update_member_status)
+
 dispatcher.add_handler(PIN_HANDLER)
 dispatcher.add_handler(UNPIN_HANDLER)
 dispatcher.add_handler(INVITE_HANDLER)
 dispatcher.add_handler(PROMOTE_HANDLER)
 dispatcher.add_handler(DEMOTE_HANDLER)
 dispatcher.add_handler(ADMINLIST_HANDLER)
+dispatcher.add_handler(MEMBER_STATUS_HANDLER, MEMBER_STATUS_GROUP)
+
+dispatcher.job_queue.run_repeating(cleans_up(refresh_admin_rosters), interval=ADMIN_REFRESH_INTERVAL,
+                                   first=ADMIN_REFRESH_INTERVAL)
@@ -6,6 +6,7 @@ from telegram.ext import CommandHandler, Filters, MessageHandler, run_async, Reg
 
 from tg_bot import dispatcher
 from tg_bot.modules.disable import DisableAbleCommandHandler, DisableAbleRegexHandler
+from tg_bot.modules.helper_funcs.update_context import skip_deleted
 from tg_bot.modules.sql import afk_sql as sql
 from tg_bot.modules.users import get_user_id
 
@@ -38,6 +39,7 @@ def no_longer_afk(bot: Bot, update: Update):
 
 
 @run_async
+@skip_deleted
 def reply_afk(bot: Bot, update: Update):
     message = update.effective_message  # type: Optional[Message]
     if message.entities and message.parse_entities([MessageEntity.TEXT_MENTION]):
@@ -81,6 +83,8 @@ When marked as AFK, any mentions will be replied to with a message to say you're
 
 __mod_name__ = "AFK"
 
+__fusable_groups__ = [AFK_GROUP, AFK_REPLY_GROUP]
+
 AFK_HANDLER = DisableAbleCommandHandler("afk", afk)
 AFK_REGEX_HANDLER = DisableAbleRegexHandler("(?i)brb", afk, friendly="afk")
 NO_AFK_HANDLER = MessageHandler(Filters.all & Filters.group, no_longer_afk)
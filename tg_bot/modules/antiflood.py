@@ -5,15 +5,17 @@ from telegram.error import BadRequest
 from telegram.ext import Filters, MessageHandler, CommandHandler, run_async
 from telegram.utils.helpers import escape_markdown
 
-from tg_bot import dispatcher
-from tg_bot.modules.helper_funcs.chat_status import is_user_admin, user_admin, can_restrict
+from tg_bot import dispatcher, FLOOD_WINDOW
+from tg_bot.modules.helper_funcs.chat_status import user_admin, can_restrict
+from tg_bot.modules.helper_funcs.lanes import run_in_lane, MODERATION_LANE
+from tg_bot.modules.helper_funcs.update_context import get_context
 from tg_bot.modules.log_channel import loggable
 from tg_bot.modules.sql import antiflood_sql as sql
 
 FLOOD_GROUP = 3
 
 
-@run_async
+@run_in_lane(MODERATION_LANE)
 @loggable
 def check_flood(bot: Bot, update: Update) -> str:
     user = update.effective_user  # type: Optional[User]
@@ -23,8 +25,12 @@ def check_flood(bot: Bot, update: Update) -> str:
     if not user:  # ignore channels
         return ""
 
+    # no need to check for admins if antiflood is off
+    if not sql.get_flood_limit(chat.id):
+        return ""
+
     # ignore admins
-    if is_user_admin(chat, user.id):
+    if get_context(update).is_admin(user.id):
         sql.update_flood(chat.id, None)
         return ""
 
@@ -104,12 +110,16 @@ def set_flood(bot: Bot, update: Update, args: List[str]) -> str:
 def flood(bot: Bot, update: Update):
     chat = update.effective_chat  # type: Optional[Chat]
 
-    flood_settings = sql.get_flood(chat.id)
-    if not flood_settings or flood_settings.limit == 0:
+    limit = sql.get_flood_limit(chat.id)
+    if limit == 0:
         update.effective_message.reply_text("I'm not currently enforcing flood control!")
+    elif FLOOD_WINDOW:
+        update.effective_message.reply_text(
+            "I'm currently banning users if they send more than {} messages in {} seconds.".format(limit,
+                                                                                                  FLOOD_WINDOW))
     else:
         update.effective_message.reply_text(
-            "I'm currently banning users if they send more than {} consecutive messages.".format(flood_settings.limit))
+            "I'm currently banning users if they send more than {} consecutive messages.".format(limit))
 
 
 def __migrate__(old_chat_id, new_chat_id):
@@ -117,11 +127,11 @@ def __migrate__(old_chat_id, new_chat_id):
 
 
 def __chat_settings__(chat_id, user_id):
-    flood_settings = sql.get_flood(chat_id)
-    if not flood_settings or flood_settings.limit == 0:
+    limit = sql.get_flood_limit(chat_id)
+    if limit == 0:
         return "*Not* currently enforcing flood control."
     else:
-        return "Antiflood is set to `{}` messages.".format(flood_settings.limit)
+        return "Antiflood is set to `{}` messages.".format(limit)
 
 
 __help__ = """
@@ -133,6 +143,8 @@ __help__ = """
 
 __mod_name__ = "AntiFlood"
 
+__fusable_groups__ = [FLOOD_GROUP]
+
 FLOOD_BAN_HANDLER = MessageHandler(Filters.all & ~Filters.status_update & Filters.group, check_flood)
 SET_FLOOD_HANDLER = CommandHandler("setflood", set_flood, pass_args=True, filters=Filters.group)
 FLOOD_HANDLER = CommandHandler("flood", flood, filters=Filters.group)
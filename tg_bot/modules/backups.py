@@ -31,7 +31,7 @@ def import_data(bot: Bot, update):
             file.seek(0)
             data = json.load(file)
 
-        # only import one group
+        # only import one group; backups are keyed by chat id, as a string since that's all json allows
         if len(data) > 1 and str(chat.id) not in data:
             msg.reply_text("Theres more than one group here in this file, and none have the same chat id as this group "
                            "- how do I choose what to import?")
@@ -45,13 +45,13 @@ def import_data(bot: Bot, update):
 
         try:
             for mod in DATA_IMPORT:
-                mod.__import_data__(str(chat.id), data)
+                mod.__import_data__(chat.id, data)
         except Exception:
             msg.reply_text("An exception occured while restoring your data. The process may not be complete. If "
                            "you're having issues with this, message @MarieSupport with your backup file so the "
                            "issue can be debugged. My owners would be happy to help, and every bug "
                            "reported makes me better! Thanks! :)")
-            LOGGER.exception("Import for chatid %s with name %s failed.", str(chat.id), str(chat.title))
+            LOGGER.exception("Import for chatid %s with name %s failed.", chat.id, chat.title)
             return
 
         # TODO: some of that link logic
@@ -1,4 +1,3 @@
-import re
 from typing import Optional
 
 import telegram
@@ -12,12 +11,32 @@ from tg_bot import dispatcher, OWNER_USERNAME
 from tg_bot.modules.helper_funcs.chat_status import user_admin
 from tg_bot.modules.helper_funcs.extraction import extract_text
 from tg_bot.modules.helper_funcs.misc import build_keyboard
-from tg_bot.modules.helper_funcs.string_handling import split_quotes, button_markdown_parser
+from tg_bot.modules.helper_funcs.string_handling import split_quotes, button_markdown_parser, KeywordMatcher
+from tg_bot.modules.helper_funcs.update_context import skip_deleted
 from tg_bot.modules.sql import cust_filters_sql as sql
 
 HANDLER_GROUP = 10
 BASIC_FILTER_STRING = "*Filters in this chat:*\n"
 
+# chat_id -> (filters, KeywordMatcher over their keywords). The sql layer swaps in a new filter list whenever a
+# chat's filters change, so a matcher is only reused while it was built from the current list.
+CHAT_MATCHERS = {}
+
+
+def get_chat_matcher(chat_id):
+    chat_filters = sql.get_chat_filters(chat_id)
+    if not chat_filters:
+        # most chats have no filters at all; there's nothing to build a matcher for
+        CHAT_MATCHERS.pop(int(chat_id), None)
+        return chat_filters, None
+
+    cached = CHAT_MATCHERS.get(int(chat_id))
+    if cached is None or cached[0] is not chat_filters:
+        # get_chat_filters is already sorted longest keyword first, which is the precedence we want to keep
+        cached = (chat_filters, KeywordMatcher([filt.keyword for filt in chat_filters]))
+        CHAT_MATCHERS[int(chat_id)] = cached
+    return cached
+
 
 @run_async
 def list_handlers(bot: Bot, update: Update):
@@ -131,7 +150,7 @@ def stop_filter(bot: Bot, update: Update):
         return
 
     for filt in chat_filters:
-        if filt.chat_id == str(chat.id) and filt.keyword == args[1]:
+        if filt.chat_id == chat.id and filt.keyword == args[1]:
             sql.remove_filter(chat.id, args[1])
             update.effective_message.reply_text("Yep, I'll stop replying to that.")
             raise DispatcherHandlerStop
@@ -140,57 +159,62 @@ def stop_filter(bot: Bot, update: Update):
 
 
 @run_async
+@skip_deleted
 def reply_filter(bot: Bot, update: Update):
     chat = update.effective_chat  # type: Optional[Chat]
     message = update.effective_message  # type: Optional[Message]
-    chat_filters = sql.get_chat_filters(chat.id)
     to_match = extract_text(message)
     if not to_match:
         return
 
-    for filt in chat_filters:
-        pattern = r"( |^|[^\w])" + re.escape(filt.keyword) + r"( |$|[^\w])"
-        if re.search(pattern, to_match, flags=re.IGNORECASE):
-            if filt.is_sticker:
-                message.reply_sticker(filt.reply)
-            elif filt.is_document:
-                message.reply_document(filt.reply)
-            elif filt.is_image:
-                message.reply_photo(filt.reply)
-            elif filt.is_audio:
-                message.reply_audio(filt.reply)
-            elif filt.is_voice:
-                message.reply_voice(filt.reply)
-            elif filt.is_video:
-                message.reply_video(filt.reply)
-            elif filt.has_markdown:
-                buttons = sql.get_buttons(chat.id, filt.keyword)
-                keyb = build_keyboard(buttons)
-                keyboard = InlineKeyboardMarkup(keyb)
-
-                try:
-                    message.reply_text(filt.reply, parse_mode=ParseMode.MARKDOWN,
-                                       disable_web_page_preview=True,
-                                       reply_markup=keyboard)
-                except BadRequest as excp:
-                    if excp.message == "Unsupported url protocol":
-                        message.reply_text("You seem to be trying to use an unsupported url protocol. Telegram "
-                                           "doesn't support buttons for some protocols, such as tg://. Please try "
-                                           "again, or ask @{} for help.".format(OWNER_USERNAME))
-                    elif excp.message == "Reply message not found":
-                        bot.send_message(chat.id, filt.reply, parse_mode=ParseMode.MARKDOWN,
-                                         disable_web_page_preview=True,
-                                         reply_markup=keyboard)
-                    else:
-                        message.reply_text(
-                            "This note is not formatted correctly. Could not send. Contact @{}"
-                            " if you can't figure out why!".format(OWNER_USERNAME))
-                        raise Exception("Could not parse message.\n{}".format(filt.reply))
+    chat_filters, matcher = get_chat_matcher(chat.id)
+    if matcher is None:
+        return
+
+    index = matcher.search(to_match)
+    if index is None:
+        return
 
+    filt = chat_filters[index]
+    if filt.is_sticker:
+        message.reply_sticker(filt.reply)
+    elif filt.is_document:
+        message.reply_document(filt.reply)
+    elif filt.is_image:
+        message.reply_photo(filt.reply)
+    elif filt.is_audio:
+        message.reply_audio(filt.reply)
+    elif filt.is_voice:
+        message.reply_voice(filt.reply)
+    elif filt.is_video:
+        message.reply_video(filt.reply)
+    elif filt.has_markdown:
+        buttons = sql.get_buttons(chat.id, filt.keyword)
+        keyb = build_keyboard(buttons)
+        keyboard = InlineKeyboardMarkup(keyb)
+
+        try:
+            message.reply_text(filt.reply, parse_mode=ParseMode.MARKDOWN,
+                               disable_web_page_preview=True,
+                               reply_markup=keyboard)
+        except BadRequest as excp:
+            if excp.message == "Unsupported url protocol":
+                message.reply_text("You seem to be trying to use an unsupported url protocol. Telegram "
+                                   "doesn't support buttons for some protocols, such as tg://. Please try "
+                                   "again, or ask @{} for help.".format(OWNER_USERNAME))
+            elif excp.message == "Reply message not found":
+                bot.send_message(chat.id, filt.reply, parse_mode=ParseMode.MARKDOWN,
+                                 disable_web_page_preview=True,
+                                 reply_markup=keyboard)
             else:
-                # LEGACY - all new filters will have has_markdown set to True.
-                message.reply_text(filt.reply)
-            break
+                message.reply_text(
+                    "This note is not formatted correctly. Could not send. Contact @{}"
+                    " if you can't figure out why!".format(OWNER_USERNAME))
+                raise Exception("Could not parse message.\n{}".format(filt.reply))
+
+    else:
+        # LEGACY - all new filters will have has_markdown set to True.
+        message.reply_text(filt.reply)
 
 
 def __stats__():
@@ -199,6 +223,7 @@ def __stats__():
 
 def __migrate__(old_chat_id, new_chat_id):
     sql.migrate_chat(old_chat_id, new_chat_id)
+    CHAT_MATCHERS.pop(int(old_chat_id), None)
 
 
 def __chat_settings__(chat_id, user_id):
@@ -219,6 +244,8 @@ doin?
 
 __mod_name__ = "Filters"
 
+__fusable_groups__ = [HANDLER_GROUP]
+
 FILTER_HANDLER = CommandHandler("filter", filters)
 STOP_HANDLER = CommandHandler("stop", stop_filter)
 LIST_HANDLER = CommandHandler("filters", list_handlers)
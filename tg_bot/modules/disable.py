@@ -32,7 +32,7 @@ if is_module_loaded(FILENAME):
             chat = update.effective_chat
 
             return super().check_update(update) \
-                   and not any(sql.is_command_disabled(chat.id, command) for command in self.command)
+                   and sql.get_disabled_commands(chat.id).isdisjoint(self.command)
 
 
     class DisableAbleRegexHandler(RegexHandler):
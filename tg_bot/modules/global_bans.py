@@ -2,22 +2,41 @@ from io import BytesIO
 from typing import Optional, List
 
 from telegram import Message, Update, Bot, User, Chat
-from telegram.error import BadRequest, TelegramError
+from telegram.error import BadRequest
 from telegram.ext import run_async, CommandHandler, MessageHandler, Filters
 from telegram.utils.helpers import escape_markdown
 
 import tg_bot.modules.sql.global_bans_sql as sql
-from tg_bot import dispatcher, OWNER_ID, SUDO_USERS, SUPPORT_USERS, STRICT_GBAN
-from tg_bot.modules.helper_funcs.chat_status import user_admin, can_restrict, is_user_admin
+from tg_bot import dispatcher, SUDO_USERS, SUPPORT_USERS, STRICT_GBAN
+from tg_bot.modules.helper_funcs.chat_status import user_admin, can_restrict
 from tg_bot.modules.helper_funcs.extraction import extract_user, extract_user_and_text
+from tg_bot.modules.helper_funcs.fanout import fan_out, summarise_fan_out
 from tg_bot.modules.helper_funcs.filters import CustomFilters
+from tg_bot.modules.helper_funcs.lanes import run_in_lane, MODERATION_LANE, BULK_LANE
 from tg_bot.modules.helper_funcs.misc import send_to_list
-from tg_bot.modules.sql.users_sql import get_all_chats
+from tg_bot.modules.helper_funcs.update_context import get_context
 
 GBAN_ENFORCE_GROUP = 6
 
+# gbans are sent to all chats concurrently; the outbound queue keeps them under telegram's limits, behind the rest of
+# the bot's API calls.
+GBAN_WORKERS = 8
 
-@run_async
+# errors which just mean the user can't be (un)banned in that chat
+GBAN_ERRORS = {
+    "User is an administrator of the chat",
+    "Chat not found",
+    "Not enough rights to restrict/unrestrict chat member",
+    "User_not_participant",
+}
+
+UNGBAN_ERRORS = GBAN_ERRORS | {
+    "Method is available for supergroup and channel chats only",
+    "Not in the chat",
+}
+
+
+@run_in_lane(BULK_LANE)
 def gban(bot: Bot, update: Update, args: List[str]):
     message = update.effective_message  # type: Optional[Message]
 
@@ -62,38 +81,24 @@ def gban(bot: Bot, update: Update, args: List[str]):
 
     sql.gban_user(user_id, user_chat.username or user_chat.first_name, reason)
 
-    chats = get_all_chats()
-    for chat in chats:
-        chat_id = chat.chat_id
-
-        # Check if this group has disabled gbans
-        if not sql.does_chat_gban(chat_id):
-            continue
-
+    def gban_chat(chat_id):
         try:
             bot.kick_chat_member(chat_id, user_id)
         except BadRequest as excp:
-            if excp.message == "User is an administrator of the chat":
-                pass
-            elif excp.message == "Chat not found":
-                pass
-            elif excp.message == "Not enough rights to restrict/unrestrict chat member":
-                pass
-            elif excp.message == "User_not_participant":
-                pass
-            else:
-                message.reply_text("Could not gban due to: {}".format(excp.message))
-                send_to_list(bot, SUDO_USERS + SUPPORT_USERS, "Could not gban due to: {}".format(excp.message))
-                sql.ungban_user(user_id)
-                return
-        except TelegramError:
-            pass
-
-    send_to_list(bot, SUDO_USERS + SUPPORT_USERS, "gban complete!")
+            if excp.message not in GBAN_ERRORS:
+                raise
+
+    def report_progress(done, total):
+        send_to_list(bot, SUDO_USERS + SUPPORT_USERS, "gban of {}: {}/{} chats done.".format(user_id, done, total))
+
+    chat_ids = sql.get_gban_chat_ids()
+    succeeded, failed = fan_out(gban_chat, chat_ids, workers=GBAN_WORKERS, progress=report_progress)
+
+    send_to_list(bot, SUDO_USERS + SUPPORT_USERS, "gban complete! " + summarise_fan_out(succeeded, failed))
     message.reply_text("Person has been gbanned.")
 
 
-@run_async
+@run_in_lane(BULK_LANE)
 def ungban(bot: Bot, update: Update, args: List[str]):
     message = update.effective_message  # type: Optional[Message]
 
@@ -121,46 +126,22 @@ def ungban(bot: Bot, update: Update, args: List[str]):
 
     sql.ungban_user(user_id)
 
-    chats = get_all_chats()
-    for chat in chats:
-        chat_id = chat.chat_id
-
-        # Check if this group has disabled gbans
-        if not sql.does_chat_gban(chat_id):
-            continue
-
+    def ungban_chat(chat_id):
         try:
             member = bot.get_chat_member(chat_id, user_id)
-            from tg_bot import LOGGER
-
-            LOGGER.info(f"{member.status}")
             if member.status == 'kicked':
                 bot.unban_chat_member(chat_id, user_id)
-
         except BadRequest as excp:
-            from tg_bot import LOGGER
-
-            LOGGER.exception("WTH IS THIS '{}'".format(excp.message))
-            if excp.message == "User is an administrator of the chat":
-                pass
-            elif excp.message == "Chat not found":
-                pass
-            elif excp.message == "Not enough rights to restrict/unrestrict chat member":
-                pass
-            elif excp.message == "User_not_participant":
-                pass
-            elif excp.message == "Method is available for supergroup and channel chats only":
-                pass
-            elif excp.message == "Not in the chat":
-                pass
-            else:
-                message.reply_text("Could not un-gban due to: {}".format(excp.message))
-                bot.send_message(OWNER_ID, "Could not un-gban due to: {}".format(excp.message))
-                return
-        except TelegramError:
-            pass
-
-    send_to_list(bot, SUDO_USERS + SUPPORT_USERS, "un-gban complete!")
+            if excp.message not in UNGBAN_ERRORS:
+                raise
+
+    def report_progress(done, total):
+        send_to_list(bot, SUDO_USERS + SUPPORT_USERS, "un-gban of {}: {}/{} chats done.".format(user_id, done, total))
+
+    chat_ids = sql.get_gban_chat_ids()
+    succeeded, failed = fan_out(ungban_chat, chat_ids, workers=GBAN_WORKERS, progress=report_progress)
+
+    send_to_list(bot, SUDO_USERS + SUPPORT_USERS, "un-gban complete! " + summarise_fan_out(succeeded, failed))
 
     message.reply_text("Person has been un-gbanned.")
 
@@ -191,15 +172,25 @@ def check_and_ban(update, user_id):
         update.effective_message.reply_text("This is a bad person, they shouldn't be here!")
 
 
-@run_async
+@run_in_lane(MODERATION_LANE)
 def enforce_gban(bot: Bot, update: Update):
-    # Not using @restrict handler to avoid spamming - just ignore if cant gban.
-    if sql.does_chat_gban(update.effective_chat.id) and update.effective_chat.get_member(bot.id).can_restrict_members:
-        user = update.effective_user  # type: Optional[User]
-        chat = update.effective_chat  # type: Optional[Chat]
-        msg = update.effective_message  # type: Optional[Message]
+    user = update.effective_user  # type: Optional[User]
+    chat = update.effective_chat  # type: Optional[Chat]
+    msg = update.effective_message  # type: Optional[Message]
+
+    # Almost nobody is gbanned - check that first, so normal messages don't cost any db or API calls.
+    to_check = [user] if user else []
+    to_check.extend(msg.new_chat_members or [])
+    if msg.reply_to_message and msg.reply_to_message.from_user:
+        to_check.append(msg.reply_to_message.from_user)
+
+    if not any(sql.is_user_gbanned(checked.id) for checked in to_check):
+        return
 
-        if user and not is_user_admin(chat, user.id):
+    # Not using @restrict handler to avoid spamming - just ignore if cant gban.
+    context = get_context(update)
+    if sql.does_chat_gban(chat.id) and context.bot_member.can_restrict_members:
+        if user and not context.is_admin(user.id):
             check_and_ban(update, user.id)
 
         if msg.new_chat_members:
@@ -209,7 +200,7 @@ def enforce_gban(bot: Bot, update: Update):
 
         if msg.reply_to_message:
             user = msg.reply_to_message.from_user  # type: Optional[User]
-            if user and not is_user_admin(chat, user.id):
+            if user and not context.is_admin(user.id):
                 check_and_ban(update, user.id)
 
 
@@ -271,6 +262,8 @@ you and your groups by removing spam flooders as quickly as possible. They can b
 
 __mod_name__ = "Global Bans"
 
+__fusable_groups__ = [GBAN_ENFORCE_GROUP]
+
 GBAN_HANDLER = CommandHandler("gban", gban, pass_args=True,
                               filters=CustomFilters.sudo_filter | CustomFilters.support_filter)
 UNGBAN_HANDLER = CommandHandler("ungban", ungban, pass_args=True,
@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class TTLCache(object):
+    """
+    Small thread safe LRU cache, where entries can also expire after a set amount of time.
+
+    Used to keep short lived copies of data which is expensive to fetch (telegram API calls, db queries) without
+    letting memory grow forever.
+    """
+
+    def __init__(self, maxsize: int, ttl: float = None):
+        """
+        :param maxsize: maximum number of entries to keep; the least recently used entry is dropped first
+        :param ttl: number of seconds an entry is valid for, or None to keep entries until they are evicted
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires < monotonic():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._data.pop(key, None)
+        return value[0] if value is not None else default
+
+    def pop_matching(self, predicate):
+        """
+        Remove all entries whose key satisfies the predicate.
+
+        :param predicate: function called with each key
+        :return: number of removed entries
+        """
+        with self._lock:
+            to_remove = [key for key in self._data if predicate(key)]
+            for key in to_remove:
+                del self._data[key]
+        return len(to_remove)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return len(self._data)
+
+
+_MISSING = object()
@@ -1,13 +1,110 @@
+import threading
 from functools import wraps
-from typing import Optional
+from time import monotonic
+from typing import Optional, Dict
 
 from telegram import User, Chat, ChatMember, Update, Bot
+from telegram.error import TelegramError
+
+from tg_bot import DEL_CMDS, SUDO_USERS, WHITELIST_USERS, LOGGER
+from tg_bot.modules.helper_funcs.cache import TTLCache
+from tg_bot.modules.helper_funcs.lanes import BULK_LANE
+
+# (chat_id, user_id) -> ChatMember. A single message can go through several handler groups which all check the
+# same member statuses; keep them around for a short while so we don't ask telegram every time.
+MEMBER_CACHE_TTL = 60  # seconds
+MEMBER_CACHE = TTLCache(maxsize=20000, ttl=MEMBER_CACHE_TTL)
+
+# chat_id -> (user_id -> ChatMember for every admin, time fetched). Admin checks are set lookups against this,
+# and the admin module refreshes the rosters of recently active chats in the background. A roster can be a few minutes
+# out of date (eg when someone is demoted from the telegram client), so it's only trusted for deciding who moderation
+# leaves alone; commands only admins may use check with telegram first (see confirm_user_admin).
+ADMIN_REFRESH_INTERVAL = 5 * 60  # seconds
+ADMIN_ROSTER_MAX_AGE = 2 * ADMIN_REFRESH_INTERVAL  # refetch on use if the background refresh isn't running
+ADMIN_ROSTERS = {}
+# chat_id -> last time the roster was used; rosters which haven't been used since the last refresh are dropped
+ADMIN_ROSTER_USED = {}
+ADMIN_ROSTERS_LOCK = threading.Lock()  # for both of the above; never held during an API call
+
+
+def refresh_admin_roster(bot: Bot, chat_id) -> Dict[int, ChatMember]:
+    admins = {admin.user.id: admin for admin in bot.get_chat_administrators(chat_id)}
+    with ADMIN_ROSTERS_LOCK:
+        ADMIN_ROSTERS[int(chat_id)] = (admins, monotonic())
+    return admins
+
+
+def invalidate_admin_roster(chat_id) -> None:
+    with ADMIN_ROSTERS_LOCK:
+        ADMIN_ROSTERS.pop(int(chat_id), None)
+        ADMIN_ROSTER_USED.pop(int(chat_id), None)
+
+
+def get_admin_roster(chat: Chat) -> Dict[int, ChatMember]:
+    with ADMIN_ROSTERS_LOCK:
+        ADMIN_ROSTER_USED[chat.id] = monotonic()
+        roster = ADMIN_ROSTERS.get(chat.id)
+    if roster is None or monotonic() - roster[1] > ADMIN_ROSTER_MAX_AGE:
+        return refresh_admin_roster(chat.bot, chat.id)
+    return roster[0]
+
+
+def refresh_admin_rosters(bot: Bot, job=None) -> None:
+    """
+    Job queue callback: refetch the admin list of every chat whose roster was used since the last run, and forget
+    the rest. That's one API call per chat, so it's done on the bulk lane rather than holding up the job queue.
+    """
+    if BULK_LANE.submit(__refresh_admin_rosters, bot) is None:
+        # the rosters are refetched on use once they get too old anyway
+        LOGGER.warning("The bulk lane is full, skipping this round of admin roster refreshes")
+
+
+def __refresh_admin_rosters(bot: Bot) -> None:
+    cutoff = monotonic() - ADMIN_REFRESH_INTERVAL
+    with ADMIN_ROSTERS_LOCK:
+        last_used = list(ADMIN_ROSTER_USED.items())
+
+    for chat_id, used in last_used:
+        if used < cutoff:
+            invalidate_admin_roster(chat_id)
+            continue
+
+        try:
+            refresh_admin_roster(bot, chat_id)
+        except TelegramError:
+            # kicked, chat deleted, etc - it'll get fetched again if it's ever needed.
+            invalidate_admin_roster(chat_id)
+
+
+def get_member(chat: Chat, user_id: int) -> ChatMember:
+    with ADMIN_ROSTERS_LOCK:
+        roster = ADMIN_ROSTERS.get(chat.id)
+    if roster is not None and user_id in roster[0]:
+        return roster[0][user_id]
+
+    key = (chat.id, user_id)
+    member = MEMBER_CACHE.get(key)
+    if member is None:
+        member = chat.get_member(user_id)
+        MEMBER_CACHE.set(key, member)
+    return member
+
 
-from tg_bot import DEL_CMDS, SUDO_USERS, WHITELIST_USERS
+def invalidate_member(chat_id, user_id: int = None) -> None:
+    """
+    Drop cached member statuses, eg after a promotion or when someone joins/leaves.
+
+    :param chat_id: chat to invalidate
+    :param user_id: user to invalidate; if None, all cached members of the chat are dropped
+    """
+    if user_id is None:
+        MEMBER_CACHE.pop_matching(lambda key: key[0] == int(chat_id))
+    else:
+        MEMBER_CACHE.pop((int(chat_id), int(user_id)))
 
 
 def can_delete(chat: Chat, bot_id: int) -> bool:
-    return chat.get_member(bot_id).can_delete_messages
+    return get_member(chat, bot_id).can_delete_messages
 
 
 def is_user_ban_protected(chat: Chat, user_id: int, member: ChatMember=None) -> bool:
@@ -17,9 +114,9 @@ def is_user_ban_protected(chat: Chat, user_id: int, member: ChatMember=None) ->
             or chat.all_members_are_administrators:
         return True
 
-    if not member:
-        member = chat.get_member(user_id)
-    return member.status in ('administrator', 'creator')
+    if member:
+        return member.status in ('administrator', 'creator')
+    return user_id in get_admin_roster(chat)
 
 
 def is_user_admin(chat: Chat, user_id: int, member: ChatMember=None) -> bool:
@@ -28,9 +125,29 @@ def is_user_admin(chat: Chat, user_id: int, member: ChatMember=None) -> bool:
             or chat.all_members_are_administrators:
         return True
 
-    if not member:
-        member = chat.get_member(user_id)
-    return member.status in ('administrator', 'creator')
+    if member:
+        return member.status in ('administrator', 'creator')
+    return user_id in get_admin_roster(chat)
+
+
+def confirm_user_admin(chat: Chat, user_id: int) -> bool:
+    """
+    Same as is_user_admin, but asks telegram rather than trusting the roster, for letting someone do something only
+    admins may (ban, warn, change settings...). If the roster turns out to be wrong, it's dropped.
+    """
+    if chat.type == 'private' \
+            or user_id in SUDO_USERS \
+            or chat.all_members_are_administrators:
+        return True
+
+    member = chat.get_member(user_id)
+    MEMBER_CACHE.set((chat.id, user_id), member)
+    is_admin = member.status in ('administrator', 'creator')
+    with ADMIN_ROSTERS_LOCK:
+        roster = ADMIN_ROSTERS.get(chat.id)
+    if roster is not None and (user_id in roster[0]) != is_admin:
+        invalidate_admin_roster(chat.id)
+    return is_admin
 
 
 def is_bot_admin(chat: Chat, bot_id: int) -> bool:
@@ -38,8 +155,7 @@ def is_bot_admin(chat: Chat, bot_id: int) -> bool:
             or chat.all_members_are_administrators:
         return True
 
-    bot_member = chat.get_member(bot_id)
-    return bot_member.status in ('administrator', 'creator')
+    return bot_id in get_admin_roster(chat)
 
 
 def is_user_in_chat(chat: Chat, user_id: int) -> bool:
@@ -50,7 +166,7 @@ def is_user_in_chat(chat: Chat, user_id: int) -> bool:
 def bot_can_delete(func):
     @wraps(func)
     def delete_rights(bot: Bot, update: Update, *args, **kwargs):
-        if update.effective_chat.get_member(bot.id).can_delete_messages:
+        if get_member(update.effective_chat, bot.id).can_delete_messages:
             return func(bot, update, *args, **kwargs)
         else:
             update.effective_message.reply_text("I can't delete messages here! "
@@ -62,7 +178,7 @@ def bot_can_delete(func):
 def can_pin(func):
     @wraps(func)
     def pin_rights(bot: Bot, update: Update, *args, **kwargs):
-        if update.effective_chat.get_member(bot.id).can_pin_messages:
+        if get_member(update.effective_chat, bot.id).can_pin_messages:
             return func(bot, update, *args, **kwargs)
         else:
             update.effective_message.reply_text("I can't pin messages here! "
@@ -74,7 +190,7 @@ def can_pin(func):
 def can_promote(func):
     @wraps(func)
     def promote_rights(bot: Bot, update: Update, *args, **kwargs):
-        if update.effective_chat.get_member(bot.id).can_promote_members:
+        if get_member(update.effective_chat, bot.id).can_promote_members:
             return func(bot, update, *args, **kwargs)
         else:
             update.effective_message.reply_text("I can't promote/demote people here! "
@@ -86,7 +202,7 @@ def can_promote(func):
 def can_restrict(func):
     @wraps(func)
     def promote_rights(bot: Bot, update: Update, *args, **kwargs):
-        if update.effective_chat.get_member(bot.id).can_restrict_members:
+        if get_member(update.effective_chat, bot.id).can_restrict_members:
             return func(bot, update, *args, **kwargs)
         else:
             update.effective_message.reply_text("I can't restrict people here! "
@@ -110,7 +226,7 @@ def user_admin(func):
     @wraps(func)
     def is_admin(bot: Bot, update: Update, *args, **kwargs):
         user = update.effective_user  # type: Optional[User]
-        if user and is_user_admin(update.effective_chat, user.id):
+        if user and confirm_user_admin(update.effective_chat, user.id):
             return func(bot, update, *args, **kwargs)
 
         elif not user:
@@ -129,7 +245,7 @@ def user_admin_no_reply(func):
     @wraps(func)
     def is_admin(bot: Bot, update: Update, *args, **kwargs):
         user = update.effective_user  # type: Optional[User]
-        if user and is_user_admin(update.effective_chat, user.id):
+        if user and confirm_user_admin(update.effective_chat, user.id):
             return func(bot, update, *args, **kwargs)
 
         elif not user:
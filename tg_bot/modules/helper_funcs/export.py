@@ -0,0 +1,82 @@
+import csv
+import gzip
+import json
+from tempfile import SpooledTemporaryFile
+from typing import Iterable, List, Tuple, IO
+
+EXPORT_FORMATS = ("txt", "csv", "json")
+COMPRESS_ARG = "gz"
+# exports are kept in memory up to this size, and spill over to a temporary file after that
+SPOOL_SIZE = 5 * 1024 * 1024
+
+
+class Utf8Writer(object):
+    """
+    Minimal text stream which encodes everything written to it onto a binary one, eg for csv.writer.
+    """
+
+    def __init__(self, raw: IO[bytes]):
+        self.raw = raw
+
+    def write(self, text: str) -> None:
+        self.raw.write(text.encode("utf-8"))
+
+
+def parse_export_args(args: List[str]) -> Tuple[List[str], str, bool]:
+    """
+    Pick the export options out of a command's args.
+
+    :return: the remaining args, the chosen format (txt by default), and whether to gzip
+    """
+    rest = []
+    export_format = "txt"
+    compress = False
+    for arg in args or []:
+        if arg.lower() in EXPORT_FORMATS:
+            export_format = arg.lower()
+        elif arg.lower() == COMPRESS_ARG:
+            compress = True
+        else:
+            rest.append(arg)
+    return rest, export_format, compress
+
+
+def export_rows(rows: Iterable[tuple], fields: Tuple[str, ...], export_format: str = "txt",
+                compress: bool = False) -> IO[bytes]:
+    """
+    Write rows out one at a time, so that exports are never built up as one huge string.
+
+    :param rows: tuples of values, in the same order as fields
+    :param fields: field names, for the csv header and json keys
+    :param export_format: one of EXPORT_FORMATS; txt puts each row on its own line, separated by " - "
+    :param compress: whether to gzip the output
+    :return: the export, ready to be read from the start
+    """
+    output = SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    raw = gzip.GzipFile(fileobj=output, mode="wb") if compress else output
+    writer = Utf8Writer(raw)
+
+    if export_format == "csv":
+        csv_writer = csv.writer(writer)
+        csv_writer.writerow(fields)
+        for row in rows:
+            csv_writer.writerow(row)
+
+    elif export_format == "json":
+        writer.write("[")
+        for index, row in enumerate(rows):
+            writer.write(("," if index else "") + "\n" + json.dumps(dict(zip(fields, row))))
+        writer.write("\n]\n")
+
+    else:
+        for row in rows:
+            writer.write(" - ".join(str(value) for value in row) + "\n")
+
+    if compress:
+        raw.close()  # writes the gzip trailer, without closing output
+    output.seek(0)
+    return output
+
+
+def export_filename(name: str, export_format: str, compress: bool) -> str:
+    return "{}.{}{}".format(name, export_format, "." + COMPRESS_ARG if compress else "")
@@ -4,9 +4,35 @@ from telegram import Message, MessageEntity
 from telegram.error import BadRequest
 
 from tg_bot import LOGGER
+from tg_bot.modules.sql import users_sql
 from tg_bot.modules.users import get_user_id
 
 
+def check_user(message: Message, user_id: int) -> bool:
+    """
+    Make sure the bot can act on a user, telling the sender if not. Telegram only has to be asked about users the bot
+    hasn't seen recently.
+    """
+    if users_sql.is_known_user(user_id):
+        users_sql.count_saved_lookup()
+        return True
+
+    try:
+        message.bot.get_chat(user_id)
+    except BadRequest as excp:
+        if excp.message in ("User_id_invalid", "Chat not found"):
+            message.reply_text("I don't seem to have interacted with this user before - please forward a message from "
+                               "them to give me control! (like a voodoo doll, I need a piece of them to be able "
+                               "to execute certain commands...)")
+        else:
+            LOGGER.exception("Exception %s on user %s", excp.message, user_id)
+
+        return False
+
+    users_sql.mark_known_user(user_id)
+    return True
+
+
 def extract_user(message: Message, args: List[str]) -> Optional[int]:
     prev_message = message.reply_to_message
 
@@ -14,6 +40,7 @@ def extract_user(message: Message, args: List[str]) -> Optional[int]:
         entities = list(message.parse_entities([MessageEntity.TEXT_MENTION]))
         ent = entities[0]
         user_id = ent.user.id
+        users_sql.mark_known_user(user_id)
 
     elif len(args) >= 1 and args[0][0] == '@':
         user = args[0]
@@ -30,20 +57,12 @@ def extract_user(message: Message, args: List[str]) -> Optional[int]:
 
     elif prev_message:
         user_id = prev_message.from_user.id
+        users_sql.mark_known_user(user_id)
 
     else:
         return None
 
-    try:
-        message.bot.get_chat(user_id)
-    except BadRequest as excp:
-        if excp.message in ("User_id_invalid", "Chat not found"):
-            message.reply_text("I don't seem to have interacted with this user before - please forward a message from "
-                               "them to give me control! (like a voodoo doll, I need a piece of them to be able "
-                               "to execute certain commands...)")
-        else:
-            LOGGER.exception("Exception %s on user %s", excp.message, user_id)
-
+    if not check_user(message, user_id):
         return
 
     return user_id
@@ -58,6 +77,7 @@ def extract_user_and_text(message: Message, args: List[str]) -> (Optional[int],
         entities = list(message.parse_entities([MessageEntity.TEXT_MENTION]))
         ent = entities[0]
         user_id = ent.user.id
+        users_sql.mark_known_user(user_id)
         text = message.text[ent.offset + ent.length:]
 
     elif len(args) >= 1 and args[0][0] == '@':
@@ -82,6 +102,7 @@ def extract_user_and_text(message: Message, args: List[str]) -> (Optional[int],
 
     elif prev_message:
         user_id = prev_message.from_user.id
+        users_sql.mark_known_user(user_id)
         res = message.text.split(None, 1)
         if len(res) >= 2:
             text = res[1]
@@ -89,16 +110,7 @@ def extract_user_and_text(message: Message, args: List[str]) -> (Optional[int],
     else:
         return None, None
 
-    try:
-        message.bot.get_chat(user_id)
-    except BadRequest as excp:
-        if excp.message in ("User_id_invalid", "Chat not found"):
-            message.reply_text("I don't seem to have interacted with this user before - please forward a message from "
-                               "them to give me control! (like a voodoo doll, I need a piece of them to be able "
-                               "to execute certain commands...)")
-        else:
-            LOGGER.exception("Exception %s on user %s", excp.message, user_id)
-
+    if not check_user(message, user_id):
         return None, None
 
     return user_id, text
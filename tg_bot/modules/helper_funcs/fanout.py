@@ -0,0 +1,73 @@
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import sleep
+from typing import Callable, Iterable, List, Tuple
+
+from telegram.error import RetryAfter
+
+from tg_bot.modules.helper_funcs.outbound import TokenBucket, get_priority, priority
+
+
+def fan_out(func: Callable, items: Iterable, workers: int = 8, limiter: TokenBucket = None, max_retries: int = 3,
+            progress: Callable[[int, int], None] = None, progress_interval: float = 30) -> Tuple[int, List[Tuple]]:
+    """
+    Call func on every item from a bounded pool of threads, and wait for all of them to finish.
+
+    :param func: function to call with each item; anything it raises counts as a failure
+    :param items: items to call func on
+    :param workers: maximum number of concurrent calls
+    :param limiter: if given, a token is taken from it before every call (including retries)
+    :param max_retries: number of times a call is retried after telegram replies with RetryAfter
+    :param progress: if given, called with (number of finished items, total number of items) every
+        progress_interval seconds while items are still pending
+    :param progress_interval: number of seconds between progress calls
+    :return: the number of successful calls, and a list of (item, exception) for every failed one
+    """
+    # API calls made by the pool's threads get the same priority as the caller's
+    level = get_priority()
+
+    def call(item):
+        for attempt in range(max_retries + 1):
+            if limiter:
+                limiter.consume()
+            try:
+                with priority(level):
+                    return func(item)
+            except RetryAfter as excp:
+                if attempt == max_retries:
+                    raise
+                if limiter:
+                    limiter.pause(excp.retry_after)
+                else:
+                    sleep(excp.retry_after)
+
+    items = list(items)
+    succeeded = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(call, item): item for item in items}
+        while pending:
+            done, _ = wait(list(pending), timeout=progress_interval)
+            for future in done:
+                item = pending.pop(future)
+                excp = future.exception()
+                if excp:
+                    failed.append((item, excp))
+                else:
+                    succeeded += 1
+
+            if progress and pending:
+                progress(len(items) - len(pending), len(items))
+
+    return succeeded, failed
+
+
+def summarise_fan_out(succeeded: int, failed: List[Tuple]) -> str:
+    """
+    :return: a short human readable summary of a fan_out result, with the most common failure reasons
+    """
+    summary = "{} succeeded, {} failed.".format(succeeded, len(failed))
+    reasons = Counter(getattr(excp, "message", None) or repr(excp) for _, excp in failed)
+    for reason, count in reasons.most_common(5):
+        summary += "\n{}x: {}".format(count, reason)
+    return summary
@@ -0,0 +1,167 @@
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from queue import Queue, Full
+from typing import Optional, Callable
+
+from telegram import Update, TelegramError
+from telegram.ext.commandhandler import CommandHandler
+from telegram.utils.promise import Promise
+
+from tg_bot import dispatcher, LOGGER, WORKERS, COMMAND_QUEUE_SIZE, MODERATION_WORKERS, MODERATION_QUEUE_SIZE, \
+    BULK_WORKERS, BULK_QUEUE_SIZE
+from tg_bot.modules.helper_funcs.cache import TTLCache
+from tg_bot.modules.helper_funcs.outbound import set_priority, PRIORITY_MODERATION, PRIORITY_COMMAND, PRIORITY_BULK
+
+# Set while a thread wants everything it would queue to run right there instead, eg in the fused pipeline.
+RUN_INLINE = threading.local()
+
+# Called, in the thread which did the work, after every job a lane runs, every update the dispatcher processes, and
+# every job queue callback decorated with @cleans_up; eg the sql package releases the thread's db session.
+CLEANUP_HOOKS = []
+
+# chat_id -> True, for chats recently told that their command was dropped. The reply is sent from the dispatcher
+# thread, which is the last thing to slow down when the bot is already overloaded; once a minute is plenty.
+OVERLOAD_REPLIED = TTLCache(maxsize=1000, ttl=60)
+
+
+class Lane(object):
+    """
+    A pool of worker threads with its own queue, so that a backlog of one kind of work can't hold up the others.
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int = 0, priority: int = PRIORITY_COMMAND):
+        """
+        :param name: used for the thread names and in logs
+        :param workers: number of threads
+        :param queue_size: maximum number of jobs waiting to run; once full, new jobs are dropped. 0 means no limit
+        :param priority: outbound priority of the API calls made by the lane's jobs
+        """
+        self.name = name
+        self.priority = priority
+        self._queue = Queue(maxsize=queue_size)
+        self._threads = [threading.Thread(target=self._pooled, name="{}_lane_{}".format(name, i), daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _pooled(self):
+        set_priority(self.priority)
+        while True:
+            self.run(self._queue.get())
+
+    def run(self, promise: Promise):
+        try:
+            promise.run()
+        finally:
+            run_cleanup_hooks()
+
+    def submit(self, func, *args, **kwargs) -> Optional[Promise]:
+        """
+        Queue func(*args, **kwargs) to run on this lane.
+
+        :return: the job's promise, or None if the queue was full and the job was dropped. When running inline, the
+            result of the call itself; anything it raises is passed on to the caller
+        """
+        if getattr(RUN_INLINE, "active", False):
+            return func(*args, **kwargs)
+
+        promise = Promise(func, args, kwargs)
+        try:
+            self._queue.put_nowait(promise)
+        except Full:
+            LOGGER.warning("The %s lane is full, dropping a call to %s", self.name, getattr(func, "__name__", func))
+            return None
+        return promise
+
+    def submit_handler(self, func, *args, **kwargs) -> Optional[Promise]:
+        """
+        Same as submit, for handler callbacks: if a command is dropped, tell the user rather than ignoring it. Anything
+        else (eg the hooks which look at every message) is dropped quietly.
+        """
+        promise = self.submit(func, *args, **kwargs)
+        if promise is None and started_by_command(func):
+            update = next((arg for arg in args if isinstance(arg, Update)), None)
+            if update and update.effective_message and update.effective_chat.id not in OVERLOAD_REPLIED:
+                OVERLOAD_REPLIED.set(update.effective_chat.id, True)
+                try:
+                    update.effective_message.reply_text("I'm a bit overloaded right now - try again in a minute!")
+                except TelegramError:
+                    pass
+        return promise
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+
+def add_cleanup_hook(hook: Callable[[], None]) -> None:
+    CLEANUP_HOOKS.append(hook)
+
+
+def run_cleanup_hooks() -> None:
+    for hook in CLEANUP_HOOKS:
+        try:
+            hook()
+        except Exception:
+            LOGGER.exception("Error running cleanup hook %s", hook)
+
+
+def cleans_up(func):
+    """
+    Run the cleanup hooks once func returns, for work which doesn't run on a lane, eg job queue callbacks.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            run_cleanup_hooks()
+
+    return wrapper
+
+
+def started_by_command(func) -> bool:
+    """
+    :return: whether func is the callback of a CommandHandler, under its @run_async or @run_in_lane. Only looked up
+        once a job has been dropped, so it's fine that this goes through every handler.
+    """
+    return any(isinstance(handler, CommandHandler) and getattr(handler.callback, "__wrapped__", None) is func
+               for handlers in dispatcher.handlers.values() for handler in handlers)
+
+
+@contextmanager
+def run_inline():
+    """
+    Run any jobs queued by the current thread immediately, in this thread, until the block exits.
+    """
+    previous = getattr(RUN_INLINE, "active", False)
+    RUN_INLINE.active = True
+    try:
+        yield
+    finally:
+        RUN_INLINE.active = previous
+
+
+def run_in_lane(lane: Lane):
+    """
+    Like @run_async, but runs the decorated handler on the given lane.
+    """
+    def decorator(func):
+        @wraps(func)
+        def queue_func(*args, **kwargs):
+            return lane.submit_handler(func, *args, **kwargs)
+
+        return queue_func
+
+    return decorator
+
+
+# Enforcement which has to keep up with every group message: locks, antiflood, gbans.
+MODERATION_LANE = Lane("moderation", MODERATION_WORKERS, MODERATION_QUEUE_SIZE, PRIORITY_MODERATION)
+# Everything else decorated with @run_async; mostly commands.
+COMMAND_LANE = Lane("command", WORKERS, COMMAND_QUEUE_SIZE)
+# Long running jobs which message many chats: broadcasts, gban fan out, banall.
+BULK_LANE = Lane("bulk", BULK_WORKERS, BULK_QUEUE_SIZE, PRIORITY_BULK)
+
+# @run_async goes through dispatcher.run_async
+dispatcher.run_async = COMMAND_LANE.submit_handler
@@ -0,0 +1,352 @@
+import heapq
+import inspect
+import itertools
+import threading
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from time import monotonic, sleep
+
+from telegram.error import RetryAfter, TimedOut
+
+from tg_bot import dispatcher, LOGGER
+from tg_bot.modules.helper_funcs.cache import TTLCache
+
+# Telegram allows bots ~30 messages per second overall, and ~20 messages per minute in any one group.
+GLOBAL_RATE = 30  # per second
+GROUP_RATE = 20 / 60  # per second
+MAX_RETRIES = 3  # times a call is retried after telegram replies with RetryAfter
+# seconds a (non bulk) caller waits for a send parked behind its chat's limit before giving up on it
+DEFERRED_TIMEOUT = 10
+
+# Lower values go first when calls are waiting for the global limit.
+PRIORITY_MODERATION = 0
+PRIORITY_COMMAND = 1
+PRIORITY_BULK = 2
+
+# API calls which post to a chat, and so count against that chat's limit as well as the global one.
+CHAT_METHODS = ["send_message", "forward_message", "send_photo", "send_audio", "send_document", "send_sticker",
+                "send_video", "send_voice", "send_video_note", "send_animation", "send_location", "send_venue",
+                "send_contact", "send_game", "send_media_group"]
+# Other API calls which change something, and only count against the global limit. Reads (get_chat, etc) aren't
+# limited.
+GLOBAL_METHODS = ["edit_message_text", "edit_message_caption", "edit_message_reply_markup", "delete_message",
+                  "kick_chat_member", "unban_chat_member", "restrict_chat_member", "promote_chat_member",
+                  "pin_chat_message", "unpin_chat_message", "leave_chat", "answer_callback_query"]
+
+__priority = threading.local()
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket, used to keep bursts of API calls under telegram's flood limits.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: number of tokens added per second
+        :param capacity: maximum number of tokens which can be saved up for a burst; defaults to one second's worth
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    def try_consume(self, tokens: float = 1) -> float:
+        """
+        Take tokens if enough are available, without waiting.
+
+        :return: 0 if the tokens were taken, otherwise the number of seconds until they will be available
+        """
+        with self._lock:
+            now = monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+    def consume(self, tokens: float = 1) -> None:
+        """
+        Block until enough tokens are available, then take them.
+        """
+        while True:
+            wait_for = self.try_consume(tokens)
+            if not wait_for:
+                return
+            sleep(wait_for)
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stop handing out tokens for a while, eg when telegram asks us to back off.
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, monotonic() + seconds)
+            self._tokens = 0
+            self._updated = self._paused_until
+
+
+def get_priority() -> int:
+    return getattr(__priority, "level", PRIORITY_COMMAND)
+
+
+def set_priority(level: int) -> None:
+    """
+    Set the priority of all API calls made from the current thread, eg by a lane's worker threads.
+    """
+    __priority.level = level
+
+
+@contextmanager
+def priority(level: int):
+    previous = get_priority()
+    set_priority(level)
+    try:
+        yield
+    finally:
+        set_priority(previous)
+
+
+class DeferredCall(object):
+    """
+    An API call parked until its chat's limit allows it, along with its outcome once the sender thread has made it.
+    """
+
+    def __init__(self, method, args, kwargs, level: int):
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.level = level
+        self.attempts = 0
+        self.started = False  # set once the sender thread has taken it off the chat's queue
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+
+class OutboundQueue(object):
+    """
+    Gate for every outgoing API call which counts against telegram's flood limits. Callers queue up in priority order
+    for a token from the global bucket; so a broadcast can use whatever the rest of the bot doesn't need, and
+    moderation actions never wait behind it.
+
+    Sends to a group which has used up its own (much lower) limit don't hold a token while they wait: they're parked
+    in that chat's deferred queue, which a sender thread drains in order as the chat's bucket refills. The caller
+    only waits for its own send, and gives up on it after DEFERRED_TIMEOUT, so a busy group can't tie up the workers
+    every other chat needs for long.
+    """
+
+    def __init__(self, global_rate: float, group_rate: float):
+        self.global_bucket = TokenBucket(global_rate)
+        self.group_rate = group_rate
+        # buckets for chats which haven't sent anything for a minute are full again anyway, so can be dropped
+        self._chat_buckets = TTLCache(maxsize=10000, ttl=60)
+        self._chat_buckets_lock = threading.Lock()
+        self._waiting = []  # heap of (priority, arrival) of callers waiting for a global token
+        self._arrivals = itertools.count()
+        self._cond = threading.Condition()
+        self._deferred = {}  # chat_id -> deque of DeferredCall, for chats with parked sends
+        self._ready = []  # heap of (time, chat_id) at which the sender should next try each chat in _deferred
+        self._deferred_cond = threading.Condition()
+        self._sender = None
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        with self._chat_buckets_lock:
+            bucket = self._chat_buckets.get(chat_id)
+            if bucket is None:
+                # allow a burst of a minute's worth of messages, eg a command reply right after a quiet period
+                bucket = TokenBucket(self.group_rate, capacity=self.group_rate * 60)
+            self._chat_buckets.set(chat_id, bucket)
+            return bucket
+
+    def acquire(self, level: int) -> None:
+        entry = (level, next(self._arrivals))
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            while self._waiting[0] != entry:
+                self._cond.wait()
+
+        try:
+            self.global_bucket.consume()
+        finally:
+            with self._cond:
+                heapq.heappop(self._waiting)
+                self._cond.notify_all()
+
+    def call(self, method, args, kwargs, chat_id=None, per_chat: bool = False):
+        """
+        Make an API call once the rate limits allow it, retrying after as long as telegram asks if it says to slow
+        down.
+
+        :param method: bot method to call
+        :param chat_id: the chat the call is about, if any
+        :param per_chat: whether the call also counts against the limit of its chat (only groups are limited)
+        :return: the call's result
+        :raises TimedOut: if the call was deferred until its chat's limit allows it, and that didn't happen in time
+        """
+        group_id = int(chat_id) if per_chat and str(chat_id).startswith("-") else None
+        for attempt in range(MAX_RETRIES + 1):
+            if group_id is not None:
+                deferred = self.defer_if_limited(group_id, method, args, kwargs, attempts=attempt)
+                if deferred is not None:
+                    return self.wait_for(group_id, deferred)
+
+            self.acquire(get_priority())
+            try:
+                return method(*args, **kwargs)
+            except RetryAfter as excp:
+                if attempt == MAX_RETRIES:
+                    raise
+                self.back_off(method, chat_id, group_id, excp.retry_after)
+
+    def back_off(self, method, chat_id, group_id, retry_after: float) -> None:
+        """
+        Hold back whatever telegram told to slow down: only the one chat's sends if it was a send to a group, so that
+        a single flooded group doesn't stop moderation everywhere else.
+        """
+        if group_id is not None:
+            LOGGER.warning("Flood limit hit calling %s in %s, retrying in %ss", method.__name__, chat_id, retry_after)
+            # the retry finds the bucket empty, and gets deferred until it's allowed again
+            self.chat_bucket(group_id).pause(retry_after)
+        elif chat_id is not None:
+            LOGGER.warning("Flood limit hit calling %s in %s, retrying in %ss", method.__name__, chat_id, retry_after)
+            # deletes, kicks, etc aren't deferred; only the caller waits
+            sleep(retry_after)
+        else:
+            LOGGER.warning("Flood limit hit calling %s, retrying in %ss", method.__name__, retry_after)
+            self.global_bucket.pause(retry_after)
+
+    def wait_for(self, chat_id: int, deferred: DeferredCall):
+        """
+        Wait for the sender thread to make a deferred call. Bulk jobs have nothing more urgent to do, so wait as long as
+        it takes; anyone else withdraws the call if it hasn't been made within DEFERRED_TIMEOUT.
+
+        :return: the call's result
+        """
+        timeout = None if deferred.level >= PRIORITY_BULK else DEFERRED_TIMEOUT
+        if not deferred.done.wait(timeout):
+            with self._deferred_cond:
+                if not deferred.started:
+                    self._deferred[chat_id].remove(deferred)
+                    raise TimedOut()
+            # already on its way; won't be long
+            deferred.done.wait()
+
+        if deferred.exception is not None:
+            raise deferred.exception
+        return deferred.result
+
+    def defer_if_limited(self, chat_id: int, method, args, kwargs, attempts: int = 0):
+        """
+        Take a token from the chat's bucket if one is free and nothing is already parked for the chat (so sends stay
+        in order); otherwise park the call for the sender thread.
+
+        :return: the parked DeferredCall, or None if the call can go ahead now
+        """
+        with self._deferred_cond:
+            queued = self._deferred.get(chat_id)
+            if queued is None:
+                wait_for = self.chat_bucket(chat_id).try_consume()
+                if not wait_for:
+                    return None
+                queued = self._deferred[chat_id] = deque()
+                heapq.heappush(self._ready, (monotonic() + wait_for, chat_id))
+                self._ensure_sender()
+                self._deferred_cond.notify()
+
+            deferred = DeferredCall(method, args, kwargs, get_priority())
+            deferred.attempts = attempts
+            queued.append(deferred)
+            return deferred
+
+    def _ensure_sender(self):
+        if self._sender is None or not self._sender.is_alive():
+            self._sender = threading.Thread(target=self._send_deferred, name="outbound-sender", daemon=True)
+            self._sender.start()
+
+    def _send_deferred(self):
+        while True:
+            with self._deferred_cond:
+                while not self._ready or self._ready[0][0] > monotonic():
+                    self._deferred_cond.wait(self._ready[0][0] - monotonic() if self._ready else None)
+
+                _, chat_id = heapq.heappop(self._ready)
+                if not self._deferred[chat_id]:
+                    # everything parked for the chat was withdrawn by callers who gave up waiting
+                    del self._deferred[chat_id]
+                    continue
+
+                wait_for = self.chat_bucket(chat_id).try_consume()
+                if wait_for:
+                    heapq.heappush(self._ready, (monotonic() + wait_for, chat_id))
+                    continue
+                deferred = self._deferred[chat_id].popleft()
+                deferred.started = True
+
+            self._make_deferred_call(chat_id, deferred)
+
+            with self._deferred_cond:
+                if self._deferred[chat_id]:
+                    heapq.heappush(self._ready, (monotonic(), chat_id))
+                else:
+                    del self._deferred[chat_id]
+
+    def _make_deferred_call(self, chat_id: int, deferred: DeferredCall):
+        self.acquire(deferred.level)
+        try:
+            deferred.result = deferred.method(*deferred.args, **deferred.kwargs)
+        except RetryAfter as excp:
+            deferred.attempts += 1
+            if deferred.attempts <= MAX_RETRIES:
+                LOGGER.warning("Flood limit hit calling %s in %s, retrying in %ss", deferred.method.__name__, chat_id,
+                               excp.retry_after)
+                self.chat_bucket(chat_id).pause(excp.retry_after)
+                with self._deferred_cond:
+                    deferred.started = False
+                    self._deferred[chat_id].appendleft(deferred)
+                return
+            deferred.exception = excp
+        except Exception as excp:
+            deferred.exception = excp
+
+        deferred.done.set()
+
+
+OUTBOUND = OutboundQueue(GLOBAL_RATE, GROUP_RATE)
+
+
+def __queued(method, per_chat: bool):
+    # where chat_id goes when it's passed positionally, if the method takes one at all (eg answer_callback_query
+    # doesn't, and edit_message_text takes the text first)
+    params = list(inspect.signature(method).parameters)
+    chat_id_index = params.index("chat_id") if "chat_id" in params else None
+
+    @wraps(method)
+    def queued_method(*args, **kwargs):
+        chat_id = kwargs.get("chat_id")
+        if chat_id is None and chat_id_index is not None and len(args) > chat_id_index:
+            chat_id = args[chat_id_index]
+        return OUTBOUND.call(method, args, kwargs, chat_id=chat_id, per_chat=per_chat)
+
+    return queued_method
+
+
+def __queue_bot_methods(bot):
+    # patch the instance, so that the camelCase aliases and the Message/Chat shortcuts go through the queue too
+    for name in CHAT_METHODS + GLOBAL_METHODS:
+        method = getattr(bot, name, None)
+        if method is None:
+            continue
+        queued_method = __queued(method, per_chat=name in CHAT_METHODS)
+        setattr(bot, name, queued_method)
+        camel_name = name.split("_")[0] + "".join(part.capitalize() for part in name.split("_")[1:])
+        setattr(bot, camel_name, queued_method)
+
+
+__queue_bot_methods(dispatcher.bot)
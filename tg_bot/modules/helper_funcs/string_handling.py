@@ -1,5 +1,5 @@
 import re
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import emoji
 from telegram import MessageEntity
@@ -204,3 +204,41 @@ def escape_chars(text: str, to_escape: List[str]) -> str:
             new_text += "\\"
         new_text += x
     return new_text
+
+
+class KeywordMatcher(object):
+    """
+    Match a whole list of keywords against some text in a single regex pass.
+
+    Keywords are matched case insensitively, and only when they are not directly surrounded by word characters - the
+    same semantics as the old per-keyword regex search. Earlier keywords take precedence over later ones, no matter
+    where in the text they appear.
+    """
+
+    def __init__(self, keywords: List[str]):
+        self.keywords = list(keywords)
+        self.pattern = None
+        if self.keywords:
+            # one capture group per keyword, so the matching keyword can be recovered through lastindex. The whole
+            # thing sits in a lookahead so that overlapping keywords are all seen by finditer.
+            alternatives = "|".join("({})".format(re.escape(keyword)) for keyword in self.keywords)
+            self.pattern = re.compile(r"(?=(?<!\w)(?:" + alternatives + r")(?!\w))", flags=re.IGNORECASE)
+
+    def search(self, text: str) -> Optional[int]:
+        """
+        Find the highest priority keyword present in the text.
+
+        :param text: text to search
+        :return: index of the matched keyword in the keyword list, or None if nothing matched
+        """
+        if not self.pattern or not text:
+            return None
+
+        best = None
+        for match in self.pattern.finditer(text):
+            index = match.lastindex - 1
+            if best is None or index < best:
+                best = index
+                if best == 0:
+                    break
+        return best
@@ -0,0 +1,48 @@
+import threading
+from contextlib import contextmanager, ExitStack
+
+
+class StripedLock(object):
+    """
+    A fixed number of reentrant locks, picked by hashing a key (eg a chat id, or a (chat_id, user_id) tuple).
+
+    Writes for the same key are serialised, while writes for unrelated keys can run in parallel - unless they happen
+    to hash to the same stripe, which only costs a little waiting.
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    @staticmethod
+    def _normalise(key):
+        # chat ids get passed around as both ints and strings; make sure both pick the same lock.
+        if isinstance(key, tuple):
+            return tuple(str(part) for part in key)
+        return str(key)
+
+    def _index(self, key) -> int:
+        return hash(self._normalise(key)) % len(self._locks)
+
+    def __getitem__(self, key) -> threading.RLock:
+        return self._locks[self._index(key)]
+
+    @contextmanager
+    def many(self, *keys):
+        """
+        Hold the locks for all of the given keys, eg the old and new ids when migrating a chat.
+        Locks are always taken in the same order, so two callers can't deadlock on each other.
+        """
+        with ExitStack() as stack:
+            for index in sorted({self._index(key) for key in keys}):
+                stack.enter_context(self._locks[index])
+            yield
+
+    @contextmanager
+    def all(self):
+        """
+        Hold every lock, for the rare writes which touch rows of many keys at once.
+        """
+        with ExitStack() as stack:
+            for lock in self._locks:
+                stack.enter_context(lock)
+            yield
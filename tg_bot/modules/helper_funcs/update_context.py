@@ -0,0 +1,111 @@
+import threading
+from functools import wraps
+from typing import Callable
+
+from telegram import Update, ChatMember
+
+from tg_bot import dispatcher
+from tg_bot.modules.helper_funcs.cache import TTLCache
+from tg_bot.modules.helper_funcs.chat_status import get_member, get_admin_roster, is_user_admin, is_bot_admin
+
+# update_id -> UpdateContext. Kept out of the Update itself, so it doesn't end up in to_dict()/to_json(). @run_async
+# handlers can still be running well after process_update returns, so contexts are only dropped once they're old.
+CONTEXT_TTL = 5 * 60  # seconds
+CONTEXTS = TTLCache(maxsize=10000, ttl=CONTEXT_TTL)
+CONTEXTS_LOCK = threading.Lock()
+
+# Functions of an update which say whether a moderation hook deletes its message, added by the modules which delete
+# messages (eg locks). Hooks ask these rather than waiting for the deleting hook to say so, so that the answer is the
+# same whether the hooks run one after the other (fused) or all at once.
+DELETE_CHECKS = []
+
+
+class UpdateContext(object):
+    """
+    Per-update memo of the lookups which can cost an API call or db query, eg member statuses.
+
+    A single group message goes through most handler groups, which all want the same facts about the chat and the
+    sender. Whichever handler asks first fetches them; everyone else gets the saved answer. Settings which are already
+    kept in memory (locks, gbans, disabled commands, ...) are cheaper to read directly than through here.
+    """
+
+    def __init__(self, update: Update):
+        self.update = update
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def get(self, func: Callable, *args):
+        """
+        :return: func(*args), only calling it the first time it's asked for during this update
+        """
+        key = (func, args)
+        with self._lock:
+            if key in self._memo:
+                return self._memo[key]
+
+        # not called under the lock, so a slow fetch doesn't hold up the other handler threads
+        result = func(*args)
+        with self._lock:
+            return self._memo.setdefault(key, result)
+
+    def chat_setting(self, func: Callable):
+        """
+        :return: func(chat_id) for the update's chat, eg chat_setting(warns_sql.get_chat_warn_filters)
+        """
+        return self.get(func, self.update.effective_chat.id)
+
+    def member(self, user_id: int) -> ChatMember:
+        return self.get(get_member, self.update.effective_chat, user_id)
+
+    @property
+    def bot_member(self) -> ChatMember:
+        return self.member(dispatcher.bot.id)
+
+    def admin_ids(self):
+        return self.get(get_admin_roster, self.update.effective_chat).keys()
+
+    def is_admin(self, user_id: int) -> bool:
+        return self.get(is_user_admin, self.update.effective_chat, user_id)
+
+    def is_bot_admin(self) -> bool:
+        return self.get(is_bot_admin, self.update.effective_chat, dispatcher.bot.id)
+
+    @property
+    def message_deleted(self) -> bool:
+        return any(self.get(check, self.update) for check in DELETE_CHECKS)
+
+
+def new_context(update: Update) -> UpdateContext:
+    """
+    Give the update a fresh context, as it comes into the dispatcher.
+    """
+    context = UpdateContext(update)
+    with CONTEXTS_LOCK:
+        CONTEXTS.set(update.update_id, context)
+    return context
+
+
+def get_context(update: Update) -> UpdateContext:
+    """
+    :return: the update's context; created here if the update didn't come through the dispatcher, eg from a job
+    """
+    with CONTEXTS_LOCK:
+        context = CONTEXTS.get(update.update_id)
+        if context is None:
+            context = UpdateContext(update)
+            CONTEXTS.set(update.update_id, context)
+        return context
+
+
+def skip_deleted(func):
+    """
+    For hooks which look at every message: don't run for messages which a moderation hook deletes, eg so that we
+    don't reply to them.
+    """
+    @wraps(func)
+    def wrapper(bot, update, *args, **kwargs):
+        if get_context(update).message_deleted:
+            return None
+        return func(bot, update, *args, **kwargs)
+
+    return wrapper
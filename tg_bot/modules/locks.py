@@ -1,3 +1,4 @@
+import threading
 from typing import Optional, List
 
 from telegram import Message, Chat, Update, Bot, ParseMode, User
@@ -7,11 +8,14 @@ from telegram.ext.dispatcher import run_async
 from telegram.utils.helpers import escape_markdown
 
 import tg_bot.modules.sql.locks_sql as sql
-from tg_bot import dispatcher, SUDO_USERS
+from tg_bot import dispatcher, SUDO_USERS, LOGGER
 from tg_bot.modules.disable import DisableAbleCommandHandler
-from tg_bot.modules.helper_funcs.chat_status import can_delete, is_user_admin, user_not_admin, user_admin, \
-    bot_can_delete, is_bot_admin
+from tg_bot.modules.helper_funcs.chat_status import can_delete, is_user_admin, user_admin, bot_can_delete, \
+    get_admin_roster
+from tg_bot.modules.helper_funcs.fanout import fan_out, summarise_fan_out
 from tg_bot.modules.helper_funcs.filters import CustomFilters
+from tg_bot.modules.helper_funcs.lanes import run_in_lane, MODERATION_LANE, BULK_LANE
+from tg_bot.modules.helper_funcs.update_context import get_context, DELETE_CHECKS
 from tg_bot.modules.log_channel import loggable
 from tg_bot.modules.sql import users_sql
 
@@ -19,36 +23,95 @@ LOCK_TYPES = ['sticker', 'audio', 'voice', 'document', 'video', 'contact', 'phot
 
 RESTRICTION_TYPES = ['messages', 'media', 'other', 'previews', 'all']
 
-PERM_GROUP = 1
-REST_GROUP = 2
-
-
-# NOT ASYNC
-def restr_members(bot, chat_id, members, messages=False, media=False, other=False, previews=False):
-    for mem in members:
-        if mem.user in SUDO_USERS:
-            pass
+LOCK_GROUP = 1
+
+# Members are (un)restricted in chunks, each of which is done concurrently; progress is reported after every chunk.
+RESTRICTION_CHUNK_SIZE = 200
+RESTRICTION_WORKERS = 8
+# chat_id -> the RestrictionJob running in that chat
+RESTRICTION_JOBS = {}
+RESTRICTION_JOBS_LOCK = threading.Lock()
+
+
+class RestrictionJob(object):
+    """
+    Background job setting the permissions of every known member of a chat, except admins and sudo users.
+    """
+
+    def __init__(self, bot: Bot, chat: Chat, description: str, messages=True, media=True, other=True, previews=True):
+        self.bot = bot
+        self.chat = chat
+        self.description = description
+        self.permissions = dict(can_send_messages=messages,
+                                can_send_media_messages=media,
+                                can_send_other_messages=other,
+                                can_add_web_page_previews=previews)
+        self.cancelled = threading.Event()
+
+    def start(self):
+        with RESTRICTION_JOBS_LOCK:
+            # members should end up with the permissions of the newest lock/unlock, so there's no point finishing
+            # an older one
+            running = RESTRICTION_JOBS.get(self.chat.id)
+            if running:
+                running.cancel()
+            RESTRICTION_JOBS[self.chat.id] = self
+
+        if BULK_LANE.submit(self.run) is None:
+            with RESTRICTION_JOBS_LOCK:
+                if RESTRICTION_JOBS.get(self.chat.id) is self:
+                    del RESTRICTION_JOBS[self.chat.id]
+            try:
+                self.bot.send_message(self.chat.id, "{}: I'm too busy to update members' permissions right now - try "
+                                                    "again in a few minutes.".format(self.description))
+            except TelegramError:
+                pass
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def restrict(self, user_id):
+        if not self.cancelled.is_set():
+            self.bot.restrict_chat_member(self.chat.id, user_id, **self.permissions)
+
+    def report(self, progress_msg: Message, text: str):
         try:
-            bot.restrict_chat_member(chat_id, mem.user,
-                                     can_send_messages=messages,
-                                     can_send_media_messages=media,
-                                     can_send_other_messages=other,
-                                     can_add_web_page_previews=previews)
+            progress_msg.edit_text(text)
         except TelegramError:
-            pass
+            pass  # deleted, or nothing changed
 
-
-# NOT ASYNC
-def unrestr_members(bot, chat_id, members, messages=True, media=True, other=True, previews=True):
-    for mem in members:
+    def run(self):
         try:
-            bot.restrict_chat_member(chat_id, mem.user,
-                                     can_send_messages=messages,
-                                     can_send_media_messages=media,
-                                     can_send_other_messages=other,
-                                     can_add_web_page_previews=previews)
-        except TelegramError:
-            pass
+            skip = set(get_admin_roster(self.chat)) | set(SUDO_USERS) | {self.bot.id}
+            user_ids = [mem.user for mem in users_sql.get_chat_members(self.chat.id) if mem.user not in skip]
+            progress_msg = self.bot.send_message(self.chat.id, "{}: updating the permissions of {} members. Use "
+                                                               "/cancelrestrict to stop."
+                                                               .format(self.description, len(user_ids)))
+            succeeded = 0
+            failed = []
+            for start in range(0, len(user_ids), RESTRICTION_CHUNK_SIZE):
+                if self.cancelled.is_set():
+                    break
+
+                chunk_succeeded, chunk_failed = fan_out(self.restrict,
+                                                        user_ids[start:start + RESTRICTION_CHUNK_SIZE],
+                                                        workers=RESTRICTION_WORKERS)
+                succeeded += chunk_succeeded
+                failed.extend(chunk_failed)
+                self.report(progress_msg, "{}: {}/{} members done.".format(self.description,
+                                                                          succeeded + len(failed), len(user_ids)))
+
+            self.report(progress_msg, "{}: {} {}".format(self.description,
+                                                         "cancelled!" if self.cancelled.is_set() else "done!",
+                                                         summarise_fan_out(succeeded, failed)))
+
+        except TelegramError as excp:
+            LOGGER.warning("Couldn't update member permissions in %s: %s", self.chat.id, excp.message)
+
+        finally:
+            with RESTRICTION_JOBS_LOCK:
+                if RESTRICTION_JOBS.get(self.chat.id) is self:
+                    del RESTRICTION_JOBS[self.chat.id]
 
 
 @run_async
@@ -56,6 +119,7 @@ def locktypes(bot: Bot, update: Update):
     update.effective_message.reply_text("\n - ".join(["Locks: "] + LOCK_TYPES + RESTRICTION_TYPES))
 
 
+@run_async
 @user_admin
 @bot_can_delete
 @loggable
@@ -79,8 +143,7 @@ def lock(bot: Bot, update: Update, args: List[str]) -> str:
             elif args[0] in RESTRICTION_TYPES:
                 sql.update_restriction(chat.id, args[0], locked=True)
                 if args[0] == "previews":
-                    members = users_sql.get_chat_members(str(chat.id))
-                    restr_members(bot, chat.id, members, messages=True, media=True, other=True)
+                    RestrictionJob(bot, chat, "Locking previews", previews=False).start()
 
                 message.reply_text("Locked {} for all non-admins!".format(args[0]))
                 return "{}:" \
@@ -120,22 +183,19 @@ def unlock(bot: Bot, update: Update, args: List[str]) -> str:
 
             elif args[0] in RESTRICTION_TYPES:
                 sql.update_restriction(chat.id, args[0], locked=False)
-                members = users_sql.get_chat_members(chat.id)
+                description = "Unlocking {}".format(args[0])
 
                 if args[0] == "messages":
-                    unrestr_members(bot, chat.id, members, media=False, other=False, previews=False)
+                    RestrictionJob(bot, chat, description, media=False, other=False, previews=False).start()
 
                 elif args[0] == "media":
-                    unrestr_members(bot, chat.id, members, other=False, previews=False)
+                    RestrictionJob(bot, chat, description, other=False, previews=False).start()
 
                 elif args[0] == "other":
-                    unrestr_members(bot, chat.id, members, previews=False)
-
-                elif args[0] == "previews":
-                    unrestr_members(bot, chat.id, members)
+                    RestrictionJob(bot, chat, description, previews=False).start()
 
-                elif args[0] == "all":
-                    unrestr_members(bot, chat.id, members, True, True, True, True)
+                elif args[0] in ("previews", "all"):
+                    RestrictionJob(bot, chat, description).start()
 
                 message.reply_text("Unlocked {} for everyone!".format(args[0]))
                 return "{}:" \
@@ -153,151 +213,76 @@ def unlock(bot: Bot, update: Update, args: List[str]) -> str:
     return ""
 
 
-@run_async
-@user_not_admin
-def del_sticker(bot: Bot, update: Update):
-    chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_locked(chat.id, "sticker") and can_delete(chat, bot.id):
-        update.effective_message.delete()
+# what enforce_locks does with a message which doesn't break any locks (or whose sender is exempt)
+NO_LOCK_ACTION = (False, [], None)
 
 
-@run_async
-@user_not_admin
-def del_audio(bot: Bot, update: Update):
-    chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_locked(chat.id, "audio") and can_delete(chat, bot.id):
-        update.effective_message.delete()
-
-
-@run_async
-@user_not_admin
-def del_voice(bot: Bot, update: Update):
-    chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_locked(chat.id, "voice") and can_delete(chat, bot.id):
-        update.effective_message.delete()
-
+def lock_actions(update: Update):
+    """
+    Work out what enforce_locks does with the update's message. Memoized for the update (see get_context), as the
+    hooks which skip deleted messages ask too.
 
-@run_async
-@user_not_admin
-def del_document(bot: Bot, update: Update):
+    :return: (delete, new_bots, restriction): whether the message gets deleted, the new bots to kick, and the
+        restriction to apply to the sender, if any
+    """
     chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_locked(chat.id, "document") and can_delete(chat, bot.id):
-        update.effective_message.delete()
+    user = update.effective_user  # type: Optional[User]
+    msg = update.effective_message  # type: Optional[Message]
 
+    lock_bits = sql.get_lock_bits(chat.id)
+    restr_bits = sql.get_restr_bits(chat.id)
+    if not user or not (lock_bits or restr_bits):
+        return NO_LOCK_ACTION
 
-@run_async
-@user_not_admin
-def del_video(bot: Bot, update: Update):
-    chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_locked(chat.id, "video") and can_delete(chat, bot.id):
-        update.effective_message.delete()
+    # Classify the message once, against only the locks which are actually set in this chat.
+    locked = any(lock_bits & sql.LOCK_BITS[lock_type] and lock_filter(msg)
+                 for lock_type, lock_filter in LOCK_FILTERS)
+    new_bots = []
+    if lock_bits & sql.LOCK_BITS["bots"]:
+        new_bots = [new_mem for new_mem in msg.new_chat_members or [] if new_mem.is_bot]
+    restriction = next((restr for restr_type, restr_filter, *restr in RESTRICTION_FILTERS
+                        if restr_bits & sql.RESTR_BITS[restr_type] and restr_filter(msg)), None)
 
+    # only now check for admin, as this is the one which can cost an API call
+    context = get_context(update)
+    if not (locked or new_bots or restriction) or context.is_admin(user.id):
+        return NO_LOCK_ACTION
 
-@run_async
-@user_not_admin
-def del_contact(bot: Bot, update: Update):
-    chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_locked(chat.id, "contact") and can_delete(chat, bot.id):
-        update.effective_message.delete()
+    if new_bots and not context.is_bot_admin():
+        new_bots = []
+    if (locked or restriction) and not context.bot_member.can_delete_messages:
+        locked = restriction = None
+    return bool(locked or restriction and restriction[0]), new_bots, restriction
 
 
-@run_async
-@user_not_admin
-def del_photo(bot: Bot, update: Update):
-    chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_locked(chat.id, "photo") and can_delete(chat, bot.id):
-        update.effective_message.delete()
+def deletes_message(update: Update) -> bool:
+    return get_context(update).get(lock_actions, update)[0]
 
 
-@run_async
-@user_not_admin
-def del_gif(bot: Bot, update: Update):
-    chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_locked(chat.id, "gif") and can_delete(chat, bot.id):
-        update.effective_message.delete()
+DELETE_CHECKS.append(deletes_message)
 
 
-@run_async
-@user_not_admin
-def del_url(bot: Bot, update: Update):
+@run_in_lane(MODERATION_LANE)
+def enforce_locks(bot: Bot, update: Update):
     chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_locked(chat.id, "url") and can_delete(chat, bot.id):
-        update.effective_message.delete()
-
-
-@run_async
-@user_not_admin
-def remove_bot(bot: Bot, update: Update):
-    chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_locked(chat.id, "bots") and is_bot_admin(chat, bot.id):
-        new_members = update.effective_message.new_chat_members
-        for new_mem in new_members:
-            if new_mem.is_bot:
-                chat.kick_member(new_mem.id)
-                update.effective_message.reply_text("Only admins are allowed to add bots to this chat! Get outta here.")
-
-
-@run_async
-@user_not_admin
-def rest_msg(bot: Bot, update: Update):
+    user = update.effective_user  # type: Optional[User]
     msg = update.effective_message  # type: Optional[Message]
-    chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_restr_locked(chat.id, "messages") \
-            and can_delete(chat, bot.id) \
-            and not is_user_admin(chat, msg.from_user.id):
-        msg.delete()
-        bot.restrict_chat_member(chat.id, msg.from_user.id,
-                                 can_send_messages=False,
-                                 can_send_media_messages=False,
-                                 can_send_other_messages=False,
-                                 can_add_web_page_previews=False)
 
+    delete, new_bots, restriction = get_context(update).get(lock_actions, update)
+    for new_mem in new_bots:
+        chat.kick_member(new_mem.id)
+        msg.reply_text("Only admins are allowed to add bots to this chat! Get outta here.")
 
-@run_async
-@user_not_admin
-def rest_media(bot: Bot, update: Update):
-    msg = update.effective_message  # type: Optional[Message]
-    chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_restr_locked(chat.id, "media") \
-            and can_delete(chat, bot.id) \
-            and not is_user_admin(chat, msg.from_user.id):
+    if delete:
         msg.delete()
-        bot.restrict_chat_member(chat.id, msg.from_user.id,
-                                 can_send_messages=True,
-                                 can_send_media_messages=False,
-                                 can_send_other_messages=False,
-                                 can_add_web_page_previews=False)
 
-
-@run_async
-@user_not_admin
-def rest_other(bot: Bot, update: Update):
-    msg = update.effective_message  # type: Optional[Message]
-    chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_restr_locked(chat.id, "other") \
-            and can_delete(chat, bot.id) \
-            and not is_user_admin(chat, msg.from_user.id):
-        msg.delete()
-        bot.restrict_chat_member(chat.id, msg.from_user.id,
-                                 can_send_messages=True,
-                                 can_send_media_messages=True,
-                                 can_send_other_messages=False,
-                                 can_add_web_page_previews=False)
-
-
-@run_async
-@user_not_admin
-def rest_previews(bot: Bot, update: Update):
-    msg = update.effective_message  # type: Optional[Message]
-    chat = update.effective_chat  # type: Optional[Chat]
-    if sql.is_restr_locked(chat.id, "previews") \
-            and can_delete(chat, bot.id) \
-            and not is_user_admin(chat, msg.from_user.id):
-        bot.restrict_chat_member(chat.id, msg.from_user.id,
-                                 can_send_messages=True,
-                                 can_send_media_messages=True,
-                                 can_send_other_messages=True,
-                                 can_add_web_page_previews=False)
+    if restriction:
+        messages, media, other, previews = restriction[1]
+        bot.restrict_chat_member(chat.id, user.id,
+                                 can_send_messages=messages,
+                                 can_send_media_messages=media,
+                                 can_send_other_messages=other,
+                                 can_add_web_page_previews=previews)
 
 
 def build_lock_message(chat_id):
@@ -329,6 +314,20 @@ def build_lock_message(chat_id):
     return res
 
 
+@run_async
+@user_admin
+def cancel_restrict(bot: Bot, update: Update):
+    chat = update.effective_chat  # type: Optional[Chat]
+    with RESTRICTION_JOBS_LOCK:
+        job = RESTRICTION_JOBS.get(chat.id)
+
+    if job:
+        job.cancel()
+        update.effective_message.reply_text("Stopping...")
+    else:
+        update.effective_message.reply_text("I'm not updating anyone's permissions here!")
+
+
 @run_async
 @user_admin
 def list_locks(bot: Bot, update: Update):
@@ -354,6 +353,7 @@ __help__ = """
  - /lock <type>: lock items of a certain type (not available in private)
  - /unlock <type>: unlock items of a certain type (not available in private)
  - /locks: the current list of locks in this chat.
+ - /cancelrestrict: stop updating member permissions after locking/unlocking messages, media, other or previews.
 
 Locks can be used to restrict a group's users.
 eg:
@@ -364,50 +364,48 @@ Locking bots will stop non-admins from adding bots to the chat.
 
 __mod_name__ = "Locks"
 
+__fusable_groups__ = [LOCK_GROUP]
+
 GIF = Filters.document & CustomFilters.mime_type("video/mp4")
 OTHER = Filters.game | Filters.sticker | GIF
 MEDIA = Filters.audio | Filters.document | Filters.video | Filters.voice | Filters.photo
 MESSAGES = Filters.text | Filters.contact | Filters.location | Filters.venue | MEDIA | OTHER
 PREVIEWS = Filters.entity("url")
 
+# lock type -> the messages it deletes. Bots are handled separately, as they aren't about the message itself.
+LOCK_FILTERS = (
+    ("gif", GIF),
+    ("sticker", Filters.sticker),
+    ("audio", Filters.audio),
+    ("voice", Filters.voice),
+    ("document", Filters.document & ~GIF),  # gifs are documents too, but have their own lock
+    ("video", Filters.video),
+    ("contact", Filters.contact),
+    ("photo", Filters.photo),
+    ("url", Filters.entity(MessageEntity.URL)),
+)
+
+# restriction type, the messages it applies to, whether to delete them, and the (messages, media, other, previews)
+# permissions left to the sender. Most restrictive first - only the first matching restriction is applied.
+RESTRICTION_FILTERS = (
+    ("messages", MESSAGES, True, (False, False, False, False)),
+    ("media", MEDIA, True, (True, False, False, False)),
+    ("other", OTHER, True, (True, True, False, False)),
+    ("previews", PREVIEWS, False, (True, True, True, False)),
+)
+
 LOCKTYPES_HANDLER = DisableAbleCommandHandler("locktypes", locktypes)
 LOCK_HANDLER = CommandHandler("lock", lock, pass_args=True, filters=Filters.group)
 UNLOCK_HANDLER = CommandHandler("unlock", unlock, pass_args=True, filters=Filters.group)
 LOCKED_HANDLER = CommandHandler("locks", list_locks, filters=Filters.group)
+CANCEL_RESTRICT_HANDLER = CommandHandler("cancelrestrict", cancel_restrict, filters=Filters.group)
 
-REST_MSG_HANDLER = MessageHandler(MESSAGES, rest_msg)
-REST_MEDIA_HANDLER = MessageHandler(MEDIA, rest_media)
-REST_OTHERS_HANDLER = MessageHandler(OTHER, rest_other)
-REST_PREVIEWS_HANDLER = MessageHandler(PREVIEWS, rest_previews)
-
-STICKER_HANDLER = MessageHandler(Filters.sticker, del_sticker)
-AUDIO_HANDLER = MessageHandler(Filters.audio, del_audio)
-VOICE_HANDLER = MessageHandler(Filters.voice, del_voice)
-DOCUMENT_HANDLER = MessageHandler(Filters.document, del_document)
-VIDEO_HANDLER = MessageHandler(Filters.video, del_video)
-CONTACT_HANDLER = MessageHandler(Filters.contact, del_contact)
-PHOTO_HANDLER = MessageHandler(Filters.photo, del_photo)
-GIF_HANDLER = MessageHandler(GIF, del_gif)
-URL_HANDLER = MessageHandler(Filters.entity(MessageEntity.URL), del_url)
-BOT_HANDLER = MessageHandler(Filters.status_update.new_chat_members, remove_bot)
+LOCK_ENFORCER = MessageHandler(Filters.group, enforce_locks)
 
 dispatcher.add_handler(LOCK_HANDLER)
 dispatcher.add_handler(UNLOCK_HANDLER)
 dispatcher.add_handler(LOCKTYPES_HANDLER)
 dispatcher.add_handler(LOCKED_HANDLER)
+dispatcher.add_handler(CANCEL_RESTRICT_HANDLER)
 
-dispatcher.add_handler(REST_MSG_HANDLER, REST_GROUP)
-dispatcher.add_handler(REST_MEDIA_HANDLER, REST_GROUP)
-dispatcher.add_handler(REST_OTHERS_HANDLER, REST_GROUP)
-dispatcher.add_handler(REST_PREVIEWS_HANDLER, REST_GROUP)
-
-dispatcher.add_handler(GIF_HANDLER, PERM_GROUP)  # be at top, before doc handler
-dispatcher.add_handler(STICKER_HANDLER, PERM_GROUP)
-dispatcher.add_handler(AUDIO_HANDLER, PERM_GROUP)
-dispatcher.add_handler(VOICE_HANDLER, PERM_GROUP)
-dispatcher.add_handler(DOCUMENT_HANDLER, PERM_GROUP)
-dispatcher.add_handler(VIDEO_HANDLER, PERM_GROUP)
-dispatcher.add_handler(CONTACT_HANDLER, PERM_GROUP)
-dispatcher.add_handler(PHOTO_HANDLER, PERM_GROUP)
-dispatcher.add_handler(URL_HANDLER, PERM_GROUP)
-dispatcher.add_handler(BOT_HANDLER, PERM_GROUP)
+dispatcher.add_handler(LOCK_ENFORCER, LOCK_GROUP)
@@ -1,12 +1,33 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, scoped_session
 
-from tg_bot import DB_URI
+from tg_bot import DB_URI, WORKERS, MODERATION_WORKERS, BULK_WORKERS, DB_POOL_SIZE, DB_POOL_RECYCLE, \
+    DB_STATEMENT_TIMEOUT, SQLITE_WAL
+from tg_bot.modules.helper_funcs.lanes import add_cleanup_hook
 
 
 def start() -> scoped_session:
-    engine = create_engine(DB_URI, client_encoding="utf8")
+    if make_url(DB_URI).get_backend_name() == "sqlite":
+        # sqlite has no real connection pool to configure; just let all the worker threads share the db.
+        engine = create_engine(DB_URI, connect_args={"check_same_thread": False})
+        if SQLITE_WAL:
+            # WAL lets readers carry on while another thread writes.
+            event.listen(engine, "connect", lambda dbapi_conn, _: dbapi_conn.execute("PRAGMA journal_mode=WAL"))
+
+    else:
+        connect_args = {}
+        if DB_STATEMENT_TIMEOUT:
+            connect_args["options"] = "-c statement_timeout={}".format(DB_STATEMENT_TIMEOUT)
+
+        # one connection for every worker of every lane, plus the dispatcher and job queue threads.
+        engine = create_engine(DB_URI, client_encoding="utf8",
+                               pool_size=DB_POOL_SIZE or WORKERS + MODERATION_WORKERS + BULK_WORKERS + 2,
+                               pool_pre_ping=True,  # drop dead connections (eg after a failover) instead of erroring
+                               pool_recycle=DB_POOL_RECYCLE,
+                               connect_args=connect_args)
+
     BASE.metadata.bind = engine
     BASE.metadata.create_all(engine)
     return scoped_session(sessionmaker(bind=engine, autoflush=False))
@@ -14,3 +35,7 @@ def start() -> scoped_session:
 
 BASE = declarative_base()
 SESSION = start()
+
+# every handler run and job starts with a fresh session, and a connection is never held (or left in a broken
+# transaction) between them
+add_cleanup_hook(SESSION.remove)
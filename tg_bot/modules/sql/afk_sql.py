@@ -1,7 +1,6 @@
-import threading
-
 from sqlalchemy import Column, UnicodeText, Boolean, Integer
 
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import BASE, SESSION
 
 
@@ -22,7 +21,7 @@ class AFK(BASE):
 
 
 AFK.__table__.create(checkfirst=True)
-INSERTION_LOCK = threading.RLock()
+INSERTION_LOCK = StripedLock()
 
 
 def check_afk_status(user_id):
@@ -33,7 +32,7 @@ def check_afk_status(user_id):
 
 
 def set_afk(user_id, reason=""):
-    with INSERTION_LOCK:
+    with INSERTION_LOCK[user_id]:
         curr = SESSION.query(AFK).get(user_id)
         if not curr:
             curr = AFK(user_id, reason, True)
@@ -44,7 +43,7 @@ def set_afk(user_id, reason=""):
 
 
 def rm_afk(user_id):
-    with INSERTION_LOCK:
+    with INSERTION_LOCK[user_id]:
         curr = SESSION.query(AFK).get(user_id)
         if curr:
             SESSION.delete(curr)
@@ -55,7 +54,7 @@ def rm_afk(user_id):
 
 
 def toggle_afk(user_id, reason=""):
-    with INSERTION_LOCK:
+    with INSERTION_LOCK[user_id]:
         curr = SESSION.query(AFK).get(user_id)
         if not curr:
             curr = AFK(user_id, reason, True)
@@ -1,19 +1,23 @@
-import threading
+from collections import deque
+from time import monotonic
 
-from sqlalchemy import String, Column, Integer
+from sqlalchemy import BigInteger, Column, Integer
 
+from tg_bot import FLOOD_WINDOW
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import SESSION, BASE
 
 
 class FloodControl(BASE):
     __tablename__ = "antiflood"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
+    # NOTE: user_id and count are legacy; flood counters are now only kept in memory.
     user_id = Column(Integer)
     count = Column(Integer, default=0)
     limit = Column(Integer, default=0)
 
     def __init__(self, chat_id):
-        self.chat_id = str(chat_id)  # ensure string
+        self.chat_id = int(chat_id)
 
     def __repr__(self):
         return "<flood control for %s>" % self.chat_id
@@ -21,14 +25,25 @@ class FloodControl(BASE):
 
 FloodControl.__table__.create(checkfirst=True)
 
-INSERTION_LOCK = threading.RLock()
+INSERTION_LOCK = StripedLock()
+
+# Only the limit is stored in the db - the counters change on every message, so they live in memory.
+CHAT_FLOOD_LIMITS = {}  # chat_id -> limit, for chats with antiflood enabled
+# consecutive mode: chat_id -> [last user_id, number of consecutive messages from them]
+# window mode: chat_id -> {user_id: deque of message timestamps}
+CHAT_FLOOD = {}
+
+# Counters have their own locks, so counting messages never waits for a db write.
+FLOOD_LOCK = StripedLock()
+# prune idle users from a chat's window counters once it tracks this many users
+WINDOW_PRUNE_SIZE = 1000
 
 
 def set_flood(chat_id, amount):
-    with INSERTION_LOCK:
-        flood = SESSION.query(FloodControl).get(str(chat_id))
+    with INSERTION_LOCK[chat_id]:
+        flood = SESSION.query(FloodControl).get(int(chat_id))
         if not flood:
-            flood = FloodControl(str(chat_id))
+            flood = FloodControl(int(chat_id))
 
         flood.user_id = None
         flood.limit = amount
@@ -36,48 +51,102 @@ def set_flood(chat_id, amount):
         SESSION.add(flood)
         SESSION.commit()
 
+        with FLOOD_LOCK[chat_id]:
+            if amount:
+                CHAT_FLOOD_LIMITS[int(chat_id)] = amount
+            else:
+                CHAT_FLOOD_LIMITS.pop(int(chat_id), None)
+            CHAT_FLOOD.pop(int(chat_id), None)
+
 
 def update_flood(chat_id, user_id):
-    with INSERTION_LOCK:
-        flood = SESSION.query(FloodControl).get(str(chat_id))
+    """
+    Count a new message, and check whether its sender is flooding.
+
+    :param chat_id: chat the message was sent in
+    :param user_id: sender of the message, or None for messages which shouldn't be counted (eg admins)
+    :return: True if the sender should be banned for flooding
+    """
+    chat_id = int(chat_id)
+    limit = CHAT_FLOOD_LIMITS.get(chat_id)
+    if not limit:
+        return False
 
-        if flood and flood.limit != 0:
-            if flood.user_id != user_id:
-                flood.user_id = user_id
-                flood.count = 0
+    with FLOOD_LOCK[chat_id]:
+        if FLOOD_WINDOW:
+            return __update_window_flood(chat_id, user_id, limit)
 
-            if not user_id:
-                SESSION.commit()
-                return False
+        flood = CHAT_FLOOD.setdefault(chat_id, [None, 0])
+        if flood[0] != user_id:
+            flood[0] = user_id
+            flood[1] = 0
 
-            flood.count += 1
+        if not user_id:
+            return False
 
-            if flood.count > flood.limit:
-                flood.user_id = None
-                flood.count = 0
+        flood[1] += 1
 
-                SESSION.commit()
-                return True
+        if flood[1] > limit:
+            flood[0] = None
+            flood[1] = 0
+            return True
 
-            SESSION.commit()
-            return False
+        return False
 
-        SESSION.close()
+
+def __update_window_flood(chat_id, user_id, limit):
+    if not user_id:
         return False
 
+    now = monotonic()
+    cutoff = now - FLOOD_WINDOW
+    chat_flood = CHAT_FLOOD.setdefault(chat_id, {})
 
-def get_flood(chat_id):
-    try:
-        return SESSION.query(FloodControl).get(str(chat_id))
-    finally:
-        SESSION.close()
+    if len(chat_flood) >= WINDOW_PRUNE_SIZE:
+        for idle_user in [user for user, times in chat_flood.items() if times[-1] < cutoff]:
+            del chat_flood[idle_user]
+
+    times = chat_flood.setdefault(user_id, deque(maxlen=limit + 1))
+    times.append(now)
+    while times[0] < cutoff:
+        times.popleft()
+
+    if len(times) > limit:
+        del chat_flood[user_id]
+        return True
+
+    return False
+
+
+def get_flood_limit(chat_id):
+    return CHAT_FLOOD_LIMITS.get(int(chat_id), 0)
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with INSERTION_LOCK:
-        flood = SESSION.query(FloodControl).get(str(old_chat_id))
+    with INSERTION_LOCK.many(old_chat_id, new_chat_id):
+        flood = SESSION.query(FloodControl).get(int(old_chat_id))
         if flood:
-            flood.chat_id = str(new_chat_id)
+            flood.chat_id = int(new_chat_id)
             SESSION.commit()
 
         SESSION.close()
+
+        with FLOOD_LOCK[old_chat_id]:
+            limit = CHAT_FLOOD_LIMITS.pop(int(old_chat_id), None)
+            CHAT_FLOOD.pop(int(old_chat_id), None)
+
+        if limit:
+            with FLOOD_LOCK[new_chat_id]:
+                CHAT_FLOOD_LIMITS[int(new_chat_id)] = limit
+
+
+def __load_flood_settings():
+    global CHAT_FLOOD_LIMITS
+    try:
+        CHAT_FLOOD_LIMITS = {flood.chat_id: flood.limit for flood in SESSION.query(FloodControl).all() if flood.limit}
+    finally:
+        SESSION.close()
+
+
+# Create in memory flood limits to avoid disk access
+__load_flood_settings()
@@ -0,0 +1,207 @@
+import threading
+
+from sqlalchemy import Column, BigInteger, Integer, UnicodeText, Boolean, DateTime, ForeignKey, func
+
+from tg_bot.modules.sql import BASE, SESSION
+from tg_bot.modules.sql.users_sql import Chats
+
+
+class Broadcasts(BASE):
+    __tablename__ = "broadcasts"
+    id = Column(Integer, primary_key=True)
+    message = Column(UnicodeText, nullable=False)
+    report_chat_id = Column(BigInteger, nullable=False)  # where to say when it's done
+    # chats are sent to in chat id order; this is the last chat id handled
+    cursor = Column(BigInteger)
+    total = Column(Integer, default=0, nullable=False)
+    sent = Column(Integer, default=0, nullable=False)
+    failed = Column(Integer, default=0, nullable=False)
+    done = Column(Boolean, default=False, nullable=False)
+    started = Column(DateTime, default=func.now(), nullable=False)
+    error = Column(UnicodeText)  # why the last run stopped before the end, if it did
+
+    def __init__(self, message, report_chat_id, total):
+        self.message = message
+        self.report_chat_id = int(report_chat_id)
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.done = False
+
+    def __repr__(self):
+        return "<Broadcast {} ({}/{} sent)>".format(self.id, self.sent, self.total)
+
+
+class BroadcastOutcomes(BASE):
+    # only failures are kept; the broadcast's cursor and counts already say which chats were sent to
+    __tablename__ = "broadcast_outcomes"
+    broadcast_id = Column(Integer, ForeignKey("broadcasts.id", ondelete="CASCADE"), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
+    error = Column(UnicodeText)
+
+    def __init__(self, broadcast_id, chat_id, error=None):
+        self.broadcast_id = broadcast_id
+        self.chat_id = int(chat_id)
+        self.error = error
+
+    def __repr__(self):
+        return "<Broadcast {} to {}: {}>".format(self.broadcast_id, self.chat_id, self.error or "sent")
+
+
+class DeadChats(BASE):
+    __tablename__ = "dead_chats"
+    chat_id = Column(BigInteger, primary_key=True)
+    reason = Column(UnicodeText)
+
+    def __init__(self, chat_id, reason=None):
+        self.chat_id = int(chat_id)
+        self.reason = reason
+
+    def __repr__(self):
+        return "<Dead chat {} ({})>".format(self.chat_id, self.reason)
+
+
+Broadcasts.__table__.create(checkfirst=True)
+BroadcastOutcomes.__table__.create(checkfirst=True)
+DeadChats.__table__.create(checkfirst=True)
+
+BROADCAST_LOCK = threading.RLock()
+DEAD_CHATS_LOCK = threading.RLock()
+DEAD_CHATS = set()  # ids of chats the bot has been kicked from, which broadcasts skip
+
+
+def new_broadcast(message, report_chat_id):
+    """
+    :return: the id of the new broadcast
+    """
+    with BROADCAST_LOCK:
+        total = SESSION.query(func.count(Chats.chat_id)) \
+            .filter(Chats.chat_id.notin_(SESSION.query(DeadChats.chat_id))).scalar()
+        broadcast = Broadcasts(message, report_chat_id, total)
+        SESSION.add(broadcast)
+        SESSION.commit()
+        return broadcast.id
+
+
+def get_broadcast(broadcast_id):
+    try:
+        return SESSION.query(Broadcasts).get(broadcast_id)
+    finally:
+        SESSION.close()
+
+
+def get_latest_broadcasts(limit=3):
+    try:
+        return SESSION.query(Broadcasts).order_by(Broadcasts.id.desc()).limit(limit).all()
+    finally:
+        SESSION.close()
+
+
+def get_unfinished_broadcast_ids():
+    try:
+        return [broadcast_id for broadcast_id, in SESSION.query(Broadcasts.id).filter(Broadcasts.done.is_(False))
+                .order_by(Broadcasts.id)]
+    finally:
+        SESSION.close()
+
+
+def get_next_chat_ids(cursor, limit):
+    """
+    :return: the ids of the next (up to) limit live chats after cursor, in chat id order
+    """
+    try:
+        query = SESSION.query(Chats.chat_id).filter(Chats.chat_id.notin_(SESSION.query(DeadChats.chat_id)))
+        if cursor is not None:
+            query = query.filter(Chats.chat_id > cursor)
+        return [chat_id for chat_id, in query.order_by(Chats.chat_id).limit(limit)]
+    finally:
+        SESSION.close()
+
+
+def record_batch(broadcast_id, chat_ids, errors, dead_chats):
+    """
+    Save the chats a batch failed to send to, and move the broadcast's cursor past them, in one transaction.
+
+    :param chat_ids: the chats which were sent to, in chat id order
+    :param errors: chat_id -> error message, for the chats which failed
+    :param dead_chats: chat_id -> reason, for the chats which should be skipped from now on
+    """
+    with BROADCAST_LOCK, DEAD_CHATS_LOCK:
+        broadcast = SESSION.query(Broadcasts).get(broadcast_id)
+        for chat_id, error in errors.items():
+            SESSION.merge(BroadcastOutcomes(broadcast_id, chat_id, error))
+        for chat_id, reason in dead_chats.items():
+            SESSION.merge(DeadChats(chat_id, reason))
+
+        broadcast.cursor = chat_ids[-1]
+        broadcast.sent += len(chat_ids) - len(errors)
+        broadcast.failed += len(errors)
+        SESSION.commit()
+        DEAD_CHATS.update(int(chat_id) for chat_id in dead_chats)
+
+
+def set_broadcast_error(broadcast_id, error):
+    """
+    Record why a broadcast stopped early; it stays unfinished, so it is picked up again on the next restart.
+    Pass None to clear it once the broadcast is running again.
+    """
+    with BROADCAST_LOCK:
+        broadcast = SESSION.query(Broadcasts).get(broadcast_id)
+        if broadcast:
+            broadcast.error = error
+        SESSION.commit()
+
+
+def finish_broadcast(broadcast_id):
+    with BROADCAST_LOCK:
+        broadcast = SESSION.query(Broadcasts).get(broadcast_id)
+        if broadcast:
+            broadcast.done = True
+        # rows for chats which were sent to, left by broadcasts started before only failures were kept
+        SESSION.query(BroadcastOutcomes).filter(BroadcastOutcomes.broadcast_id == broadcast_id,
+                                                BroadcastOutcomes.error.is_(None)).delete(synchronize_session=False)
+        SESSION.commit()
+
+
+def is_chat_dead(chat_id):
+    return int(chat_id) in DEAD_CHATS
+
+
+def revive_chat(chat_id):
+    """
+    Stop skipping a chat, eg because the bot was added back to it.
+    """
+    with DEAD_CHATS_LOCK:
+        chat = SESSION.query(DeadChats).get(int(chat_id))
+        if chat:
+            SESSION.delete(chat)
+        SESSION.commit()
+        DEAD_CHATS.discard(int(chat_id))
+
+
+def num_dead_chats():
+    return len(DEAD_CHATS)
+
+
+def __load_dead_chats():
+    global DEAD_CHATS
+    try:
+        DEAD_CHATS = {chat_id for chat_id, in SESSION.query(DeadChats.chat_id)}
+    finally:
+        SESSION.close()
+
+
+def migrate_chat(old_chat_id, new_chat_id):
+    with DEAD_CHATS_LOCK:
+        chat = SESSION.query(DeadChats).get(int(old_chat_id))
+        if chat:
+            chat.chat_id = int(new_chat_id)
+        SESSION.commit()
+
+        if int(old_chat_id) in DEAD_CHATS:
+            DEAD_CHATS.discard(int(old_chat_id))
+            DEAD_CHATS.add(int(new_chat_id))
+
+
+# Create in memory set of dead chats to avoid disk access
+__load_dead_chats()
@@ -1,13 +1,12 @@
-import threading
-
-from sqlalchemy import Column, String, UnicodeText, Boolean, Integer, distinct, func
+from sqlalchemy import Column, BigInteger, UnicodeText, Boolean, Integer, Index, distinct, func
 
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import BASE, SESSION
 
 
 class CustomFilters(BASE):
     __tablename__ = "cust_filters"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     keyword = Column(UnicodeText, primary_key=True, nullable=False)
     reply = Column(UnicodeText, nullable=False)
     is_sticker = Column(Boolean, nullable=False, default=False)
@@ -23,7 +22,7 @@ class CustomFilters(BASE):
 
     def __init__(self, chat_id, keyword, reply, is_sticker=False, is_document=False, is_image=False, is_audio=False,
                  is_voice=False, is_video=False, has_buttons=False):
-        self.chat_id = str(chat_id)  # ensure string
+        self.chat_id = int(chat_id)
         self.keyword = keyword
         self.reply = reply
         self.is_sticker = is_sticker
@@ -47,14 +46,16 @@ class CustomFilters(BASE):
 class Buttons(BASE):
     __tablename__ = "cust_filter_urls"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     keyword = Column(UnicodeText, primary_key=True)
     name = Column(UnicodeText, nullable=False)
     url = Column(UnicodeText, nullable=False)
     same_line = Column(Boolean, default=False)
+    # buttons are always looked up by chat (and filter); the primary key starts with id, so can't be used for that
+    __table_args__ = (Index("ix_cust_filter_urls_chat_id_keyword", "chat_id", "keyword"),)
 
     def __init__(self, chat_id, keyword, name, url, same_line=False):
-        self.chat_id = str(chat_id)
+        self.chat_id = int(chat_id)
         self.keyword = keyword
         self.name = name
         self.url = url
@@ -64,8 +65,15 @@ class Buttons(BASE):
 CustomFilters.__table__.create(checkfirst=True)
 Buttons.__table__.create(checkfirst=True)
 
-CUST_FILT_LOCK = threading.RLock()
-BUTTON_LOCK = threading.RLock()
+CUST_FILT_LOCK = StripedLock()
+BUTTON_LOCK = StripedLock()
+
+# In memory copies of each chat's filters and buttons, to avoid hitting the db on every message.
+# chat_id -> list of filters, sorted longest keyword first
+CHAT_FILTERS = {}
+NO_FILTERS = ()  # returned for every chat without filters, so callers can tell nothing changed
+# chat_id -> {keyword: list of buttons}
+CHAT_BUTTONS = {}
 
 
 def get_all_filters():
@@ -80,62 +88,61 @@ def add_filter(chat_id, keyword, reply, is_sticker=False, is_document=False, is_
     if buttons is None:
         buttons = []
 
-    with CUST_FILT_LOCK:
-        prev = SESSION.query(CustomFilters).get((str(chat_id), keyword))
+    with CUST_FILT_LOCK[chat_id]:
+        prev = SESSION.query(CustomFilters).get((int(chat_id), keyword))
         if prev:
-            with BUTTON_LOCK:
-                prev_buttons = SESSION.query(Buttons).filter(Buttons.chat_id == str(chat_id),
+            with BUTTON_LOCK[chat_id]:
+                prev_buttons = SESSION.query(Buttons).filter(Buttons.chat_id == int(chat_id),
                                                              Buttons.keyword == keyword).all()
                 for btn in prev_buttons:
                     SESSION.delete(btn)
             SESSION.delete(prev)
 
-        filt = CustomFilters(str(chat_id), keyword, reply, is_sticker, is_document, is_image, is_audio, is_voice,
+        filt = CustomFilters(int(chat_id), keyword, reply, is_sticker, is_document, is_image, is_audio, is_voice,
                              is_video, bool(buttons))
 
         SESSION.add(filt)
-        SESSION.commit()
 
-    for b_name, url, same_line in buttons:
-        add_note_button_to_db(chat_id, keyword, b_name, url, same_line)
+        with BUTTON_LOCK[chat_id]:
+            for b_name, url, same_line in buttons:
+                SESSION.add(Buttons(chat_id, keyword, b_name, url, same_line))
+
+        SESSION.commit()
+        __load_chat_filters(chat_id)
 
 
 def remove_filter(chat_id, keyword):
-    with CUST_FILT_LOCK:
-        filt = SESSION.query(CustomFilters).get((str(chat_id), keyword))
+    with CUST_FILT_LOCK[chat_id]:
+        filt = SESSION.query(CustomFilters).get((int(chat_id), keyword))
         if filt:
-            with BUTTON_LOCK:
-                prev_buttons = SESSION.query(Buttons).filter(Buttons.chat_id == str(chat_id),
+            with BUTTON_LOCK[chat_id]:
+                prev_buttons = SESSION.query(Buttons).filter(Buttons.chat_id == int(chat_id),
                                                              Buttons.keyword == keyword).all()
                 for btn in prev_buttons:
                     SESSION.delete(btn)
             SESSION.delete(filt)
             SESSION.commit()
+            __load_chat_filters(chat_id)
             return True
         SESSION.close()
         return False
 
 
 def get_chat_filters(chat_id):
-    try:
-        return SESSION.query(CustomFilters).filter(CustomFilters.chat_id == str(chat_id)).order_by(
-            func.length(CustomFilters.keyword).desc()).order_by(CustomFilters.keyword.asc()).all()
-    finally:
-        SESSION.close()
+    # NOTE: the returned list is shared with the cache - don't modify it.
+    return CHAT_FILTERS.get(int(chat_id), NO_FILTERS)
 
 
 def add_note_button_to_db(chat_id, keyword, b_name, url, same_line):
-    with BUTTON_LOCK:
+    with CUST_FILT_LOCK[chat_id], BUTTON_LOCK[chat_id]:
         button = Buttons(chat_id, keyword, b_name, url, same_line)
         SESSION.add(button)
         SESSION.commit()
+        __load_chat_filters(chat_id)
 
 
 def get_buttons(chat_id, keyword):
-    try:
-        return SESSION.query(Buttons).filter(Buttons.chat_id == str(chat_id), Buttons.keyword == keyword).all()
-    finally:
-        SESSION.close()
+    return CHAT_BUTTONS.get(int(chat_id), {}).get(keyword, [])
 
 
 def num_filters():
@@ -153,14 +160,69 @@ def num_chats():
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with CUST_FILT_LOCK:
-        chat_filters = SESSION.query(CustomFilters).filter(CustomFilters.chat_id == str(old_chat_id)).all()
+    with CUST_FILT_LOCK.many(old_chat_id, new_chat_id):
+        chat_filters = SESSION.query(CustomFilters).filter(CustomFilters.chat_id == int(old_chat_id)).all()
         for filt in chat_filters:
-            filt.chat_id = str(new_chat_id)
+            filt.chat_id = int(new_chat_id)
         SESSION.commit()
 
-        with BUTTON_LOCK:
-            chat_buttons = SESSION.query(Buttons).filter(Buttons.chat_id == str(old_chat_id)).all()
+        with BUTTON_LOCK.many(old_chat_id, new_chat_id):
+            chat_buttons = SESSION.query(Buttons).filter(Buttons.chat_id == int(old_chat_id)).all()
             for btn in chat_buttons:
-                btn.chat_id = str(new_chat_id)
+                btn.chat_id = int(new_chat_id)
             SESSION.commit()
+
+        __load_chat_filters(old_chat_id)
+        __load_chat_filters(new_chat_id)
+
+
+def __sort_filters(chat_filters):
+    # longest keywords first, so that the most specific filter wins
+    return sorted(chat_filters, key=lambda filt: (-len(filt.keyword), filt.keyword))
+
+
+def __load_chat_filters(chat_id):
+    chat_id = int(chat_id)
+    try:
+        chat_filters = SESSION.query(CustomFilters).filter(CustomFilters.chat_id == chat_id).all()
+        chat_buttons = SESSION.query(Buttons).filter(Buttons.chat_id == chat_id).order_by(Buttons.id.asc()).all()
+    finally:
+        SESSION.close()
+
+    buttons = {}
+    for btn in chat_buttons:
+        buttons.setdefault(btn.keyword, []).append(btn)
+
+    # swap in whole new objects so readers never see a half-built list
+    if chat_filters:
+        CHAT_FILTERS[chat_id] = __sort_filters(chat_filters)
+    else:
+        CHAT_FILTERS.pop(chat_id, None)
+
+    if buttons:
+        CHAT_BUTTONS[chat_id] = buttons
+    else:
+        CHAT_BUTTONS.pop(chat_id, None)
+
+
+def __load_all_filters():
+    global CHAT_FILTERS, CHAT_BUTTONS
+    try:
+        all_buttons = SESSION.query(Buttons).order_by(Buttons.id.asc()).all()
+    finally:
+        SESSION.close()
+
+    chat_filters = {}
+    for filt in get_all_filters():
+        chat_filters.setdefault(filt.chat_id, []).append(filt)
+
+    chat_buttons = {}
+    for btn in all_buttons:
+        chat_buttons.setdefault(btn.chat_id, {}).setdefault(btn.keyword, []).append(btn)
+
+    CHAT_FILTERS = {chat_id: __sort_filters(filts) for chat_id, filts in chat_filters.items()}
+    CHAT_BUTTONS = chat_buttons
+
+
+# Create in memory filter cache to avoid disk access
+__load_all_filters()
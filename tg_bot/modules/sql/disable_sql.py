@@ -1,16 +1,15 @@
-import threading
-
-from sqlalchemy import Column, String, UnicodeText, func, distinct
+from sqlalchemy import Column, BigInteger, UnicodeText, func, distinct
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import SESSION, BASE
 
 
 class Disable(BASE):
     __tablename__ = "disabled_commands"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     command = Column(UnicodeText, primary_key=True)
 
     def __init__(self, chat_id, command):
-        self.chat_id = chat_id
+        self.chat_id = int(chat_id)
         self.command = command
 
     def __repr__(self):
@@ -18,17 +17,21 @@ class Disable(BASE):
 
 
 Disable.__table__.create(checkfirst=True)
-DISABLE_INSERTION_LOCK = threading.RLock()
+DISABLE_INSERTION_LOCK = StripedLock()
+
+# chat_id -> frozenset of disabled commands; checked for every command and every regex handler match
+DISABLED = {}
 
 
 def disable_command(chat_id, disable):
-    with DISABLE_INSERTION_LOCK:
-        disabled = SESSION.query(Disable).get((str(chat_id), disable))
+    with DISABLE_INSERTION_LOCK[chat_id]:
+        disabled = SESSION.query(Disable).get((int(chat_id), disable))
 
         if not disabled:
-            disabled = Disable(str(chat_id), disable)
+            disabled = Disable(int(chat_id), disable)
             SESSION.add(disabled)
             SESSION.commit()
+            DISABLED[int(chat_id)] = DISABLED.get(int(chat_id), frozenset()) | {disable}
             return True
 
         SESSION.close()
@@ -36,12 +39,13 @@ def disable_command(chat_id, disable):
 
 
 def enable_command(chat_id, enable):
-    with DISABLE_INSERTION_LOCK:
-        disabled = SESSION.query(Disable).get((str(chat_id), enable))
+    with DISABLE_INSERTION_LOCK[chat_id]:
+        disabled = SESSION.query(Disable).get((int(chat_id), enable))
 
         if disabled:
             SESSION.delete(disabled)
             SESSION.commit()
+            DISABLED[int(chat_id)] = DISABLED.get(int(chat_id), frozenset()) - {enable}
             return True
 
         SESSION.close()
@@ -49,15 +53,16 @@ def enable_command(chat_id, enable):
 
 
 def is_command_disabled(chat_id, cmd):
-    try:
-        return bool(SESSION.query(Disable).get((str(chat_id), cmd)))
-    finally:
-        SESSION.close()
+    return cmd in DISABLED.get(int(chat_id), ())
+
+
+def get_disabled_commands(chat_id):
+    return DISABLED.get(int(chat_id), frozenset())
 
 
 def get_all_disabled(chat_id):
     try:
-        return SESSION.query(Disable).filter(Disable.chat_id == str(chat_id)).all()
+        return SESSION.query(Disable).filter(Disable.chat_id == int(chat_id)).all()
     finally:
         SESSION.close()
 
@@ -77,10 +82,29 @@ def num_disabled():
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with DISABLE_INSERTION_LOCK:
-        chat = SESSION.query(Disable).get(str(old_chat_id))
-        if chat:
-            chat.chat_id = str(new_chat_id)
+    with DISABLE_INSERTION_LOCK.many(old_chat_id, new_chat_id):
+        chats = SESSION.query(Disable).filter(Disable.chat_id == int(old_chat_id)).all()
+        for chat in chats:
+            chat.chat_id = int(new_chat_id)
             SESSION.add(chat)
 
         SESSION.commit()
+
+        if int(old_chat_id) in DISABLED:
+            DISABLED[int(new_chat_id)] = DISABLED.pop(int(old_chat_id))
+
+
+def __load_disabled_commands():
+    global DISABLED
+    try:
+        all_chats = {}
+        for chat_id, command in SESSION.query(Disable.chat_id, Disable.command):
+            all_chats.setdefault(chat_id, set()).add(command)
+
+        DISABLED = {chat_id: frozenset(commands) for chat_id, commands in all_chats.items()}
+    finally:
+        SESSION.close()
+
+
+# Create in memory disabled commands to avoid disk access
+__load_disabled_commands()
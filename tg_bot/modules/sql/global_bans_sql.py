@@ -1,8 +1,8 @@
-import threading
-
-from sqlalchemy import Column, UnicodeText, Integer, String, Boolean
+from sqlalchemy import Column, UnicodeText, Integer, BigInteger, Boolean, or_
 
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import BASE, SESSION
+from tg_bot.modules.sql.users_sql import Chats
 
 
 class GloballyBannedUsers(BASE):
@@ -27,11 +27,11 @@ class GloballyBannedUsers(BASE):
 
 class GbanSettings(BASE):
     __tablename__ = "gban_settings"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     setting = Column(Boolean, default=True, nullable=False)
 
     def __init__(self, chat_id, enabled):
-        self.chat_id = str(chat_id)
+        self.chat_id = int(chat_id)
         self.setting = enabled
 
     def __repr__(self):
@@ -41,13 +41,14 @@ class GbanSettings(BASE):
 GloballyBannedUsers.__table__.create(checkfirst=True)
 GbanSettings.__table__.create(checkfirst=True)
 
-GBANNED_USERS_LOCK = threading.RLock()
-GBAN_SETTING_LOCK = threading.RLock()
-GBANNED_LIST = []
+GBANNED_USERS_LOCK = StripedLock()
+GBAN_SETTING_LOCK = StripedLock()
+GBANNED_SET = set()
+GBANSTAT_DISABLED = set()  # ids of chats which have disabled gbans
 
 
 def gban_user(user_id, name, reason=None):
-    with GBANNED_USERS_LOCK:
+    with GBANNED_USERS_LOCK[user_id]:
         user = SESSION.query(GloballyBannedUsers).get(user_id)
         if not user:
             user = GloballyBannedUsers(user_id, name, reason)
@@ -57,21 +58,21 @@ def gban_user(user_id, name, reason=None):
 
         SESSION.merge(user)
         SESSION.commit()
-        __load_gbanned_userid_list()
+        GBANNED_SET.add(int(user_id))
 
 
 def ungban_user(user_id):
-    with GBANNED_USERS_LOCK:
+    with GBANNED_USERS_LOCK[user_id]:
         user = SESSION.query(GloballyBannedUsers).get(user_id)
         if user:
             SESSION.delete(user)
 
         SESSION.commit()
-        __load_gbanned_userid_list()
+        GBANNED_SET.discard(int(user_id))
 
 
 def is_user_gbanned(user_id):
-    return user_id in GBANNED_LIST
+    return user_id in GBANNED_SET
 
 
 def get_gbanned_user(user_id):
@@ -89,56 +90,80 @@ def get_gban_list():
 
 
 def enable_gbans(chat_id):
-    with GBAN_SETTING_LOCK:
-        chat = SESSION.query(GbanSettings).get(str(chat_id))
+    with GBAN_SETTING_LOCK[chat_id]:
+        chat = SESSION.query(GbanSettings).get(int(chat_id))
         if not chat:
             chat = GbanSettings(chat_id, True)
 
         chat.setting = True
         SESSION.add(chat)
         SESSION.commit()
+        GBANSTAT_DISABLED.discard(int(chat_id))
 
 
 def disable_gbans(chat_id):
-    with GBAN_SETTING_LOCK:
-        chat = SESSION.query(GbanSettings).get(str(chat_id))
+    with GBAN_SETTING_LOCK[chat_id]:
+        chat = SESSION.query(GbanSettings).get(int(chat_id))
         if not chat:
             chat = GbanSettings(chat_id, False)
 
         chat.setting = False
         SESSION.add(chat)
         SESSION.commit()
+        GBANSTAT_DISABLED.add(int(chat_id))
 
 
 def does_chat_gban(chat_id):
+    return int(chat_id) not in GBANSTAT_DISABLED
+
+
+def get_gban_chat_ids():
+    """
+    :return: the ids of all known chats which haven't disabled gbans, in a single query
+    """
     try:
-        chat = SESSION.query(GbanSettings).get(str(chat_id))
-        return bool(not chat or chat.setting)
+        return [chat_id for chat_id, in SESSION.query(Chats.chat_id)
+                .outerjoin(GbanSettings, GbanSettings.chat_id == Chats.chat_id)
+                .filter(or_(GbanSettings.setting.is_(None), GbanSettings.setting.is_(True)))]
     finally:
         SESSION.close()
 
 
 def num_gbanned_users():
-    return len(GBANNED_LIST)
+    return len(GBANNED_SET)
 
 
 def __load_gbanned_userid_list():
-    global GBANNED_LIST
+    global GBANNED_SET
     try:
-        GBANNED_LIST = [x.user_id for x in SESSION.query(GloballyBannedUsers).all()]
+        GBANNED_SET = {user_id for user_id, in SESSION.query(GloballyBannedUsers.user_id)}
+    finally:
+        SESSION.close()
+
+
+def __load_gban_stat_list():
+    global GBANSTAT_DISABLED
+    try:
+        GBANSTAT_DISABLED = {chat_id for chat_id, in SESSION.query(GbanSettings.chat_id)
+                             .filter(GbanSettings.setting.is_(False))}
     finally:
         SESSION.close()
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with GBAN_SETTING_LOCK:
-        chat = SESSION.query(GbanSettings).get(str(old_chat_id))
+    with GBAN_SETTING_LOCK.many(old_chat_id, new_chat_id):
+        chat = SESSION.query(GbanSettings).get(int(old_chat_id))
         if chat:
-            chat.chat_id = new_chat_id
+            chat.chat_id = int(new_chat_id)
             SESSION.add(chat)
 
         SESSION.commit()
 
+        if int(old_chat_id) in GBANSTAT_DISABLED:
+            GBANSTAT_DISABLED.discard(int(old_chat_id))
+            GBANSTAT_DISABLED.add(int(new_chat_id))
+
 
-# Create in memory userid to avoid disk access
+# Create in memory userid and chat settings to avoid disk access
 __load_gbanned_userid_list()
+__load_gban_stat_list()
@@ -1,14 +1,13 @@
 # New chat added -> setup permissions
-import threading
-
-from sqlalchemy import Column, String, Boolean
+from sqlalchemy import Column, BigInteger, Boolean
 
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import SESSION, BASE
 
 
 class Permissions(BASE):
     __tablename__ = "permissions"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     # Booleans are for "is this locked", _NOT_ "is this allowed"
     audio = Column(Boolean, default=False)
     voice = Column(Boolean, default=False)
@@ -22,7 +21,7 @@ class Permissions(BASE):
     bots = Column(Boolean, default=False)
 
     def __init__(self, chat_id):
-        self.chat_id = str(chat_id)  # ensure string
+        self.chat_id = int(chat_id)
         self.audio = False
         self.voice = False
         self.contact = False
@@ -40,7 +39,7 @@ class Permissions(BASE):
 
 class Restrictions(BASE):
     __tablename__ = "restrictions"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     # Booleans are for "is this restricted", _NOT_ "is this allowed"
     messages = Column(Boolean, default=False)
     media = Column(Boolean, default=False)
@@ -48,7 +47,7 @@ class Restrictions(BASE):
     preview = Column(Boolean, default=False)
 
     def __init__(self, chat_id):
-        self.chat_id = str(chat_id)  # ensure string
+        self.chat_id = int(chat_id)
         self.messages = False
         self.media = False
         self.other = False
@@ -62,35 +61,53 @@ Permissions.__table__.create(checkfirst=True)
 Restrictions.__table__.create(checkfirst=True)
 
 
-PERM_LOCK = threading.RLock()
-RESTR_LOCK = threading.RLock()
+PERM_LOCK = StripedLock()
+RESTR_LOCK = StripedLock()
+
+# Every chat's locks and restrictions are kept in memory as a single int each, one bit per lock type.
+LOCK_BITS = {lock_type: 1 << index for index, lock_type in enumerate(
+    ("audio", "voice", "contact", "video", "document", "photo", "sticker", "gif", "url", "bots"))}
+RESTR_BITS = {restr_type: 1 << index for index, restr_type in enumerate(("messages", "media", "other", "previews"))}
+RESTR_BITS["all"] = sum(RESTR_BITS.values())
+RESTR_COLUMNS = {"messages": "messages", "media": "media", "other": "other", "previews": "preview"}
+
+CHAT_LOCKS = {}  # chat_id -> lock bitmask
+CHAT_RESTRICTIONS = {}  # chat_id -> restriction bitmask
+
+
+def __perm_to_bits(perm):
+    return sum(bit for lock_type, bit in LOCK_BITS.items() if getattr(perm, lock_type))
+
+
+def __restr_to_bits(restr):
+    return sum(RESTR_BITS[restr_type] for restr_type, column in RESTR_COLUMNS.items() if getattr(restr, column))
 
 
 def init_permissions(chat_id, reset=False):
-    curr_perm = SESSION.query(Permissions).get(str(chat_id))
+    curr_perm = SESSION.query(Permissions).get(int(chat_id))
     if reset:
         SESSION.delete(curr_perm)
         SESSION.flush()
-    perm = Permissions(str(chat_id))
+    perm = Permissions(int(chat_id))
     SESSION.add(perm)
     SESSION.commit()
     return perm
 
 
 def init_restrictions(chat_id, reset=False):
-    curr_restr = SESSION.query(Restrictions).get(str(chat_id))
+    curr_restr = SESSION.query(Restrictions).get(int(chat_id))
     if reset:
         SESSION.delete(curr_restr)
         SESSION.flush()
-    restr = Restrictions(str(chat_id))
+    restr = Restrictions(int(chat_id))
     SESSION.add(restr)
     SESSION.commit()
     return restr
 
 
 def update_lock(chat_id, lock_type, locked):
-    with PERM_LOCK:
-        curr_perm = SESSION.query(Permissions).get(str(chat_id))
+    with PERM_LOCK[chat_id]:
+        curr_perm = SESSION.query(Permissions).get(int(chat_id))
         if not curr_perm:
             curr_perm = init_permissions(chat_id)
 
@@ -115,13 +132,15 @@ def update_lock(chat_id, lock_type, locked):
         elif lock_type == 'bots':
             curr_perm.bots = locked
 
+        bits = __perm_to_bits(curr_perm)
         SESSION.add(curr_perm)
         SESSION.commit()
+        CHAT_LOCKS[int(chat_id)] = bits
 
 
 def update_restriction(chat_id, restr_type, locked):
-    with RESTR_LOCK:
-        curr_restr = SESSION.query(Restrictions).get(str(chat_id))
+    with RESTR_LOCK[chat_id]:
+        curr_restr = SESSION.query(Restrictions).get(int(chat_id))
         if not curr_restr:
             curr_restr = init_restrictions(chat_id)
 
@@ -138,81 +157,70 @@ def update_restriction(chat_id, restr_type, locked):
             curr_restr.media = locked
             curr_restr.other = locked
             curr_restr.preview = locked
+
+        bits = __restr_to_bits(curr_restr)
         SESSION.add(curr_restr)
         SESSION.commit()
+        CHAT_RESTRICTIONS[int(chat_id)] = bits
 
 
 def is_locked(chat_id, lock_type):
-    curr_perm = SESSION.query(Permissions).get(str(chat_id))
-    SESSION.close()
-
-    if not curr_perm:
-        return False
-
-    elif lock_type == "sticker":
-        return curr_perm.sticker
-    elif lock_type == "photo":
-        return curr_perm.photo
-    elif lock_type == "audio":
-        return curr_perm.audio
-    elif lock_type == "voice":
-        return curr_perm.voice
-    elif lock_type == "contact":
-        return curr_perm.contact
-    elif lock_type == "video":
-        return curr_perm.video
-    elif lock_type == "document":
-        return curr_perm.document
-    elif lock_type == "gif":
-        return curr_perm.gif
-    elif lock_type == "url":
-        return curr_perm.url
-    elif lock_type == "bots":
-        return curr_perm.bots
+    return bool(CHAT_LOCKS.get(int(chat_id), 0) & LOCK_BITS.get(lock_type, 0))
 
 
 def is_restr_locked(chat_id, lock_type):
-    curr_restr = SESSION.query(Restrictions).get(str(chat_id))
-    SESSION.close()
+    bit = RESTR_BITS.get(lock_type, 0)
+    return bool(bit) and CHAT_RESTRICTIONS.get(int(chat_id), 0) & bit == bit
+
 
-    if not curr_restr:
-        return False
+def get_lock_bits(chat_id):
+    return CHAT_LOCKS.get(int(chat_id), 0)
 
-    if lock_type == "messages":
-        return curr_restr.messages
-    elif lock_type == "media":
-        return curr_restr.media
-    elif lock_type == "other":
-        return curr_restr.other
-    elif lock_type == "previews":
-        return curr_restr.preview
-    elif lock_type == "all":
-        return curr_restr.messages and curr_restr.media and curr_restr.other and curr_restr.preview
+
+def get_restr_bits(chat_id):
+    return CHAT_RESTRICTIONS.get(int(chat_id), 0)
 
 
 def get_locks(chat_id):
     try:
-        return SESSION.query(Permissions).get(str(chat_id))
+        return SESSION.query(Permissions).get(int(chat_id))
     finally:
         SESSION.close()
 
 
-def get_restr(chat_id):
+def get_reint(chat_id):
     try:
-        return SESSION.query(Restrictions).get(str(chat_id))
+        return SESSION.query(Restrictions).get(int(chat_id))
     finally:
         SESSION.close()
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with PERM_LOCK:
-        perms = SESSION.query(Permissions).get(str(old_chat_id))
+    with PERM_LOCK.many(old_chat_id, new_chat_id):
+        perms = SESSION.query(Permissions).get(int(old_chat_id))
         if perms:
-            perms.chat_id = str(new_chat_id)
+            perms.chat_id = int(new_chat_id)
         SESSION.commit()
+        if int(old_chat_id) in CHAT_LOCKS:
+            CHAT_LOCKS[int(new_chat_id)] = CHAT_LOCKS.pop(int(old_chat_id))
 
-    with RESTR_LOCK:
-        rest = SESSION.query(Restrictions).get(str(old_chat_id))
+    with RESTR_LOCK.many(old_chat_id, new_chat_id):
+        rest = SESSION.query(Restrictions).get(int(old_chat_id))
         if rest:
-            rest.chat_id = str(new_chat_id)
+            rest.chat_id = int(new_chat_id)
         SESSION.commit()
+        if int(old_chat_id) in CHAT_RESTRICTIONS:
+            CHAT_RESTRICTIONS[int(new_chat_id)] = CHAT_RESTRICTIONS.pop(int(old_chat_id))
+
+
+def __load_chat_locks():
+    global CHAT_LOCKS, CHAT_RESTRICTIONS
+    try:
+        CHAT_LOCKS = {perm.chat_id: __perm_to_bits(perm) for perm in SESSION.query(Permissions).all()}
+        CHAT_RESTRICTIONS = {restr.chat_id: __restr_to_bits(restr) for restr in SESSION.query(Restrictions).all()}
+    finally:
+        SESSION.close()
+
+
+# Create in memory lock bitmasks to avoid disk access
+__load_chat_locks()
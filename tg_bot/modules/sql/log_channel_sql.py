@@ -1,28 +1,27 @@
-import threading
-
-from sqlalchemy import Column, String, func, distinct
+from sqlalchemy import Column, BigInteger, func, distinct
 
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import BASE, SESSION
 
 
 class GroupLogs(BASE):
     __tablename__ = "log_channels"
-    chat_id = Column(String(14), primary_key=True)
-    log_channel = Column(String(14), nullable=False)
+    chat_id = Column(BigInteger, primary_key=True)
+    log_channel = Column(BigInteger, nullable=False)
 
     def __init__(self, chat_id, log_channel):
-        self.chat_id = str(chat_id)
-        self.log_channel = str(log_channel)
+        self.chat_id = int(chat_id)
+        self.log_channel = int(log_channel)
 
 
 GroupLogs.__table__.create(checkfirst=True)
 
-LOGS_INSERTION_LOCK = threading.RLock()
+LOGS_INSERTION_LOCK = StripedLock()
 
 
 def set_chat_log_channel(chat_id, log_channel):
-    with LOGS_INSERTION_LOCK:
-        res = SESSION.query(GroupLogs).get(str(chat_id))
+    with LOGS_INSERTION_LOCK[chat_id]:
+        res = SESSION.query(GroupLogs).get(int(chat_id))
         if res:
             res.log_channel = log_channel
         else:
@@ -34,7 +33,7 @@ def set_chat_log_channel(chat_id, log_channel):
 
 def get_chat_log_group(chat_id):
     try:
-        res = SESSION.query(GroupLogs).get(str(chat_id))
+        res = SESSION.query(GroupLogs).get(int(chat_id))
         if res:
             return res.log_channel
         return None
@@ -43,8 +42,8 @@ def get_chat_log_group(chat_id):
 
 
 def stop_chat_logging(chat_id):
-    with LOGS_INSERTION_LOCK:
-        res = SESSION.query(GroupLogs).get(str(chat_id))
+    with LOGS_INSERTION_LOCK[chat_id]:
+        res = SESSION.query(GroupLogs).get(int(chat_id))
         if res:
             log_channel = res.log_channel
             SESSION.delete(res)
@@ -53,10 +52,10 @@ def stop_chat_logging(chat_id):
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with LOGS_INSERTION_LOCK:
-        chat = SESSION.query(GroupLogs).get(str(old_chat_id))
+    with LOGS_INSERTION_LOCK.many(old_chat_id, new_chat_id):
+        chat = SESSION.query(GroupLogs).get(int(old_chat_id))
         if chat:
-            chat.chat_id = str(new_chat_id)
+            chat.chat_id = int(new_chat_id)
             SESSION.add(chat)
 
         SESSION.commit()
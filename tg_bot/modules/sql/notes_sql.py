@@ -1,21 +1,19 @@
-# Note: chat_id's are stored as strings because the int is too large to be stored in a PSQL database.
-import threading
-
-from sqlalchemy import Column, String, Boolean, UnicodeText, Integer, func, distinct
+from sqlalchemy import Column, BigInteger, Boolean, UnicodeText, Integer, Index, func, distinct
 
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import SESSION, BASE
 
 
 class Notes(BASE):
     __tablename__ = "notes"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     name = Column(UnicodeText, primary_key=True)
     value = Column(UnicodeText, nullable=False)
     is_reply = Column(Boolean, default=False)
     has_buttons = Column(Boolean, default=False)
 
     def __init__(self, chat_id, name, value, is_reply=False, has_buttons=False):
-        self.chat_id = str(chat_id)  # ensure string
+        self.chat_id = int(chat_id)
         self.name = name
         self.value = value
         self.is_reply = is_reply
@@ -28,14 +26,16 @@ class Notes(BASE):
 class Buttons(BASE):
     __tablename__ = "note_urls"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     note_name = Column(UnicodeText, primary_key=True)
     name = Column(UnicodeText, nullable=False)
     url = Column(UnicodeText, nullable=False)
     same_line = Column(Boolean, default=False)
+    # buttons are always looked up by chat (and note); the primary key starts with id, so can't be used for that
+    __table_args__ = (Index("ix_note_urls_chat_id_note_name", "chat_id", "note_name"),)
 
     def __init__(self, chat_id, note_name, name, url, same_line=False):
-        self.chat_id = str(chat_id)
+        self.chat_id = int(chat_id)
         self.note_name = note_name
         self.name = name
         self.url = url
@@ -45,24 +45,24 @@ class Buttons(BASE):
 Notes.__table__.create(checkfirst=True)
 Buttons.__table__.create(checkfirst=True)
 
-NOTES_INSERTION_LOCK = threading.RLock()
-BUTTONS_INSERTION_LOCK = threading.RLock()
+NOTES_INSERTION_LOCK = StripedLock()
+BUTTONS_INSERTION_LOCK = StripedLock()
 
 
 def add_note_to_db(chat_id, note_name, note_data, is_reply=False, buttons=None):
     if not buttons:
         buttons = []
 
-    with NOTES_INSERTION_LOCK:
-        prev = SESSION.query(Notes).get((str(chat_id), note_name))
+    with NOTES_INSERTION_LOCK[chat_id]:
+        prev = SESSION.query(Notes).get((int(chat_id), note_name))
         if prev:
-            with BUTTONS_INSERTION_LOCK:
-                prev_buttons = SESSION.query(Buttons).filter(Buttons.chat_id == str(chat_id),
+            with BUTTONS_INSERTION_LOCK[chat_id]:
+                prev_buttons = SESSION.query(Buttons).filter(Buttons.chat_id == int(chat_id),
                                                              Buttons.note_name == note_name).all()
                 for btn in prev_buttons:
                     SESSION.delete(btn)
             SESSION.delete(prev)
-        note = Notes(str(chat_id), note_name, note_data, is_reply=is_reply, has_buttons=bool(buttons))
+        note = Notes(int(chat_id), note_name, note_data, is_reply=is_reply, has_buttons=bool(buttons))
 
         SESSION.add(note)
         SESSION.commit()
@@ -73,17 +73,17 @@ def add_note_to_db(chat_id, note_name, note_data, is_reply=False, buttons=None):
 
 def get_note(chat_id, note_name):
     try:
-        return SESSION.query(Notes).get((str(chat_id), note_name))
+        return SESSION.query(Notes).get((int(chat_id), note_name))
     finally:
         SESSION.close()
 
 
 def rm_note(chat_id, note_name):
-    with NOTES_INSERTION_LOCK:
-        note = SESSION.query(Notes).get((str(chat_id), note_name))
+    with NOTES_INSERTION_LOCK[chat_id]:
+        note = SESSION.query(Notes).get((int(chat_id), note_name))
         if note:
-            with BUTTONS_INSERTION_LOCK:
-                buttons = SESSION.query(Buttons).filter(Buttons.chat_id == str(chat_id),
+            with BUTTONS_INSERTION_LOCK[chat_id]:
+                buttons = SESSION.query(Buttons).filter(Buttons.chat_id == int(chat_id),
                                                         Buttons.note_name == note_name).all()
                 for btn in buttons:
                     SESSION.delete(btn)
@@ -97,13 +97,13 @@ def rm_note(chat_id, note_name):
 
 def get_all_chat_notes(chat_id):
     try:
-        return SESSION.query(Notes).filter(Notes.chat_id == str(chat_id)).order_by(Notes.name.asc()).all()
+        return SESSION.query(Notes).filter(Notes.chat_id == int(chat_id)).order_by(Notes.name.asc()).all()
     finally:
         SESSION.close()
 
 
 def add_note_button_to_db(chat_id, note_name, b_name, url, same_line):
-    with BUTTONS_INSERTION_LOCK:
+    with BUTTONS_INSERTION_LOCK[chat_id]:
         button = Buttons(chat_id, note_name, b_name, url, same_line)
         SESSION.add(button)
         SESSION.commit()
@@ -111,7 +111,7 @@ def add_note_button_to_db(chat_id, note_name, b_name, url, same_line):
 
 def get_buttons(chat_id, note_name):
     try:
-        return SESSION.query(Buttons).filter(Buttons.chat_id == str(chat_id), Buttons.note_name == note_name).all()
+        return SESSION.query(Buttons).filter(Buttons.chat_id == int(chat_id), Buttons.note_name == note_name).all()
     finally:
         SESSION.close()
 
@@ -131,14 +131,14 @@ def num_chats():
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with NOTES_INSERTION_LOCK:
-        chat_notes = SESSION.query(Notes).filter(Notes.chat_id == str(old_chat_id)).all()
+    with NOTES_INSERTION_LOCK.many(old_chat_id, new_chat_id):
+        chat_notes = SESSION.query(Notes).filter(Notes.chat_id == int(old_chat_id)).all()
         for note in chat_notes:
-            note.chat_id = str(new_chat_id)
+            note.chat_id = int(new_chat_id)
 
-        with BUTTONS_INSERTION_LOCK:
-            chat_buttons = SESSION.query(Buttons).filter(Buttons.chat_id == str(old_chat_id)).all()
+        with BUTTONS_INSERTION_LOCK.many(old_chat_id, new_chat_id):
+            chat_buttons = SESSION.query(Buttons).filter(Buttons.chat_id == int(old_chat_id)).all()
             for btn in chat_buttons:
-                btn.chat_id = str(new_chat_id)
+                btn.chat_id = int(new_chat_id)
 
         SESSION.commit()
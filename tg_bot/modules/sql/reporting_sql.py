@@ -1,8 +1,8 @@
-import threading
 from typing import Union
 
-from sqlalchemy import Column, Integer, String, Boolean
+from sqlalchemy import Column, Integer, BigInteger, Boolean
 
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import SESSION, BASE
 
 
@@ -20,11 +20,11 @@ class ReportingUserSettings(BASE):
 
 class ReportingChatSettings(BASE):
     __tablename__ = "chat_report_settings"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     should_report = Column(Boolean, default=True)
 
     def __init__(self, chat_id):
-        self.chat_id = str(chat_id)
+        self.chat_id = int(chat_id)
 
     def __repr__(self):
         return "<Chat report settings ({})>".format(self.chat_id)
@@ -33,13 +33,13 @@ class ReportingChatSettings(BASE):
 ReportingUserSettings.__table__.create(checkfirst=True)
 ReportingChatSettings.__table__.create(checkfirst=True)
 
-CHAT_LOCK = threading.RLock()
-USER_LOCK = threading.RLock()
+CHAT_LOCK = StripedLock()
+USER_LOCK = StripedLock()
 
 
 def chat_should_report(chat_id: Union[str, int]) -> bool:
     try:
-        chat_setting = SESSION.query(ReportingChatSettings).get(str(chat_id))
+        chat_setting = SESSION.query(ReportingChatSettings).get(int(chat_id))
         if chat_setting:
             return chat_setting.should_report
         return False
@@ -58,8 +58,8 @@ def user_should_report(user_id: int) -> bool:
 
 
 def set_chat_setting(chat_id: Union[int, str], setting: bool):
-    with CHAT_LOCK:
-        chat_setting = SESSION.query(ReportingChatSettings).get(str(chat_id))
+    with CHAT_LOCK[chat_id]:
+        chat_setting = SESSION.query(ReportingChatSettings).get(int(chat_id))
         if not chat_setting:
             chat_setting = ReportingChatSettings(chat_id)
 
@@ -69,7 +69,7 @@ def set_chat_setting(chat_id: Union[int, str], setting: bool):
 
 
 def set_user_setting(user_id: int, setting: bool):
-    with USER_LOCK:
+    with USER_LOCK[user_id]:
         user_setting = SESSION.query(ReportingUserSettings).get(user_id)
         if not user_setting:
             user_setting = ReportingUserSettings(user_id)
@@ -80,9 +80,9 @@ def set_user_setting(user_id: int, setting: bool):
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with CHAT_LOCK:
+    with CHAT_LOCK.many(old_chat_id, new_chat_id):
         chat_notes = SESSION.query(ReportingChatSettings).filter(
-            ReportingChatSettings.chat_id == str(old_chat_id)).all()
+            ReportingChatSettings.chat_id == int(old_chat_id)).all()
         for note in chat_notes:
-            note.chat_id = str(new_chat_id)
+            note.chat_id = int(new_chat_id)
         SESSION.commit()
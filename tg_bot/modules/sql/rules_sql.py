@@ -1,17 +1,16 @@
-import threading
-
-from sqlalchemy import Column, String, UnicodeText, func, distinct
+from sqlalchemy import Column, BigInteger, UnicodeText, func, distinct
 
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import SESSION, BASE
 
 
 class Rules(BASE):
     __tablename__ = "rules"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     rules = Column(UnicodeText, default="")
 
     def __init__(self, chat_id):
-        self.chat_id = chat_id
+        self.chat_id = int(chat_id)
 
     def __repr__(self):
         return "<Chat {} rules: {}>".format(self.chat_id, self.rules)
@@ -19,14 +18,14 @@ class Rules(BASE):
 
 Rules.__table__.create(checkfirst=True)
 
-INSERTION_LOCK = threading.RLock()
+INSERTION_LOCK = StripedLock()
 
 
 def set_rules(chat_id, rules_text):
-    with INSERTION_LOCK:
-        rules = SESSION.query(Rules).get(str(chat_id))
+    with INSERTION_LOCK[chat_id]:
+        rules = SESSION.query(Rules).get(int(chat_id))
         if not rules:
-            rules = Rules(str(chat_id))
+            rules = Rules(int(chat_id))
         rules.rules = rules_text
 
         SESSION.add(rules)
@@ -34,7 +33,7 @@ def set_rules(chat_id, rules_text):
 
 
 def get_rules(chat_id):
-    rules = SESSION.query(Rules).get(str(chat_id))
+    rules = SESSION.query(Rules).get(int(chat_id))
     ret = ""
     if rules:
         ret = rules.rules
@@ -51,8 +50,8 @@ def num_chats():
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with INSERTION_LOCK:
-        chat = SESSION.query(Rules).get(str(old_chat_id))
+    with INSERTION_LOCK.many(old_chat_id, new_chat_id):
+        chat = SESSION.query(Rules).get(int(old_chat_id))
         if chat:
-            chat.chat_id = str(new_chat_id)
+            chat.chat_id = int(new_chat_id)
         SESSION.commit()
@@ -1,7 +1,6 @@
-import threading
-
 from sqlalchemy import Column, Integer, UnicodeText
 
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import SESSION, BASE
 
 
@@ -34,7 +33,7 @@ class UserBio(BASE):
 UserInfo.__table__.create(checkfirst=True)
 UserBio.__table__.create(checkfirst=True)
 
-INSERTION_LOCK = threading.RLock()
+INSERTION_LOCK = StripedLock()
 
 
 def get_user_me_info(user_id):
@@ -46,7 +45,7 @@ def get_user_me_info(user_id):
 
 
 def set_user_me_info(user_id, info):
-    with INSERTION_LOCK:
+    with INSERTION_LOCK[user_id]:
         userinfo = SESSION.query(UserInfo).get(user_id)
         if userinfo:
             userinfo.info = info
@@ -65,7 +64,7 @@ def get_user_bio(user_id):
 
 
 def set_user_bio(user_id, bio):
-    with INSERTION_LOCK:
+    with INSERTION_LOCK[user_id]:
         userbio = SESSION.query(UserBio).get(user_id)
         if userbio:
             userbio.bio = bio
@@ -1,8 +1,12 @@
+import atexit
 import threading
 
-from sqlalchemy import Column, Integer, UnicodeText, String, ForeignKey, UniqueConstraint, func
+from sqlalchemy import Column, Integer, UnicodeText, BigInteger, ForeignKey, UniqueConstraint, Index, func
+from sqlalchemy.dialects.postgresql import insert
 
-from tg_bot import dispatcher
+from tg_bot import dispatcher, LOGGER
+from tg_bot.modules.helper_funcs.cache import TTLCache
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import BASE, SESSION
 
 
@@ -10,6 +14,8 @@ class Users(BASE):
     __tablename__ = "users"
     user_id = Column(Integer, primary_key=True)
     username = Column(UnicodeText)
+    # usernames are looked up case insensitively
+    __table_args__ = (Index("ix_users_lower_username", func.lower(username)),)
 
     def __init__(self, user_id, username=None):
         self.user_id = user_id
@@ -21,11 +27,11 @@ class Users(BASE):
 
 class Chats(BASE):
     __tablename__ = "chats"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     chat_name = Column(UnicodeText, nullable=False)
 
     def __init__(self, chat_id, chat_name):
-        self.chat_id = str(chat_id)
+        self.chat_id = int(chat_id)
         self.chat_name = chat_name
 
     def __repr__(self):
@@ -36,7 +42,7 @@ class ChatMembers(BASE):
     __tablename__ = "chat_members"
     priv_chat_id = Column(Integer, primary_key=True)
     # NOTE: Use dual primary key instead of private primary key?
-    chat = Column(String(14),
+    chat = Column(BigInteger,
                   ForeignKey("chats.chat_id",
                              onupdate="CASCADE",
                              ondelete="CASCADE"),
@@ -46,7 +52,8 @@ class ChatMembers(BASE):
                              onupdate="CASCADE",
                              ondelete="CASCADE"),
                   nullable=False)
-    __table_args__ = (UniqueConstraint('chat', 'user', name='_chat_members_uc'),)
+    __table_args__ = (UniqueConstraint('chat', 'user', name='_chat_members_uc'),
+                      Index("ix_chat_members_user", "user"))
 
     def __init__(self, chat, user):
         self.chat = chat
@@ -61,18 +68,100 @@ Users.__table__.create(checkfirst=True)
 Chats.__table__.create(checkfirst=True)
 ChatMembers.__table__.create(checkfirst=True)
 
-INSERTION_LOCK = threading.RLock()
+USERS_INSERTION_LOCK = StripedLock()  # keyed by user_id
+CHATS_INSERTION_LOCK = StripedLock()  # keyed by chat_id
+CHAT_MEMBERS_INSERTION_LOCK = StripedLock()  # keyed by (chat_id, user_id)
+
+# Usernames can change hands, so each one belongs to whoever was most recently seen with it. Recently seen usernames
+# are kept in memory, so resolving an @username rarely needs the db.
+USERNAME_CACHE_SIZE = 50000
+USERNAME_LOCK = threading.Lock()
+USERNAME_TO_ID = TTLCache(maxsize=USERNAME_CACHE_SIZE)  # lowercase username -> user_id
+ID_TO_USERNAME = TTLCache(maxsize=USERNAME_CACHE_SIZE)  # user_id -> lowercase username
+
+# Users who have been seen recently (or are in the db) have certainly interacted with the bot, so there's no need to
+# ask telegram whether they exist before acting on them.
+KNOWN_USER_TTL = 24 * 60 * 60  # seconds
+KNOWN_USERS = TTLCache(maxsize=USERNAME_CACHE_SIZE, ttl=KNOWN_USER_TTL)  # user_id -> True
+SAVED_LOOKUPS_LOCK = threading.Lock()
+SAVED_LOOKUPS = 0  # get_chat calls skipped thanks to KNOWN_USERS
+
+# Users are logged on every group message, but nearly always with data we already have. Updates are deduplicated
+# against recently seen values, queued, and written in bulk every FLUSH_INTERVAL seconds.
+FLUSH_INTERVAL = 10  # seconds
+SEEN_USERS = TTLCache(maxsize=50000)  # (user_id, chat_id) -> (username, chat_name), as last queued
+PENDING_LOCK = threading.Lock()
+PENDING_USERS = {}  # user_id -> username
+PENDING_CHATS = {}  # chat_id -> chat_name
+PENDING_MEMBERS = set()  # (chat_id, user_id)
+BULK_CHUNK_SIZE = 1000
+# flushes in a row which can fail (and be requeued) before the queued updates are written one at a time instead, so
+# that a bad row gets skipped rather than failing every flush after it
+MAX_FLUSH_RETRIES = 3
+FLUSH_FAILURES = 0  # guarded by PENDING_LOCK
+# held for a whole flush (but never by queue_user_update), so that flushes don't overlap with each other or migrations
+FLUSH_LOCK = threading.RLock()
+
+
+def remember_username(user_id, username):
+    """
+    Record that user_id is now the owner of username (or has no username, if None).
+    """
+    with USERNAME_LOCK:
+        old_username = ID_TO_USERNAME.get(user_id)
+        new_username = username.lower() if username else None
+        if old_username == new_username:
+            return
+
+        # they've changed username; the old one doesn't point to them anymore
+        if old_username and USERNAME_TO_ID.get(old_username) == user_id:
+            USERNAME_TO_ID.pop(old_username)
+        ID_TO_USERNAME.set(user_id, new_username)
+        if new_username:
+            USERNAME_TO_ID.set(new_username, user_id)
+
+
+def get_cached_userid(username):
+    return USERNAME_TO_ID.get(username.lower())
+
+
+def mark_known_user(user_id):
+    KNOWN_USERS.set(int(user_id), True)
+
+
+def is_known_user(user_id):
+    if int(user_id) in KNOWN_USERS:
+        return True
+
+    try:
+        known = SESSION.query(Users).get(int(user_id)) is not None
+    finally:
+        SESSION.close()
+
+    if known:
+        mark_known_user(user_id)
+    return known
+
+
+def count_saved_lookup():
+    global SAVED_LOOKUPS
+    with SAVED_LOOKUPS_LOCK:
+        SAVED_LOOKUPS += 1
+
+
+def num_saved_lookups():
+    return SAVED_LOOKUPS
 
 
 def ensure_bot_in_db():
-    with INSERTION_LOCK:
+    with USERS_INSERTION_LOCK[dispatcher.bot.id]:
         bot = Users(dispatcher.bot.id, dispatcher.bot.username)
         SESSION.merge(bot)
         SESSION.commit()
 
 
 def update_user(user_id, username, chat_id=None, chat_name=None):
-    with INSERTION_LOCK:
+    with USERS_INSERTION_LOCK[user_id]:
         user = SESSION.query(Users).get(user_id)
         if not user:
             user = Users(user_id, username)
@@ -81,26 +170,159 @@ def update_user(user_id, username, chat_id=None, chat_name=None):
         else:
             user.username = username
 
+        if username:
+            # anyone else who had this username has since changed theirs
+            SESSION.query(Users).filter(func.lower(Users.username) == username.lower(),
+                                        Users.user_id != user_id).update({Users.username: None},
+                                                                         synchronize_session=False)
+        remember_username(user_id, username)
+        mark_known_user(user_id)
+
         if not chat_id or not chat_name:
             SESSION.commit()
             return
 
-        chat = SESSION.query(Chats).get(str(chat_id))
-        if not chat:
-            chat = Chats(str(chat_id), chat_name)
-            SESSION.add(chat)
-            SESSION.flush()
+        with CHATS_INSERTION_LOCK[chat_id], CHAT_MEMBERS_INSERTION_LOCK[(chat_id, user_id)]:
+            chat = SESSION.query(Chats).get(int(chat_id))
+            if not chat:
+                chat = Chats(int(chat_id), chat_name)
+                SESSION.add(chat)
+                SESSION.flush()
 
-        else:
-            chat.chat_name = chat_name
+            else:
+                chat.chat_name = chat_name
 
-        member = SESSION.query(ChatMembers).filter(ChatMembers.chat == chat.chat_id,
-                                                   ChatMembers.user == user.user_id).first()
-        if not member:
-            chat_member = ChatMembers(chat.chat_id, user.user_id)
-            SESSION.add(chat_member)
+            member = SESSION.query(ChatMembers).filter(ChatMembers.chat == chat.chat_id,
+                                                       ChatMembers.user == user.user_id).first()
+            if not member:
+                chat_member = ChatMembers(chat.chat_id, user.user_id)
+                SESSION.add(chat_member)
 
-        SESSION.commit()
+            SESSION.commit()
+
+
+def queue_user_update(user_id, username, chat_id=None, chat_name=None):
+    """
+    Same as update_user, but the write is deferred until the next flush_user_updates, and skipped entirely if
+    nothing changed since the last time this user was seen.
+    """
+    if not chat_id or not chat_name:
+        chat_id = chat_name = None
+    else:
+        chat_id = int(chat_id)
+
+    mark_known_user(user_id)
+    key = (user_id, chat_id)
+    if SEEN_USERS.get(key) == (username, chat_name):
+        return
+
+    SEEN_USERS.set(key, (username, chat_name))
+    remember_username(user_id, username)
+    with PENDING_LOCK:
+        PENDING_USERS[user_id] = username
+        if chat_id:
+            PENDING_CHATS[chat_id] = chat_name
+            PENDING_MEMBERS.add((chat_id, user_id))
+
+
+def flush_user_updates(bot=None, job=None):
+    """
+    Write all queued user updates to the db. Used as a job queue callback.
+    """
+    with FLUSH_LOCK:
+        __flush_pending()
+
+
+def __flush_pending():
+    global PENDING_USERS, PENDING_CHATS, PENDING_MEMBERS, FLUSH_FAILURES
+    # only held to swap the queues over, so queue_user_update never waits on the db
+    with PENDING_LOCK:
+        users, chats, members = PENDING_USERS, PENDING_CHATS, PENDING_MEMBERS
+        PENDING_USERS, PENDING_CHATS, PENDING_MEMBERS = {}, {}, set()
+        one_by_one = users and FLUSH_FAILURES >= MAX_FLUSH_RETRIES
+        if one_by_one:
+            FLUSH_FAILURES = 0
+
+    if not users:
+        return
+
+    if one_by_one:
+        __write_one_by_one(users, chats, members)
+        return
+
+    try:
+        if SESSION.get_bind().dialect.name == "postgresql":
+            # no insertion locks needed: each upsert is atomic, whatever else is writing the same rows
+            __bulk_upsert(users, chats, members)
+        else:
+            for chat_id, user_id in members:
+                update_user(user_id, users[user_id], chat_id, chats[chat_id])
+            for user_id in users.keys() - {user_id for _, user_id in members}:
+                update_user(user_id, users[user_id])
+        with PENDING_LOCK:
+            FLUSH_FAILURES = 0
+
+    except Exception:
+        SESSION.rollback()
+        # put them back, without overwriting anything newer which was queued in the meantime
+        with PENDING_LOCK:
+            FLUSH_FAILURES += 1
+            failures = FLUSH_FAILURES
+            for user_id, username in users.items():
+                PENDING_USERS.setdefault(user_id, username)
+            for chat_id, chat_name in chats.items():
+                PENDING_CHATS.setdefault(chat_id, chat_name)
+            PENDING_MEMBERS.update(members)
+        LOGGER.exception("Failed to write %d queued users (%d/%d), will retry on next flush", len(users),
+                         failures, MAX_FLUSH_RETRIES)
+
+
+def __write_one_by_one(users, chats, members):
+    # much slower than a bulk write, but one bad row can only lose its own update
+    rows = [(user_id, chat_id) for chat_id, user_id in members]
+    rows.extend((user_id, None) for user_id in users.keys() - {user_id for _, user_id in members})
+    skipped = 0
+    for user_id, chat_id in rows:
+        try:
+            update_user(user_id, users[user_id], chat_id, chats.get(chat_id))
+        except Exception:
+            SESSION.rollback()
+            skipped += 1
+            LOGGER.exception("Skipping queued update of user %s in chat %s", user_id, chat_id)
+
+    LOGGER.warning("Wrote %d queued user updates one at a time, skipping %d", len(rows) - skipped, skipped)
+
+
+def __bulk_upsert(users, chats, members):
+    # chunked to stay well under postgres' limit on parameters per statement
+    users, chats, members = list(users.items()), list(chats.items()), list(members)
+    for i in range(0, len(users), BULK_CHUNK_SIZE):
+        stmt = insert(Users.__table__).values([{"user_id": user_id, "username": username}
+                                               for user_id, username in users[i:i + BULK_CHUNK_SIZE]])
+        SESSION.execute(stmt.on_conflict_do_update(index_elements=[Users.user_id],
+                                                   set_={"username": stmt.excluded.username}))
+        # anyone else who had one of these usernames has since changed theirs
+        chunk_names = {username.lower() for _, username in users[i:i + BULK_CHUNK_SIZE] if username}
+        chunk_ids = [user_id for user_id, _ in users[i:i + BULK_CHUNK_SIZE]]
+        if chunk_names:
+            SESSION.execute(Users.__table__.update()
+                            .where(func.lower(Users.username).in_(chunk_names))
+                            .where(Users.user_id.notin_(chunk_ids))
+                            .values(username=None))
+
+    for i in range(0, len(chats), BULK_CHUNK_SIZE):
+        stmt = insert(Chats.__table__).values([{"chat_id": chat_id, "chat_name": chat_name}
+                                               for chat_id, chat_name in chats[i:i + BULK_CHUNK_SIZE]])
+        SESSION.execute(stmt.on_conflict_do_update(index_elements=[Chats.chat_id],
+                                                   set_={"chat_name": stmt.excluded.chat_name}))
+
+    for i in range(0, len(members), BULK_CHUNK_SIZE):
+        stmt = insert(ChatMembers.__table__).values([{"chat": chat_id, "user": user_id}
+                                                     for chat_id, user_id in members[i:i + BULK_CHUNK_SIZE]])
+        SESSION.execute(stmt.on_conflict_do_nothing(constraint="_chat_members_uc"))
+
+    # all in one transaction, so members never reference users or chats which weren't written
+    SESSION.commit()
 
 
 def get_userid_by_name(username):
@@ -112,14 +334,15 @@ def get_userid_by_name(username):
 
 def get_name_by_userid(user_id):
     try:
-        return SESSION.query(Users).get(Users.user_id == int(user_id)).first()
+        user = SESSION.query(Users).get(int(user_id))
+        return user.username if user else None
     finally:
         SESSION.close()
 
 
 def get_chat_members(chat_id):
     try:
-        return SESSION.query(ChatMembers).filter(ChatMembers.chat == str(chat_id)).all()
+        return SESSION.query(ChatMembers).filter(ChatMembers.chat == int(chat_id)).all()
     finally:
         SESSION.close()
 
@@ -131,6 +354,31 @@ def get_all_chats():
         SESSION.close()
 
 
+def iter_chat_member_names(chat_id, batch_size=1000):
+    """
+    Stream (user_id, username) for every known member of a chat, from a single query. Rows are fetched batch_size at
+    a time (with a server side cursor on postgres), so big chats are never loaded all at once.
+    """
+    try:
+        query = SESSION.query(ChatMembers.user, Users.username) \
+            .join(Users, Users.user_id == ChatMembers.user) \
+            .filter(ChatMembers.chat == int(chat_id)) \
+            .order_by(ChatMembers.user)
+        yield from query.yield_per(batch_size)
+    finally:
+        SESSION.close()
+
+
+def iter_chats(batch_size=1000):
+    """
+    Stream (chat_id, chat_name) for every known chat, batch_size rows at a time.
+    """
+    try:
+        yield from SESSION.query(Chats.chat_id, Chats.chat_name).order_by(Chats.chat_id).yield_per(batch_size)
+    finally:
+        SESSION.close()
+
+
 def get_user_num_chats(user_id):
     try:
         return SESSION.query(ChatMembers).filter(ChatMembers.user == int(user_id)).count()
@@ -153,20 +401,26 @@ def num_users():
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with INSERTION_LOCK:
-        chat = SESSION.query(Chats).get(str(old_chat_id))
-        if chat:
-            chat.chat_id = str(new_chat_id)
-            SESSION.add(chat)
+    # make sure no queued updates for the old chat get written after it's been migrated
+    with FLUSH_LOCK:
+        flush_user_updates()
+        SEEN_USERS.pop_matching(lambda key: key[1] == int(old_chat_id))
 
-        SESSION.flush()
+        with CHATS_INSERTION_LOCK.many(old_chat_id, new_chat_id), CHAT_MEMBERS_INSERTION_LOCK.all():
+            chat = SESSION.query(Chats).get(int(old_chat_id))
+            if chat:
+                chat.chat_id = int(new_chat_id)
+                SESSION.add(chat)
 
-        chat_members = SESSION.query(ChatMembers).filter(ChatMembers.chat == str(old_chat_id)).all()
-        for member in chat_members:
-            member.chat = str(new_chat_id)
-            SESSION.add(member)
+            SESSION.flush()
 
-        SESSION.commit()
+            chat_members = SESSION.query(ChatMembers).filter(ChatMembers.chat == int(old_chat_id)).all()
+            for member in chat_members:
+                member.chat = int(new_chat_id)
+                SESSION.add(member)
+
+            SESSION.commit()
 
 
 ensure_bot_in_db()
+atexit.register(flush_user_updates)
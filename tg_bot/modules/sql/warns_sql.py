@@ -1,8 +1,7 @@
-import threading
-
-from sqlalchemy import Integer, Column, String, UnicodeText, func, distinct, Boolean
+from sqlalchemy import Integer, Column, BigInteger, UnicodeText, func, distinct, Boolean, Index
 from sqlalchemy.dialects import postgresql
 
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import SESSION, BASE
 
 
@@ -10,13 +9,14 @@ class Warns(BASE):
     __tablename__ = "warns"
 
     user_id = Column(Integer, primary_key=True)
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     num_warns = Column(Integer, default=0)
     reasons = Column(postgresql.ARRAY(UnicodeText))
+    __table_args__ = (Index("ix_warns_chat_id", "chat_id"),)
 
     def __init__(self, user_id, chat_id):
         self.user_id = user_id
-        self.chat_id = str(chat_id)
+        self.chat_id = int(chat_id)
         self.num_warns = 0
         self.reasons = []
 
@@ -26,12 +26,12 @@ class Warns(BASE):
 
 class WarnFilters(BASE):
     __tablename__ = "warn_filters"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     keyword = Column(UnicodeText, primary_key=True, nullable=False)
     reply = Column(UnicodeText, nullable=False)
 
     def __init__(self, chat_id, keyword, reply):
-        self.chat_id = str(chat_id)  # ensure string
+        self.chat_id = int(chat_id)
         self.keyword = keyword
         self.reply = reply
 
@@ -46,12 +46,12 @@ class WarnFilters(BASE):
 
 class WarnSettings(BASE):
     __tablename__ = "warn_settings"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     warn_limit = Column(Integer, default=3)
     soft_warn = Column(Boolean, default=False)
 
     def __init__(self, chat_id, warn_limit=3, soft_warn=False):
-        self.chat_id = str(chat_id)
+        self.chat_id = int(chat_id)
         self.warn_limit = warn_limit
         self.soft_warn = soft_warn
 
@@ -63,16 +63,16 @@ Warns.__table__.create(checkfirst=True)
 WarnFilters.__table__.create(checkfirst=True)
 WarnSettings.__table__.create(checkfirst=True)
 
-WARN_INSERTION_LOCK = threading.RLock()
-WARN_FILTER_INSERTION_LOCK = threading.RLock()
-WARN_SETTINGS_LOCK = threading.RLock()
+WARN_INSERTION_LOCK = StripedLock()
+WARN_FILTER_INSERTION_LOCK = StripedLock()
+WARN_SETTINGS_LOCK = StripedLock()
 
 
 def warn_user(user_id, chat_id, reason=None):
-    with WARN_INSERTION_LOCK:
-        warned_user = SESSION.query(Warns).get((user_id, str(chat_id)))
+    with WARN_INSERTION_LOCK[(chat_id, user_id)]:
+        warned_user = SESSION.query(Warns).get((user_id, int(chat_id)))
         if not warned_user:
-            warned_user = Warns(user_id, str(chat_id))
+            warned_user = Warns(user_id, int(chat_id))
 
         warned_user.num_warns += 1
         if reason:
@@ -88,8 +88,8 @@ def warn_user(user_id, chat_id, reason=None):
 
 
 def remove_warn(user_id, chat_id):
-    with WARN_INSERTION_LOCK:
-        warned_user = SESSION.query(Warns).get((user_id, str(chat_id)))
+    with WARN_INSERTION_LOCK[(chat_id, user_id)]:
+        warned_user = SESSION.query(Warns).get((user_id, int(chat_id)))
         if not warned_user:
             SESSION.close()
             return None
@@ -106,8 +106,8 @@ def remove_warn(user_id, chat_id):
 
 
 def reset_warns(user_id, chat_id):
-    with WARN_INSERTION_LOCK:
-        warned_user = SESSION.query(Warns).get((user_id, str(chat_id)))
+    with WARN_INSERTION_LOCK[(chat_id, user_id)]:
+        warned_user = SESSION.query(Warns).get((user_id, int(chat_id)))
         if warned_user:
             warned_user.num_warns = 0
             warned_user.reasons = []
@@ -119,7 +119,7 @@ def reset_warns(user_id, chat_id):
 
 def get_warns(user_id, chat_id):
     try:
-        user = SESSION.query(Warns).get((user_id, str(chat_id)))
+        user = SESSION.query(Warns).get((user_id, int(chat_id)))
         if not user:
             return None
         reasons = user.reasons
@@ -130,16 +130,16 @@ def get_warns(user_id, chat_id):
 
 
 def add_warn_filter(chat_id, keyword, reply):
-    with WARN_FILTER_INSERTION_LOCK:
-        warn_filt = WarnFilters(str(chat_id), keyword, reply)
+    with WARN_FILTER_INSERTION_LOCK[chat_id]:
+        warn_filt = WarnFilters(int(chat_id), keyword, reply)
 
         SESSION.merge(warn_filt)  # merge to avoid duplicate key issues
         SESSION.commit()
 
 
 def remove_warn_filter(chat_id, keyword):
-    with WARN_FILTER_INSERTION_LOCK:
-        warn_filt = SESSION.query(WarnFilters).get((str(chat_id), keyword))
+    with WARN_FILTER_INSERTION_LOCK[chat_id]:
+        warn_filt = SESSION.query(WarnFilters).get((int(chat_id), keyword))
         if warn_filt:
             SESSION.delete(warn_filt)
             SESSION.commit()
@@ -150,14 +150,14 @@ def remove_warn_filter(chat_id, keyword):
 
 def get_chat_warn_filters(chat_id):
     try:
-        return SESSION.query(WarnFilters).filter(WarnFilters.chat_id == str(chat_id)).all()
+        return SESSION.query(WarnFilters).filter(WarnFilters.chat_id == int(chat_id)).all()
     finally:
         SESSION.close()
 
 
 def set_warn_limit(chat_id, warn_limit):
-    with WARN_SETTINGS_LOCK:
-        curr_setting = SESSION.query(WarnSettings).get(str(chat_id))
+    with WARN_SETTINGS_LOCK[chat_id]:
+        curr_setting = SESSION.query(WarnSettings).get(int(chat_id))
         if not curr_setting:
             curr_setting = WarnSettings(chat_id, warn_limit=warn_limit)
 
@@ -168,8 +168,8 @@ def set_warn_limit(chat_id, warn_limit):
 
 
 def set_warn_strength(chat_id, soft_warn):
-    with WARN_SETTINGS_LOCK:
-        curr_setting = SESSION.query(WarnSettings).get(str(chat_id))
+    with WARN_SETTINGS_LOCK[chat_id]:
+        curr_setting = SESSION.query(WarnSettings).get(int(chat_id))
         if not curr_setting:
             curr_setting = WarnSettings(chat_id, soft_warn=soft_warn)
 
@@ -181,7 +181,7 @@ def set_warn_strength(chat_id, soft_warn):
 
 def get_warn_setting(chat_id):
     try:
-        setting = SESSION.query(WarnSettings).get(str(chat_id))
+        setting = SESSION.query(WarnSettings).get(int(chat_id))
         if setting:
             return setting.warn_limit, setting.soft_warn
         else:
@@ -214,7 +214,7 @@ def num_warn_filters():
 
 def num_warn_chat_filters(chat_id):
     try:
-        return SESSION.query(WarnFilters.chat_id).filter(WarnFilters.chat_id == str(chat_id)).count()
+        return SESSION.query(WarnFilters.chat_id).filter(WarnFilters.chat_id == int(chat_id)).count()
     finally:
         SESSION.close()
 
@@ -227,20 +227,21 @@ def num_warn_filter_chats():
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with WARN_INSERTION_LOCK:
-        chat_notes = SESSION.query(Warns).filter(Warns.chat_id == str(old_chat_id)).all()
+    # every user's warns in the chat move, so this needs all of the (chat, user) locks
+    with WARN_INSERTION_LOCK.all():
+        chat_notes = SESSION.query(Warns).filter(Warns.chat_id == int(old_chat_id)).all()
         for note in chat_notes:
-            note.chat_id = str(new_chat_id)
+            note.chat_id = int(new_chat_id)
         SESSION.commit()
 
-    with WARN_FILTER_INSERTION_LOCK:
-        chat_filters = SESSION.query(WarnFilters).filter(WarnFilters.chat_id == str(old_chat_id)).all()
+    with WARN_FILTER_INSERTION_LOCK.many(old_chat_id, new_chat_id):
+        chat_filters = SESSION.query(WarnFilters).filter(WarnFilters.chat_id == int(old_chat_id)).all()
         for filt in chat_filters:
-            filt.chat_id = str(new_chat_id)
+            filt.chat_id = int(new_chat_id)
         SESSION.commit()
 
-    with WARN_SETTINGS_LOCK:
-        chat_settings = SESSION.query(WarnSettings).filter(WarnSettings.chat_id == str(old_chat_id)).all()
+    with WARN_SETTINGS_LOCK.many(old_chat_id, new_chat_id):
+        chat_settings = SESSION.query(WarnSettings).filter(WarnSettings.chat_id == int(old_chat_id)).all()
         for setting in chat_settings:
-            setting.chat_id = str(new_chat_id)
+            setting.chat_id = int(new_chat_id)
         SESSION.commit()
@@ -1,8 +1,8 @@
-import threading
 from enum import IntEnum, unique
 
-from sqlalchemy import Column, String, Boolean, UnicodeText, Integer
+from sqlalchemy import Column, BigInteger, Boolean, UnicodeText, Integer, Index
 
+from tg_bot.modules.helper_funcs.striped_lock import StripedLock
 from tg_bot.modules.sql import SESSION, BASE
 
 DEFAULT_WELCOME = "Hey {first}, how are you?"
@@ -23,7 +23,7 @@ class Types(IntEnum):
 
 class Welcome(BASE):
     __tablename__ = "welcome_pref"
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     should_welcome = Column(Boolean, default=True)
     should_goodbye = Column(Boolean, default=True)
 
@@ -34,7 +34,7 @@ class Welcome(BASE):
     leave_type = Column(Integer, default=Types.TEXT.value)
 
     def __init__(self, chat_id, should_welcome=True, should_goodbye=True):
-        self.chat_id = chat_id
+        self.chat_id = int(chat_id)
         self.should_welcome = should_welcome
         self.should_goodbye = should_goodbye
 
@@ -45,13 +45,15 @@ class Welcome(BASE):
 class WelcomeButtons(BASE):
     __tablename__ = "welcome_urls"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     name = Column(UnicodeText, nullable=False)
     url = Column(UnicodeText, nullable=False)
     same_line = Column(Boolean, default=False)
+    # buttons are always looked up by chat; the primary key starts with id, so can't be used for that
+    __table_args__ = (Index("ix_welcome_urls_chat_id", "chat_id"),)
 
     def __init__(self, chat_id, name, url, same_line=False):
-        self.chat_id = str(chat_id)
+        self.chat_id = int(chat_id)
         self.name = name
         self.url = url
         self.same_line = same_line
@@ -60,13 +62,14 @@ class WelcomeButtons(BASE):
 class GoodbyeButtons(BASE):
     __tablename__ = "leave_urls"
     id = Column(Integer, primary_key=True, autoincrement=True)
-    chat_id = Column(String(14), primary_key=True)
+    chat_id = Column(BigInteger, primary_key=True)
     name = Column(UnicodeText, nullable=False)
     url = Column(UnicodeText, nullable=False)
     same_line = Column(Boolean, default=False)
+    __table_args__ = (Index("ix_leave_urls_chat_id", "chat_id"),)
 
     def __init__(self, chat_id, name, url, same_line=False):
-        self.chat_id = str(chat_id)
+        self.chat_id = int(chat_id)
         self.name = name
         self.url = url
         self.same_line = same_line
@@ -76,13 +79,13 @@ Welcome.__table__.create(checkfirst=True)
 WelcomeButtons.__table__.create(checkfirst=True)
 GoodbyeButtons.__table__.create(checkfirst=True)
 
-INSERTION_LOCK = threading.RLock()
-WELC_BTN_LOCK = threading.RLock()
-LEAVE_BTN_LOCK = threading.RLock()
+INSERTION_LOCK = StripedLock()
+WELC_BTN_LOCK = StripedLock()
+LEAVE_BTN_LOCK = StripedLock()
 
 
 def get_welc_pref(chat_id):
-    welc = SESSION.query(Welcome).get(str(chat_id))
+    welc = SESSION.query(Welcome).get(int(chat_id))
     SESSION.close()
     if welc:
         return welc.should_welcome, welc.custom_welcome, welc.welcome_type
@@ -92,7 +95,7 @@ def get_welc_pref(chat_id):
 
 
 def get_gdbye_pref(chat_id):
-    welc = SESSION.query(Welcome).get(str(chat_id))
+    welc = SESSION.query(Welcome).get(int(chat_id))
     SESSION.close()
     if welc:
         return welc.should_goodbye, welc.custom_leave, welc.leave_type
@@ -102,10 +105,10 @@ def get_gdbye_pref(chat_id):
 
 
 def set_welc_preference(chat_id, should_welcome):
-    with INSERTION_LOCK:
-        curr = SESSION.query(Welcome).get(str(chat_id))
+    with INSERTION_LOCK[chat_id]:
+        curr = SESSION.query(Welcome).get(int(chat_id))
         if not curr:
-            curr = Welcome(str(chat_id), should_welcome=should_welcome)
+            curr = Welcome(int(chat_id), should_welcome=should_welcome)
         else:
             curr.should_welcome = should_welcome
 
@@ -114,10 +117,10 @@ def set_welc_preference(chat_id, should_welcome):
 
 
 def set_gdbye_preference(chat_id, should_goodbye):
-    with INSERTION_LOCK:
-        curr = SESSION.query(Welcome).get(str(chat_id))
+    with INSERTION_LOCK[chat_id]:
+        curr = SESSION.query(Welcome).get(int(chat_id))
         if not curr:
-            curr = Welcome(str(chat_id), should_goodbye=should_goodbye)
+            curr = Welcome(int(chat_id), should_goodbye=should_goodbye)
         else:
             curr.should_goodbye = should_goodbye
 
@@ -129,10 +132,10 @@ def set_custom_welcome(chat_id, custom_welcome, welcome_type, buttons=None):
     if buttons is None:
         buttons = []
 
-    with INSERTION_LOCK:
-        welcome_settings = SESSION.query(Welcome).get(str(chat_id))
+    with INSERTION_LOCK[chat_id]:
+        welcome_settings = SESSION.query(Welcome).get(int(chat_id))
         if not welcome_settings:
-            welcome_settings = Welcome(str(chat_id), True)
+            welcome_settings = Welcome(int(chat_id), True)
 
         if custom_welcome:
             welcome_settings.custom_welcome = custom_welcome
@@ -144,8 +147,8 @@ def set_custom_welcome(chat_id, custom_welcome, welcome_type, buttons=None):
 
         SESSION.add(welcome_settings)
 
-        with WELC_BTN_LOCK:
-            prev_buttons = SESSION.query(WelcomeButtons).filter(WelcomeButtons.chat_id == str(chat_id)).all()
+        with WELC_BTN_LOCK[chat_id]:
+            prev_buttons = SESSION.query(WelcomeButtons).filter(WelcomeButtons.chat_id == int(chat_id)).all()
             for btn in prev_buttons:
                 SESSION.delete(btn)
 
@@ -157,7 +160,7 @@ def set_custom_welcome(chat_id, custom_welcome, welcome_type, buttons=None):
 
 
 def get_custom_welcome(chat_id):
-    welcome_settings = SESSION.query(Welcome).get(str(chat_id))
+    welcome_settings = SESSION.query(Welcome).get(int(chat_id))
     ret = DEFAULT_WELCOME
     if welcome_settings and welcome_settings.custom_welcome:
         ret = welcome_settings.custom_welcome
@@ -170,10 +173,10 @@ def set_custom_gdbye(chat_id, custom_goodbye, goodbye_type, buttons=None):
     if buttons is None:
         buttons = []
 
-    with INSERTION_LOCK:
-        welcome_settings = SESSION.query(Welcome).get(str(chat_id))
+    with INSERTION_LOCK[chat_id]:
+        welcome_settings = SESSION.query(Welcome).get(int(chat_id))
         if not welcome_settings:
-            welcome_settings = Welcome(str(chat_id), True)
+            welcome_settings = Welcome(int(chat_id), True)
 
         if custom_goodbye:
             welcome_settings.custom_leave = custom_goodbye
@@ -185,8 +188,8 @@ def set_custom_gdbye(chat_id, custom_goodbye, goodbye_type, buttons=None):
 
         SESSION.add(welcome_settings)
 
-        with LEAVE_BTN_LOCK:
-            prev_buttons = SESSION.query(GoodbyeButtons).filter(GoodbyeButtons.chat_id == str(chat_id)).all()
+        with LEAVE_BTN_LOCK[chat_id]:
+            prev_buttons = SESSION.query(GoodbyeButtons).filter(GoodbyeButtons.chat_id == int(chat_id)).all()
             for btn in prev_buttons:
                 SESSION.delete(btn)
 
@@ -198,7 +201,7 @@ def set_custom_gdbye(chat_id, custom_goodbye, goodbye_type, buttons=None):
 
 
 def get_custom_gdbye(chat_id):
-    welcome_settings = SESSION.query(Welcome).get(str(chat_id))
+    welcome_settings = SESSION.query(Welcome).get(int(chat_id))
     ret = DEFAULT_GOODBYE
     if welcome_settings and welcome_settings.custom_leave:
         ret = welcome_settings.custom_leave
@@ -209,32 +212,32 @@ def get_custom_gdbye(chat_id):
 
 def get_welc_buttons(chat_id):
     try:
-        return SESSION.query(WelcomeButtons).filter(WelcomeButtons.chat_id == str(chat_id)).all()
+        return SESSION.query(WelcomeButtons).filter(WelcomeButtons.chat_id == int(chat_id)).all()
     finally:
         SESSION.close()
 
 
 def get_gdbye_buttons(chat_id):
     try:
-        return SESSION.query(GoodbyeButtons).filter(GoodbyeButtons.chat_id == str(chat_id)).all()
+        return SESSION.query(GoodbyeButtons).filter(GoodbyeButtons.chat_id == int(chat_id)).all()
     finally:
         SESSION.close()
 
 
 def migrate_chat(old_chat_id, new_chat_id):
-    with INSERTION_LOCK:
-        chat = SESSION.query(Welcome).get(str(old_chat_id))
+    with INSERTION_LOCK.many(old_chat_id, new_chat_id):
+        chat = SESSION.query(Welcome).get(int(old_chat_id))
         if chat:
-            chat.chat_id = str(new_chat_id)
+            chat.chat_id = int(new_chat_id)
 
-        with WELC_BTN_LOCK:
-            chat_buttons = SESSION.query(WelcomeButtons).filter(WelcomeButtons.chat_id == str(old_chat_id)).all()
+        with WELC_BTN_LOCK.many(old_chat_id, new_chat_id):
+            chat_buttons = SESSION.query(WelcomeButtons).filter(WelcomeButtons.chat_id == int(old_chat_id)).all()
             for btn in chat_buttons:
-                btn.chat_id = str(new_chat_id)
+                btn.chat_id = int(new_chat_id)
 
-        with LEAVE_BTN_LOCK:
-            chat_buttons = SESSION.query(GoodbyeButtons).filter(GoodbyeButtons.chat_id == str(old_chat_id)).all()
+        with LEAVE_BTN_LOCK.many(old_chat_id, new_chat_id):
+            chat_buttons = SESSION.query(GoodbyeButtons).filter(GoodbyeButtons.chat_id == int(old_chat_id)).all()
             for btn in chat_buttons:
-                btn.chat_id = str(new_chat_id)
+                btn.chat_id = int(new_chat_id)
 
         SESSION.commit()
@@ -1,9 +1,7 @@
-from io import BytesIO
-from time import sleep
 from typing import Optional, List
 from telegram import TelegramError, Chat, Message
 from telegram import Update, Bot
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Unauthorized
 from telegram.ext import MessageHandler, Filters, CommandHandler
 from telegram.ext.dispatcher import run_async
 from tg_bot.modules.helper_funcs.chat_status import is_user_ban_protected
@@ -11,55 +9,91 @@ from telegram import random
 
 import tg_bot.modules.sql.users_sql as sql
 from tg_bot import dispatcher, OWNER_ID, LOGGER
+from tg_bot.modules.helper_funcs.export import parse_export_args, export_rows, export_filename
+from tg_bot.modules.helper_funcs.fanout import fan_out, summarise_fan_out
 from tg_bot.modules.helper_funcs.filters import CustomFilters
+from tg_bot.modules.helper_funcs.lanes import run_in_lane, BULK_LANE, cleans_up
+from tg_bot.modules.sql import broadcast_sql
 
 USERS_GROUP = 4
 
+# Broadcasts are sent to chats in batches, each of which is sent concurrently, then saved before starting the next;
+# so a broadcast interrupted by a restart picks up from its last batch.
+BROADCAST_BATCH_SIZE = 50
+BROADCAST_WORKERS = 8
+RESUME_RETRY_INTERVAL = 60  # seconds to wait before trying again to resume broadcasts, if the bulk lane is full
+
+BANALL_WORKERS = 8
+BANALL_PROGRESS_INTERVAL = 10  # seconds between edits of the progress message
+
 @run_async
 def quickscope(bot: Bot, update: Update, args: List[int]):
-    if args:
-        chat_id = str(args[1])
-        to_kick = str(args[0])
-    else:
+    try:
+        chat_id = int(args[1])
+        to_kick = int(args[0])
+    except (IndexError, ValueError):
         update.effective_message.reply_text("You don't seem to be referring to a chat/user")
+        return
     try:
         bot.kick_chat_member(chat_id, to_kick)
-        update.effective_message.reply_text("Attempted banning " + to_kick + " from" + chat_id)
+        update.effective_message.reply_text("Attempted banning {} from {}".format(to_kick, chat_id))
     except BadRequest as excp:
-        update.effective_message.reply_text(excp.message + " " + to_kick)
+        update.effective_message.reply_text("{} {}".format(excp.message, to_kick))
 
 
-@run_async
+@run_in_lane(BULK_LANE)
 def banall(bot: Bot, update: Update, args: List[int]):
     if args:
-        chat_id = str(args[0])
-        all_mems = sql.get_chat_members(chat_id)
+        try:
+            chat_id = int(args[0])
+        except ValueError:
+            update.effective_message.reply_text("That doesn't look like a chat id.")
+            return
     else:
-        chat_id = str(update.effective_chat.id)
-        all_mems = sql.get_chat_members(chat_id)
-    for mems in all_mems:
+        chat_id = update.effective_chat.id
+
+    user_ids = [mem.user for mem in sql.get_chat_members(chat_id) if mem.user != bot.id]
+    progress_msg = update.effective_message.reply_text("Banning {} members...".format(len(user_ids)))
+
+    def report_progress(done, total):
         try:
-            bot.kick_chat_member(chat_id, mems.user)
-            update.effective_message.reply_text("Tried banning " + str(mems.user))
-        except BadRequest as excp:
-            update.effective_message.reply_text(excp.message + " " + str(mems.user))
-            continue
+            progress_msg.edit_text("Banning members: {}/{} done.".format(done, total))
+        except TelegramError:
+            pass
 
+    succeeded, failed = fan_out(lambda user_id: bot.kick_chat_member(chat_id, user_id), user_ids,
+                                workers=BANALL_WORKERS, progress=report_progress,
+                                progress_interval=BANALL_PROGRESS_INTERVAL)
 
-@run_async
-def userlist(bot: Bot, update: Update, args:List[int]):
+    summary = "banall complete! " + summarise_fan_out(succeeded, failed)
+    try:
+        progress_msg.edit_text(summary)
+    except TelegramError:
+        pass
+
+    if failed:
+        rows = ((user_id, getattr(excp, "message", None) or repr(excp)) for user_id, excp in failed)
+        with export_rows(rows, ("user_id", "error")) as output:
+            update.effective_message.reply_document(document=output, filename="banall_failures.txt",
+                                                    caption="These members couldn't be banned.")
+
+
+@run_in_lane(BULK_LANE)
+def userlist(bot: Bot, update: Update, args: List[str]):
+    args, export_format, compress = parse_export_args(args)
     if args:
-        chat_id = str(args[0])
-        all_mems = sql.get_chat_members(chat_id)
+        try:
+            chat_id = int(args[0])
+        except ValueError:
+            update.effective_message.reply_text("That's not a valid chat id.")
+            return
     else:
-        chat = update.effective_chat
-        all_mems = sql.get_chat_members(str(chat.id))
-    memlist = 'List of members\n'
-    for mems in all_mems:
-        memlist += "{} - {}".format(mems.user, str(sql.get_name_by_userid(mems.user)))
-    with BytesIO(str.encode(memlist)) as output:
-        output.name = "userlist.txt"
-        update.effective_message.reply_document(document=output, filename="userlist.txt",
+        chat_id = update.effective_chat.id
+
+    rows = sql.iter_chat_member_names(chat_id)
+    with export_rows(rows, ("user_id", "username"), export_format, compress) as output:
+        update.effective_message.reply_document(document=output,
+                                                filename=export_filename("userlist", export_format, compress),
                                                 caption="Here is the list of members in this chat.")
 
 
@@ -71,19 +105,27 @@ def get_user_id(username):
     if username.startswith('@'):
         username = username[1:]
 
+    user_id = sql.get_cached_userid(username)
+    if user_id:
+        return user_id
+
     users = sql.get_userid_by_name(username)
 
     if not users:
         return None
 
     elif len(users) == 1:
+        sql.remember_username(users[0].user_id, users[0].username)
         return users[0].user_id
 
     else:
+        # Only left over from before usernames were given to their latest owner; once resolved, the others are
+        # cleared so this doesn't happen again.
         for user_obj in users:
             try:
                 userdat = dispatcher.bot.get_chat(user_obj.user_id)
-                if userdat.username == username:
+                if userdat.username and userdat.username.lower() == username.lower():
+                    sql.update_user(userdat.id, userdat.username)
                     return userdat.id
 
             except BadRequest as excp:
@@ -95,71 +137,152 @@ def get_user_id(username):
     return None
 
 
-@run_async
+def run_broadcast(bot: Bot, broadcast_id: int):
+    broadcast = broadcast_sql.get_broadcast(broadcast_id)
+    if broadcast.error:
+        broadcast_sql.set_broadcast_error(broadcast_id, None)
+
+    try:
+        __send_broadcast(bot, broadcast)
+    except Exception as excp:
+        # left unfinished, so the next restart picks it up again from the last recorded batch
+        LOGGER.exception("Broadcast %s stopped early", broadcast_id)
+        broadcast_sql.set_broadcast_error(broadcast_id, repr(excp))
+        report = "Broadcast {} stopped early: {}. I'll carry on from where it got to the next time I'm " \
+                 "restarted.".format(broadcast_id, repr(excp))
+    else:
+        broadcast_sql.finish_broadcast(broadcast_id)
+        broadcast = broadcast_sql.get_broadcast(broadcast_id)
+        report = "Broadcast {} complete: sent to {} chats, {} failed. {} chats are now marked as dead, and will be " \
+                 "skipped.".format(broadcast_id, broadcast.sent, broadcast.failed, broadcast_sql.num_dead_chats())
+
+    try:
+        bot.send_message(broadcast.report_chat_id, report)
+    except TelegramError:
+        LOGGER.warning("Couldn't report the end of broadcast %s", broadcast_id)
+
+
+def __send_broadcast(bot: Bot, broadcast):
+    broadcast_id = broadcast.id
+    cursor = broadcast.cursor
+
+    while True:
+        chat_ids = broadcast_sql.get_next_chat_ids(cursor, BROADCAST_BATCH_SIZE)
+        if not chat_ids:
+            break
+
+        _, failed = fan_out(lambda chat_id: bot.send_message(chat_id, broadcast.message), chat_ids,
+                            workers=BROADCAST_WORKERS)
+
+        errors = {}
+        dead_chats = {}
+        for chat_id, excp in failed:
+            errors[chat_id] = getattr(excp, "message", None) or repr(excp)
+            # kicked, or the chat's gone; don't bother trying again next time
+            if isinstance(excp, Unauthorized) or errors[chat_id] == "Chat not found":
+                dead_chats[chat_id] = errors[chat_id]
+            else:
+                LOGGER.warning("Couldn't send broadcast %s to %s: %s", broadcast_id, chat_id, errors[chat_id])
+
+        broadcast_sql.record_batch(broadcast_id, chat_ids, errors, dead_chats)
+        cursor = chat_ids[-1]
+
+
+@cleans_up
+def resume_broadcasts(bot: Bot, job=None):
+    # retries only get the broadcasts which didn't fit last time, so none are run twice
+    broadcast_ids = job.context if job and job.context else broadcast_sql.get_unfinished_broadcast_ids()
+    for index, broadcast_id in enumerate(broadcast_ids):
+        if BULK_LANE.submit(run_broadcast, bot, broadcast_id) is None:
+            LOGGER.warning("The bulk lane is full, trying to resume broadcasts %s again in %ss",
+                           broadcast_ids[index:], RESUME_RETRY_INTERVAL)
+            dispatcher.job_queue.run_once(resume_broadcasts, RESUME_RETRY_INTERVAL, context=broadcast_ids[index:])
+            return
+        LOGGER.info("Resuming broadcast %s", broadcast_id)
+
+
+@run_in_lane(BULK_LANE)
 def broadcast(bot: Bot, update: Update):
     to_send = update.effective_message.text.split(None, 1)
     if len(to_send) >= 2:
-        chats = sql.get_all_chats() or []
-        failed = 0
-        for chat in chats:
-            try:
-                bot.sendMessage(int(chat.chat_id), to_send[1])
-                sleep(0.1)
-            except TelegramError:
-                failed += 1
-                LOGGER.warning("Couldn't send broadcast to %s, group name %s", str(chat.chat_id), str(chat.chat_name))
+        broadcast_id = broadcast_sql.new_broadcast(to_send[1], update.effective_chat.id)
+        update.effective_message.reply_text("Started broadcast {}. Use /broadcaststatus to see how it's "
+                                            "going.".format(broadcast_id))
+        run_broadcast(bot, broadcast_id)
+
+
+@run_async
+def broadcast_status(bot: Bot, update: Update):
+    broadcasts = broadcast_sql.get_latest_broadcasts()
+    if not broadcasts:
+        update.effective_message.reply_text("There haven't been any broadcasts yet.")
+        return
+
+    text = ""
+    for broadcast in broadcasts:
+        if broadcast.done:
+            state = "done"
+        elif broadcast.error:
+            state = "stopped early: {}".format(broadcast.error)
+        else:
+            state = "running"
+        text += "Broadcast {} ({}), started {}: {}/{} chats done, {} failed.\n".format(
+            broadcast.id, state, broadcast.started.strftime("%Y-%m-%d %H:%M"),
+            broadcast.sent + broadcast.failed, broadcast.total, broadcast.failed)
+    text += "{} chats are marked as dead, and skipped.".format(broadcast_sql.num_dead_chats())
+    update.effective_message.reply_text(text)
 
-        update.effective_message.reply_text("Broadcast complete. {} groups failed to receive the message, probably "
-                                            "due to being kicked.".format(failed))
 
 @run_async
 def snipe(bot: Bot, update: Update, args: List[str]):
     try:
-        chat_id = str(args[0])
+        chat_id = int(args[0])
         del args[0]
-    except TypeError as excp:
+    except (IndexError, ValueError):
         update.effective_message.reply_text("Please give me a chat to echo to!")
+        return
     to_send = " ".join(args)
     if len(to_send) >= 2:
         try:
-            bot.sendMessage(int(chat_id), str(to_send))
+            bot.sendMessage(chat_id, str(to_send))
         except TelegramError:
-            LOGGER.warning("Couldn't send to group %s", str(chat_id))
+            LOGGER.warning("Couldn't send to group %s", chat_id)
             update.effective_message.reply_text("Couldn't send the message. Perhaps I'm not part of that group?")
 
-@run_async
-def chats(bot: Bot, update: Update):
-    chats = sql.get_all_chats() or []
-
-    chatfile = 'List of chats.\n'
-    for chat in chats:
-        chatfile += "[x] {} - {}\n".format(chat.chat_name, chat.chat_id)
+@run_in_lane(BULK_LANE)
+def chats(bot: Bot, update: Update, args: List[str]):
+    _, export_format, compress = parse_export_args(args)
 
-    with BytesIO(str.encode(chatfile)) as output:
-        output.name = "chatlist.txt"
-        update.effective_message.reply_document(document=output, filename="chatlist.txt",
+    with export_rows(sql.iter_chats(), ("chat_id", "chat_name"), export_format, compress) as output:
+        update.effective_message.reply_document(document=output,
+                                                filename=export_filename("chatlist", export_format, compress),
                                                 caption="Here is the list of chats in my database.")
 
 
-@run_async
+# not @run_async: this only queues in-memory updates (and every message needs it), so it runs in the dispatcher
+# thread rather than as a job which could be dropped when the command lane is full.
 def log_user(bot: Bot, update: Update):
     chat = update.effective_chat  # type: Optional[Chat]
     msg = update.effective_message  # type: Optional[Message]
 
-    sql.update_user(msg.from_user.id,
-                    msg.from_user.username,
-                    chat.id,
-                    chat.title)
+    if broadcast_sql.is_chat_dead(chat.id):
+        # we're clearly back in the chat
+        broadcast_sql.revive_chat(chat.id)
+
+    sql.queue_user_update(msg.from_user.id,
+                          msg.from_user.username,
+                          chat.id,
+                          chat.title)
 
     if msg.reply_to_message:
-        sql.update_user(msg.reply_to_message.from_user.id,
-                        msg.reply_to_message.from_user.username,
-                        chat.id,
-                        chat.title)
+        sql.queue_user_update(msg.reply_to_message.from_user.id,
+                              msg.reply_to_message.from_user.username,
+                              chat.id,
+                              chat.title)
 
     if msg.forward_from:
-        sql.update_user(msg.forward_from.id,
-                        msg.forward_from.username)
+        sql.queue_user_update(msg.forward_from.id,
+                              msg.forward_from.username)
 
 
 def __user_info__(user_id):
@@ -170,11 +293,13 @@ def __user_info__(user_id):
 
 
 def __stats__():
-    return "{} users, across {} chats".format(sql.num_users(), sql.num_chats())
+    return "{} users, across {} chats\n{} user lookups saved by the known user cache".format(
+        sql.num_users(), sql.num_chats(), sql.num_saved_lookups())
 
 
 def __migrate__(old_chat_id, new_chat_id):
     sql.migrate_chat(old_chat_id, new_chat_id)
+    broadcast_sql.migrate_chat(old_chat_id, new_chat_id)
 
 
 __help__ = ""  # no help string
@@ -183,8 +308,9 @@ __mod_name__ = "Users"
 
 
 BROADCAST_HANDLER = CommandHandler("broadcast", broadcast, filters=CustomFilters.sudo_filter)
+BROADCAST_STATUS_HANDLER = CommandHandler("broadcaststatus", broadcast_status, filters=CustomFilters.sudo_filter)
 USER_HANDLER = MessageHandler(Filters.all & Filters.group, log_user)
-CHATSS_HANDLER = CommandHandler("chats", chats, filters=CustomFilters.sudo_filter)
+CHATSS_HANDLER = CommandHandler("chats", chats, pass_args=True, filters=CustomFilters.sudo_filter)
 SNIPE_HANDLER = CommandHandler("snipe", snipe, pass_args = True, filters=CustomFilters.sudo_filter)
 MEMSLIST_HANDLER = CommandHandler("userlist", userlist, pass_args = True, filters=CustomFilters.sudo_filter)
 BANALL_HANDLER = CommandHandler("banall", banall, pass_args = True, filters=CustomFilters.sudo_filter)
@@ -192,8 +318,13 @@ QUICKSCOPE_HANDLER = CommandHandler("quickscope", quickscope, pass_args = True,
 
 dispatcher.add_handler(USER_HANDLER, USERS_GROUP)
 dispatcher.add_handler(BROADCAST_HANDLER)
+dispatcher.add_handler(BROADCAST_STATUS_HANDLER)
 dispatcher.add_handler(CHATSS_HANDLER)
 dispatcher.add_handler(SNIPE_HANDLER)
 dispatcher.add_handler(MEMSLIST_HANDLER)
 dispatcher.add_handler(BANALL_HANDLER)
 dispatcher.add_handler(QUICKSCOPE_HANDLER)
+
+dispatcher.job_queue.run_repeating(cleans_up(sql.flush_user_updates), interval=sql.FLUSH_INTERVAL,
+                                   first=sql.FLUSH_INTERVAL)
+dispatcher.job_queue.run_once(resume_broadcasts, 0)
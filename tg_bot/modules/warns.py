@@ -14,6 +14,7 @@ from tg_bot.modules.helper_funcs.chat_status import is_user_admin, bot_admin, us
 from tg_bot.modules.helper_funcs.extraction import extract_text, extract_user_and_text, extract_user
 from tg_bot.modules.helper_funcs.misc import split_message
 from tg_bot.modules.helper_funcs.string_handling import split_quotes
+from tg_bot.modules.helper_funcs.update_context import get_context, skip_deleted
 from tg_bot.modules.log_channel import loggable
 from tg_bot.modules.sql import warns_sql as sql
 
@@ -212,7 +213,7 @@ def remove_warn_filter(bot: Bot, update: Update, args: List[str]):
         return
 
     for filt in chat_filters:
-        if filt.chat_id == str(chat.id) and filt.keyword == args[0]:
+        if filt.chat_id == chat.id and filt.keyword == args[0]:
             sql.remove_warn_filter(chat.id, args[0])
             update.effective_message.reply_text("Yep, I'll stop warning people for that.")
             raise DispatcherHandlerStop
@@ -244,14 +245,16 @@ def list_warn_filters(bot: Bot, update: Update):
 
 
 @run_async
+@skip_deleted
 @loggable
 def reply_filter(bot: Bot, update: Update) -> str:
-    chat_warn_filters = sql.get_chat_warn_filters(update.effective_chat.id)
     message = update.effective_message  # type: Optional[Message]
     to_match = extract_text(message)
     if not to_match:
         return ""
 
+    chat_warn_filters = get_context(update).chat_setting(sql.get_chat_warn_filters)
+
     for warn_filter in chat_warn_filters:
         pattern = r"( |^|[^\w])" + re.escape(warn_filter.keyword) + r"( |$|[^\w])"
         if re.search(pattern, to_match, flags=re.IGNORECASE):
@@ -365,6 +368,8 @@ be a sentence, encompass it with quotes, as such: `/addwarn "very angry" This is
 
 __mod_name__ = "Warnings"
 
+__fusable_groups__ = [WARN_HANDLER_GROUP]
+
 WARN_HANDLER = CommandHandler("warn", warn_user, pass_args=True, filters=Filters.group)
 RESET_WARN_HANDLER = CommandHandler("resetwarn", reset_warns, pass_args=True, filters=Filters.group)
 CALLBACK_QUERY_HANDLER = CallbackQueryHandler(button, pattern=r"rm_warn")
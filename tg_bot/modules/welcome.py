@@ -226,11 +226,11 @@ def welcome(bot: Bot, update: Update, args: List[str]):
 
     elif len(args) >= 1:
         if args[0].lower() in ("on", "yes"):
-            sql.set_welc_preference(str(chat.id), True)
+            sql.set_welc_preference(chat.id, True)
             update.effective_message.reply_text("I'll be polite!")
 
         elif args[0].lower() in ("off", "no"):
-            sql.set_welc_preference(str(chat.id), False)
+            sql.set_welc_preference(chat.id, False)
             update.effective_message.reply_text("I'm sulking, not saying hello anymore.")
 
         else:
@@ -262,11 +262,11 @@ def goodbye(bot: Bot, update: Update, args: List[str]):
 
     elif len(args) >= 1:
         if args[0].lower() in ("on", "yes"):
-            sql.set_gdbye_preference(str(chat.id), True)
+            sql.set_gdbye_preference(chat.id, True)
             update.effective_message.reply_text("I'll be sorry when people leave!")
 
         elif args[0].lower() in ("off", "no"):
-            sql.set_gdbye_preference(str(chat.id), False)
+            sql.set_gdbye_preference(chat.id, False)
             update.effective_message.reply_text("They leave, they're dead to me.")
 
         else:
@@ -32,8 +32,19 @@ class Config(object):
     DEL_CMDS = False  # Whether or not you should delete "blue text must click" commands
     STRICT_GBAN = False
     WORKERS = 8  # Number of subthreads to use. This is the recommended amount - see for yourself what works best!
+    COMMAND_QUEUE_SIZE = 500  # Max number of commands waiting for a worker; more are dropped. 0 means no limit
+    MODERATION_WORKERS = 4  # Threads which only enforce locks, antiflood and gbans, so commands can't hold them up
+    MODERATION_QUEUE_SIZE = 0  # Max number of messages waiting for a moderation thread. 0 means no limit
+    BULK_WORKERS = 2  # Threads for long jobs which message lots of chats: broadcasts, gbans, banall
+    BULK_QUEUE_SIZE = 20  # Max number of bulk jobs waiting for a thread. 0 means no limit
     BAN_STICKER = 'CAADAgADOwADPPEcAXkko5EB3YGYAg'  # banhammer marie sticker
     ALLOW_EXCL = False  # Allow ! commands as well as /
+    DB_POOL_SIZE = 0  # Number of db connections to keep open. 0 means one per worker, plus two
+    DB_POOL_RECYCLE = 1800  # Reopen db connections after this many seconds
+    DB_STATEMENT_TIMEOUT = 0  # Cancel db queries which take longer than this many milliseconds (postgres). 0 disables
+    SQLITE_WAL = False  # Use write-ahead logging when SQLALCHEMY_DATABASE_URI is an sqlite db, eg for local testing
+    FLOOD_WINDOW = 0  # If set, antiflood counts each user's messages over this many seconds, not consecutive messages
+    FUSED_PIPELINE = False  # Run the per-message handlers (locks, antiflood, filters...) one after another in one job
 
 
 class Production(Config):
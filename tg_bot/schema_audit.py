@@ -0,0 +1,164 @@
+"""
+Check that every query the sql modules make can use an index, and add the indexes which are missing.
+
+    python3 -m tg_bot.schema_audit           # list every query pattern, and whether the db has an index for it
+    python3 -m tg_bot.schema_audit --apply   # also create the missing indexes
+
+Tables are only created (with their indexes) when they don't exist yet, so databases created by an older version of
+the bot are missing any index added to the models since. Each pattern is checked by asking the database itself how it
+would run the query (EXPLAIN), so indexes created by hand, or under another name, count too. On postgres, indexes are
+built concurrently, so the bot can keep running meanwhile.
+Works with both postgres and sqlite.
+"""
+import argparse
+import re
+
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.engine.url import make_url
+
+from tg_bot import DB_URI, LOGGER
+
+# (table, columns compared with "=", used by) for every query pattern which filters a table. Columns are SQL
+# expressions; a pattern is covered by an index starting with the same columns, in any order.
+QUERY_PATTERNS = [
+    ("users", ("lower(username)",), "users_sql.get_userid_by_name"),
+    ("chat_members", ("chat",), "users_sql.get_chat_members, iter_chat_member_names, migrate_chat"),
+    ("chat_members", ("chat", '"user"'), "users_sql.update_user"),
+    ("chat_members", ('"user"',), "users_sql.get_user_num_chats"),
+    ("cust_filters", ("chat_id",), "cust_filters_sql.__load_chat_filters, migrate_chat"),
+    ("cust_filter_urls", ("chat_id",), "cust_filters_sql.__load_chat_filters, migrate_chat"),
+    ("cust_filter_urls", ("chat_id", "keyword"), "cust_filters_sql.add_filter, remove_filter"),
+    ("disabled_commands", ("chat_id",), "disable_sql.get_all_disabled, migrate_chat"),
+    ("notes", ("chat_id",), "notes_sql.get_all_chat_notes, migrate_chat"),
+    ("note_urls", ("chat_id",), "notes_sql.migrate_chat"),
+    ("note_urls", ("chat_id", "note_name"), "notes_sql.add_note_to_db, rm_note, get_buttons"),
+    ("warns", ("chat_id",), "warns_sql.migrate_chat"),
+    ("warn_filters", ("chat_id",), "warns_sql.get_chat_warn_filters, num_warn_chat_filters, migrate_chat"),
+    ("welcome_urls", ("chat_id",), "welcome_sql.set_custom_welcome, get_welc_buttons, migrate_chat"),
+    ("leave_urls", ("chat_id",), "welcome_sql.set_custom_gdbye, get_gdbye_buttons, migrate_chat"),
+    ("broadcast_outcomes", ("broadcast_id",), "broadcast_sql (cascading deletes of broadcasts)"),
+]
+
+
+def index_name(table, columns):
+    return "ix_{}_{}".format(table, "_".join(re.sub(r"\W+", "_", column).strip("_") for column in columns))
+
+
+def explain(conn, backend, table, columns):
+    """
+    :return: the query plan for looking up rows of table by columns, as one string
+    """
+    where = " AND ".join("{} = :p{}".format(column, i) for i, column in enumerate(columns))
+    query = "SELECT * FROM {} WHERE {}".format(table, where)
+    # the value is a string literal, which both dbs happily compare to text and integer columns alike
+    params = {"p{}".format(i): "1" for i in range(len(columns))}
+    if backend == "sqlite":
+        return "\n".join(row[-1] for row in conn.execute(text("EXPLAIN QUERY PLAN " + query), params))
+    return "\n".join(row[0] for row in conn.execute(text("EXPLAIN " + query), params))
+
+
+def uses_index(backend, plan):
+    if backend == "sqlite":
+        return any(line.startswith("SEARCH") for line in plan.splitlines())
+    return "Seq Scan" not in plan
+
+
+def has_leading_index(inspector, table, columns):
+    """
+    Postgres can scan a whole index just to filter on a later column, which looks fine in the plan but isn't; so also
+    check that some index actually starts with the pattern's columns. Expressions are left to the plan.
+    """
+    if any("(" in column for column in columns):
+        return True
+
+    names = {column.strip('"') for column in columns}
+    candidates = [inspector.get_pk_constraint(table)["constrained_columns"]]
+    candidates.extend(constraint["column_names"] for constraint in inspector.get_unique_constraints(table))
+    candidates.extend(index["column_names"] for index in inspector.get_indexes(table))
+    return any(set(candidate[:len(names)]) == names for candidate in candidates)
+
+
+def audit(engine):
+    """
+    :return: (table, columns, used by, plan, covered) for every query pattern whose table exists
+    """
+    backend = make_url(DB_URI).get_backend_name()
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    results = []
+    with engine.connect() as conn:
+        trans = conn.begin()
+        try:
+            if backend != "sqlite":
+                # tables which are still small get scanned anyway; we want to know whether an index *could* be used
+                conn.execute(text("SET LOCAL enable_seqscan = off"))
+            for table, columns, used_by in QUERY_PATTERNS:
+                if table not in tables:
+                    continue
+                plan = explain(conn, backend, table, columns)
+                covered = uses_index(backend, plan) and has_leading_index(inspector, table, columns)
+                results.append((table, columns, used_by, plan, covered))
+        finally:
+            trans.rollback()
+    return results
+
+
+def missing_indexes(results):
+    """
+    :return: (table, columns) of the indexes needed to cover every uncovered pattern. A pattern whose columns are the
+        start of another uncovered pattern's is left to that one's composite index.
+    """
+    uncovered = [(table, columns) for table, columns, _, _, covered in results if not covered]
+    return [(table, columns) for table, columns in uncovered
+            if not any(other_table == table and len(other) > len(columns) and set(other[:len(columns)]) == set(columns)
+                       for other_table, other in uncovered)]
+
+
+def create_index(engine, table, columns):
+    name = index_name(table, columns)
+    LOGGER.info("%s: building index %s", table, name)
+    concurrently = "" if make_url(DB_URI).get_backend_name() == "sqlite" else "CONCURRENTLY "
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("CREATE INDEX {}IF NOT EXISTS {} ON {} ({})".format(concurrently, name, table,
+                                                                             ", ".join(columns))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the db has an index for every query the bot makes.")
+    parser.add_argument("--apply", action="store_true", help="create the missing indexes")
+    parser.add_argument("--verbose", action="store_true", help="print the query plan of every pattern")
+    args = parser.parse_args()
+
+    if make_url(DB_URI).get_backend_name() == "sqlite":
+        engine = create_engine(DB_URI)
+    else:
+        engine = create_engine(DB_URI, client_encoding="utf8")
+
+    results = audit(engine)
+    for table, columns, used_by, plan, covered in results:
+        print("{:<5} {:<40} {}".format("ok" if covered else "SCAN", "{}({})".format(table, ", ".join(columns)),
+                                       used_by))
+        if args.verbose:
+            print("      " + plan.replace("\n", "\n      "))
+
+    missing = missing_indexes(results)
+    if not missing:
+        LOGGER.info("Every query pattern is covered by an index, nothing to do.")
+        return
+
+    if not args.apply:
+        LOGGER.info("%d indexes are missing; run again with --apply to create them.", len(missing))
+        return
+
+    for table, columns in missing:
+        create_index(engine, table, columns)
+
+    still_missing = missing_indexes(audit(engine))
+    if still_missing:
+        LOGGER.error("Some patterns still can't use an index: %s", still_missing)
+    else:
+        LOGGER.info("Done! Every query pattern is now covered by an index.")
+
+
+if __name__ == '__main__':
+    main()